@@ -1,30 +1,25 @@
-from flask import Flask, request, jsonify, make_response, send_file
+from flask import current_app, request, make_response, send_file
 from flask_restful import Api, Resource, reqparse
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt, get_jwt_identity
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-from model import db, User, Section, Book, Feedback, Request
-from flask_caching import Cache
-import redis 
-from celery_config import celery
-import os
-
-app = Flask(__name__)
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
-cache = Cache(app, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS': 'redis_client'})
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///librar.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['JWT_SECRET_KEY'] = 'librar'
-celery.conf.update(app.config)
-
-
-
-db.init_app(app)
-CORS(app, origins='*')
-jwt = JWTManager(app)
-api = Api(app)
-
+from model import db, User, Section, Book, Feedback, Request, RequestHistory, ExportJob, BookFile
+from sqlalchemy import func, select
+from stats import section_book_counts, section_book_counts_from_counters, library_totals, library_totals_from_counters
+from circulation import CirculationError, date_range, circulation_series, trending
+from pagination import MAX_LIMIT, PaginationError, paginate, int_arg, id_list_arg, filter_date_range, offset_page, encode_cursor
+from search import search_books
+from serializers import json_response, paginated_response, USER_SCHEMA, BOOK_SCHEMA, SECTION_BOOK_SCHEMA, REQUEST_SCHEMA, REQUEST_HISTORY_SCHEMA, FEEDBACK_SCHEMA
+from ingest import ingest_books, DEFAULT_BATCH_SIZE, FORMATS as INGEST_FORMATS
+from content import ContentError, UploadConflict, start_upload, parse_content_range, write_chunk, remove_files, current_file, can_read, content_path, upload_state
+from loans import place_request, set_request_status, transition_requests, LoanError, LoanLimitReached, DuplicateRequest, TRANSITIONS, MAX_BATCH_TRANSITIONS
+from caching import cached_by_entities, invalidate
+from etags import conditional, table_stamp, row_stamp
+from metrics import registry, PROMETHEUS_CONTENT_TYPE
+from database import read_session
+from factory import create_core_app
+import uuid
 
 class SignUpResource(Resource):
     def post(self):
@@ -60,7 +55,8 @@ class LoginResource(Resource):
         user = User.query.filter_by(username=args['username']).first()
 
         if user and check_password_hash(user.password, args['password']):
-            access_token = create_access_token(identity=user.role)
+            # The identity stays the role; the id lets per-user endpoints check what this user may read.
+            access_token = create_access_token(identity=user.role, additional_claims={'user_id': user.id})
             user_info = {"id": user.id, "username": user.username, "role": user.role}
             return {"access_token": access_token, "user": user_info}, 200
         else:
@@ -68,60 +64,52 @@ class LoginResource(Resource):
 
 
 class UserInfo(Resource):
-    @cache.cached(timeout=20)
+    @cached_by_entities('user')
     def get(self):
-        users = User.query.filter(User.role != 'admin').all()
-        user_info = [{
-            "id": user.id,
-            "username": user.username,
-            "role": user.role
-        } for user in users]
-        return user_info
+        query, make = USER_SCHEMA.rows(read_session)
+        return json_response([make(row) for row in query.filter(User.role != 'admin')])
 
 
 
 
 class SectionResource(Resource):
+    @conditional(table_stamp('section', 'book'))
+    @cached_by_entities('section', 'book')
     def get(self, section_id=None):
+        include_books = request.args.get('include_books', 'true').lower() != 'false'
+
+        # One statement for both modes: sections joined to the projected book columns
+        # (or to a per-section book count in summary mode) instead of a query per section.
+        if include_books:
+            book_columns, make_book = SECTION_BOOK_SCHEMA.plan()
+            query = read_session.query(
+                Section.id, Section.name, *book_columns
+            ).outerjoin(Book, Book.section_id == Section.id).order_by(Section.id, Book.id)
+        else:
+            query = read_session.query(
+                Section.id, Section.name, func.count(Book.id)
+            ).outerjoin(Book, Book.section_id == Section.id).group_by(Section.id).order_by(Section.id)
+
         if section_id:
-            section = Section.query.get(section_id)
-            if not section:
+            query = query.filter(Section.id == section_id)
+
+        sections = {}
+        for row in query:
+            section = sections.get(row[0])
+            if section is None:
+                section = sections[row[0]] = {"id": row[0], "name": row[1]}
+                if include_books:
+                    section["books"] = []
+            if not include_books:
+                section["book_count"] = row[2]
+            elif row[2] is not None:
+                section["books"].append(make_book(row[2:]))
+
+        if section_id:
+            if section_id not in sections:
                 return {"message": "Section not found"}, 404
-            
-            books = Book.query.filter_by(section_id=section_id).all()
-            books_data = [{
-                "id": book.id,
-                "name": book.name,
-                "author": book.author,
-                "content": book.content,
-                "issue_date": book.issue_date.strftime('%Y-%m-%d'),
-                "return_date": book.return_date.strftime('%Y-%m-%d')
-            } for book in books]
-            
-            return jsonify({
-                "id": section.id,
-                "name": section.name,
-                "books": books_data
-            })
-        else:
-            sections = Section.query.all()
-            sections_data = []
-            for section in sections:
-                books = Book.query.filter_by(section_id=section.id).all()
-                books_data = [{
-                    "id": book.id,
-                    "name": book.name,
-                    "author": book.author,
-                    "content": book.content,
-                    "issue_date": book.issue_date.strftime('%Y-%m-%d'),
-                    "return_date": book.return_date.strftime('%Y-%m-%d')
-                } for book in books]
-                sections_data.append({
-                    "id": section.id,
-                    "name": section.name,
-                    "books": books_data
-                })
-            return jsonify(sections_data)
+            return json_response(sections[section_id])
+        return json_response(list(sections.values()))
 
     def post(self):
         parser = reqparse.RequestParser()
@@ -163,23 +151,24 @@ class SectionResource(Resource):
 
 
 class BookResource(Resource):
+    @conditional(table_stamp('book'))
+    @cached_by_entities('book')
     def get(self):
-        user_id = request.args.get('user_id')
-        if user_id:
-            books = Book.query.filter_by(user_id=user_id).all()
-        else:
-            books = Book.query.all()
-        return jsonify([{
-            "id": book.id,
-            "name": book.name,
-            "author": book.author,
-            "content": book.content,
-            "section_id": book.section_id,
-            "user_id": book.user_id,
-            "created_at": book.created_at,
-            "issue_date": book.issue_date.strftime('%Y-%m-%d'),
-            "return_date": book.return_date.strftime('%Y-%m-%d')
-        } for book in books])
+        try:
+            keys = [Book.created_at, Book.id] if request.args.get('sort') == 'created_at' else [Book.id]
+            query, make = BOOK_SCHEMA.rows(read_session, BOOK_SCHEMA.fields_arg(), extra=keys)
+            user_id = int_arg('user_id')
+            if user_id is not None:
+                query = query.filter(Book.user_id == user_id)
+            section_id = int_arg('section_id')
+            if section_id is not None:
+                query = query.filter(Book.section_id == section_id)
+            query = filter_date_range(query, Book.created_at, 'created')
+            books, next_cursor = paginate(query, keys)
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+
+        return paginated_response([make(book) for book in books], next_cursor)
 
     def post(self):
         parser = reqparse.RequestParser()
@@ -256,32 +245,59 @@ class BookResource(Resource):
         return {"message": "Book deleted successfully"}, 200
 
 
+class BookBulkResource(Resource):
+    @jwt_required()
+    def post(self):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+
+        upload = request.files.get('file')
+        filename = upload.filename if upload else ''
+        fmt = request.args.get('format') or ('jsonl' if filename.endswith(('.jsonl', '.ndjson')) else 'csv')
+        if fmt not in INGEST_FORMATS:
+            return {'message': f"format must be one of {', '.join(INGEST_FORMATS)}"}, 400
+        try:
+            batch_size = min(max(int_arg('batch_size') or DEFAULT_BATCH_SIZE, 1), 10000)
+        except PaginationError as e:
+            return {'message': str(e)}, 400
+        upsert = request.args.get('upsert', 'false').lower() == 'true'
+
+        report = ingest_books(db.engine, upload.stream if upload else request.stream, fmt, batch_size, upsert)
+        # Core executemany bypasses the session hooks, so invalidate the cached views here.
+        try:
+            invalidate('book', 'section')
+        except Exception as e:
+            print(f"Cache invalidation failed after bulk ingest: {e}")
+        return report, 200
+
+
 class RequestResource(Resource):
     def get(self, user_id):
-        if user_id != 1:
-            requests = Request.query.filter_by(user_id=user_id).all()
-        else:
-            requests = Request.query.all()
-
-        return jsonify([{
-            "id": request.id,
-            "user_id": request.user_id,
-            "book_id": request.book_id,
-            "book_name": request.book.name,
-            "book_author": request.book.author,
-            "issue_date": request.issue_date.strftime('%Y-%m-%d'),
-            "return_date": request.return_date.strftime('%Y-%m-%d'),
-            "status": request.status,
-            "book": {
-                "content": request.book.content if request.book else "No content available",
-                "section_id": request.book.section_id,
-                "section_name": request.book.section.name
-            },
-            "user": {
-                "username": request.user.username,
-                "email": request.user.email
-            }
-        } for request in requests])
+        try:
+            query, make = REQUEST_SCHEMA.rows(read_session, REQUEST_SCHEMA.fields_arg(), extra=[Request.id])
+            query = query.select_from(Request).join(Book, Book.id == Request.book_id) \
+                .join(Section, Section.id == Book.section_id).join(User, User.id == Request.user_id)
+            if user_id != 1:
+                query = query.filter(Request.user_id == user_id)
+            ids = id_list_arg('ids')
+            if ids:
+                query = query.filter(Request.id.in_(ids))
+            status = request.args.get('status')
+            if status:
+                query = query.filter(Request.status.in_(status.split(',')))
+            book_id = int_arg('book_id')
+            if book_id is not None:
+                query = query.filter(Request.book_id == book_id)
+            section_id = int_arg('section_id')
+            if section_id is not None:
+                query = query.filter(Book.section_id == section_id)
+            query = filter_date_range(query, Request.issue_date, 'issued')
+            query = filter_date_range(query, Request.return_date, 'due')
+            requests, next_cursor = paginate(query, [Request.id])
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+
+        return paginated_response([make(row) for row in requests], next_cursor)
 
     def post(self):
         parser = reqparse.RequestParser()
@@ -289,29 +305,12 @@ class RequestResource(Resource):
         parser.add_argument('book_id', required=True, type=int)
         args = parser.parse_args()
 
-        # Check if the user has 5 or more books accepted or pending
-        active_requests_count = Request.query.filter_by(user_id=args['user_id']).filter(Request.status.in_(['pending', 'accepted'])).count()
-        if active_requests_count >= 5:
+        try:
+            place_request(db.session, args['user_id'], args['book_id'])
+        except LoanLimitReached:
             return {"message": "You cannot request more than 5 books at a time. Please return some books first."}, 400
-
-        # Check if the user has a pending or accepted request for the same book
-        existing_request = Request.query.filter_by(user_id=args['user_id'], book_id=args['book_id']).filter(Request.status.in_(['pending', 'accepted'])).first()
-        if existing_request:
+        except DuplicateRequest:
             return {"message": "You have already requested this book or the request is still pending."}, 400
-
-        # Set issue_date to today and return_date to one week from today
-        issue_date = datetime.now()
-        return_date = issue_date + timedelta(weeks=1)
-
-        new_request = Request(
-            user_id=args['user_id'],
-            book_id=args['book_id'],
-            status='pending',
-            issue_date=issue_date,
-            return_date=return_date
-        )
-        db.session.add(new_request)
-        db.session.commit()
         return {"message": "Request created successfully"}, 201
 
     def put(self, request_id):
@@ -319,20 +318,14 @@ class RequestResource(Resource):
         parser.add_argument('status', required=True, type=str)
         args = parser.parse_args()
 
-        request = Request.query.get(request_id)
+        try:
+            request = set_request_status(db.session, request_id, args['status'])
+        except LoanLimitReached:
+            return {"message": "You cannot request more than 5 books at a time. Please return some books first."}, 400
+        except DuplicateRequest:
+            return {"message": "You have already requested this book or the request is still pending."}, 400
         if not request:
             return {"message": "Request not found"}, 404
-
-        request.status = args['status']
-
-        if args['status'] == 'accepted':
-            book = Book.query.get(request.book_id)
-            book.user_id = request.user_id
-        elif args['status'] == 'revoked':
-            book = Book.query.get(request.book_id)
-            book.user_id = None
-
-        db.session.commit()
         return {"message": "Request updated successfully"}, 200
 
     def delete(self, request_id):
@@ -346,6 +339,74 @@ class RequestResource(Resource):
     
     
 
+class RequestBatchResource(Resource):
+    @jwt_required()
+    def post(self):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+
+        body = request.get_json(silent=True) or {}
+        action = body.get('action')
+        if action not in TRANSITIONS:
+            return {'message': f"action must be one of {', '.join(TRANSITIONS)}"}, 400
+        ids = body.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                return {'message': 'ids must be a list of integers'}, 400
+            if len(ids) > MAX_BATCH_TRANSITIONS:
+                return {'message': f'at most {MAX_BATCH_TRANSITIONS} ids per batch'}, 400
+        filters = {}
+        for name in ('section_id', 'user_id', 'book_id'):
+            if body.get(name) is not None:
+                if not isinstance(body[name], int):
+                    return {'message': f'{name} must be an integer'}, 400
+                filters[name] = body[name]
+
+        try:
+            results = transition_requests(db.session, action, ids, **filters)
+            db.session.commit()
+        except LoanError as e:
+            db.session.rollback()
+            return {'message': str(e)}, 400
+        return {
+            'action': action,
+            'updated': sum(result['ok'] for result in results),
+            'results': results
+        }, 200
+
+
+class RequestHistoryResource(Resource):
+    """Archived requests. Readers see their own; admins anyone's, or ?user_id= for one reader."""
+    @jwt_required()
+    def get(self):
+        if get_jwt_identity() == 'admin':
+            user_id = None
+        else:
+            user_id = get_jwt().get('user_id')
+            if user_id is None:
+                return {"message": "Token has no user id; log in again"}, 403
+        try:
+            if user_id is None:
+                user_id = int_arg('user_id')
+            query, make = REQUEST_HISTORY_SCHEMA.rows(read_session, REQUEST_HISTORY_SCHEMA.fields_arg(), extra=[RequestHistory.id])
+            query = query.select_from(RequestHistory).outerjoin(Book, Book.id == RequestHistory.book_id)
+            if user_id is not None:
+                query = query.filter(RequestHistory.user_id == user_id)
+            book_id = int_arg('book_id')
+            if book_id is not None:
+                query = query.filter(RequestHistory.book_id == book_id)
+            status = request.args.get('status')
+            if status:
+                query = query.filter(RequestHistory.status.in_(status.split(',')))
+            query = filter_date_range(query, RequestHistory.issue_date, 'issued')
+            query = filter_date_range(query, RequestHistory.return_date, 'due')
+            requests, next_cursor = paginate(query, [RequestHistory.id])
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+
+        return paginated_response([make(row) for row in requests], next_cursor)
+
+
 class ReturnBookResource(Resource):
     def put(self, book_id):
         parser = reqparse.RequestParser()
@@ -365,28 +426,25 @@ class ReturnBookResource(Resource):
 
 
 class FeedbackResource(Resource):
+    @conditional(table_stamp('feedback', 'book', 'user'))
+    @cached_by_entities('feedback', 'book', 'user')
     def get(self, book_id=None):
-        if book_id:
-            feedbacks = Feedback.query.filter_by(book_id=book_id).all()
-            if not feedbacks:
-                return jsonify([])
-
-            return jsonify([{
-                "id": feedback.id,
-                "user_id": feedback.user_id,
-                "book_id": feedback.book_id,
-                "content": feedback.content,
-                "user": {"username": feedback.user.username}  
-            } for feedback in feedbacks])
-        else:
-            feedbacks = Feedback.query.all()
-            return jsonify([{
-                "id": feedback.id,
-                "user_id": feedback.user_id,
-                "book_id": feedback.book_id,
-                "content": feedback.content,
-                "user": {"username": feedback.user.username}  
-            } for feedback in feedbacks])
+        try:
+            query, make = FEEDBACK_SCHEMA.rows(read_session, FEEDBACK_SCHEMA.fields_arg(), extra=[Feedback.id])
+            query = query.select_from(Feedback).join(User, User.id == Feedback.user_id)
+            if book_id:
+                query = query.filter(Feedback.book_id == book_id)
+            user_id = int_arg('user_id')
+            if user_id is not None:
+                query = query.filter(Feedback.user_id == user_id)
+            section_id = int_arg('section_id')
+            if section_id is not None:
+                query = query.join(Book, Book.id == Feedback.book_id).filter(Book.section_id == section_id)
+            feedbacks, next_cursor = paginate(query, [Feedback.id])
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+
+        return paginated_response([make(row) for row in feedbacks], next_cursor)
 
     def post(self):
         parser = reqparse.RequestParser()
@@ -402,111 +460,371 @@ class FeedbackResource(Resource):
 
 
 
-class BooksInLibraryStatsResource(Resource):
-    @cache.cached(timeout=20)
+FEEDBACK_BATCH_MAX_BOOKS = 1000
+FEEDBACK_BATCH_PER_BOOK = 20
+
+
+class FeedbackBatchResource(Resource):
+    @conditional(table_stamp('feedback', 'book', 'user'))
+    @cached_by_entities('feedback', 'book', 'user')
     def get(self):
-        sections = Section.query.all()
-        books_in_library = {}
+        try:
+            book_ids = id_list_arg('book_ids')
+            section_ids = id_list_arg('section_id')
+            per_book = min(max(int_arg('per_book') or FEEDBACK_BATCH_PER_BOOK, 1), MAX_LIMIT)
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+        if not book_ids and not section_ids:
+            return {"message": "book_ids or section_id is required"}, 400
+        if len(book_ids) > FEEDBACK_BATCH_MAX_BOOKS:
+            return {"message": f"At most {FEEDBACK_BATCH_MAX_BOOKS} book_ids per request"}, 400
+
+        # One statement: newest feedback per book ranked by a window, with each book's total alongside.
+        ranked = select(
+            Feedback.id, Feedback.user_id, Feedback.book_id, Feedback.content, User.username,
+            func.row_number().over(partition_by=Feedback.book_id, order_by=Feedback.id.desc()).label('position'),
+            func.count().over(partition_by=Feedback.book_id).label('total')
+        ).join(User, User.id == Feedback.user_id)
+        if book_ids:
+            ranked = ranked.where(Feedback.book_id.in_(book_ids))
+        if section_ids:
+            ranked = ranked.join(Book, Book.id == Feedback.book_id).where(Book.section_id.in_(section_ids))
+        ranked = ranked.subquery()
+        rows = read_session.execute(
+            select(ranked).where(ranked.c.position <= per_book).order_by(ranked.c.book_id, ranked.c.position)
+        )
+
+        grouped = {str(book_id): {"count": 0, "feedbacks": []} for book_id in book_ids}
+        for feedback_id, user_id, book_id, content, username, position, total in rows:
+            book = grouped.setdefault(str(book_id), {"count": 0, "feedbacks": []})
+            book["count"] = total
+            book["feedbacks"].append({
+                "id": feedback_id,
+                "user_id": user_id,
+                "book_id": book_id,
+                "content": content,
+                "user": {"username": username}
+            })
+        return json_response(grouped)
 
-        for section in sections:
-            section_name = section.name
-            books_in_library[section_name] = Book.query.filter_by(section_id=section.id).count()
 
+class BooksInLibraryStatsResource(Resource):
+    @cached_by_entities('section', 'book')
+    def get(self):
+        counts = section_book_counts_from_counters() if current_app.config['STATS_USE_COUNTERS'] else section_book_counts()
         return {
-            "sections": list(books_in_library.keys()),
-            "counts": list(books_in_library.values())
+            "sections": [name for name, total, issued in counts],
+            "counts": [total for name, total, issued in counts]
         }
 
 class BooksIssuedStatsResource(Resource):
-    @cache.cached(timeout=20)
+    @cached_by_entities('section', 'book')
     def get(self):
-        sections = Section.query.all()
-        books_issued = {}
+        counts = section_book_counts_from_counters() if current_app.config['STATS_USE_COUNTERS'] else section_book_counts()
+        return {
+            "sections": [name for name, total, issued in counts],
+            "counts": [issued for name, total, issued in counts]
+        }
 
-        for section in sections:
-            section_name = section.name
-            books_issued[section_name] = Book.query.filter(Book.section_id == section.id, Book.user_id.isnot(None)).count()
+class LibraryStatsResource(Resource):
+    @cached_by_entities('section', 'book', 'request', 'user')
+    def get(self):
+        totals = library_totals_from_counters() if current_app.config['STATS_USE_COUNTERS'] else library_totals()
 
         return {
-            "sections": list(books_issued.keys()),
-            "counts": list(books_issued.values())
+            "total_books": totals['books'],
+            "total_sections": totals['sections'],
+            "total_books_issued": totals['requests_accepted'],
+            "total_users": totals['users']
         }
 
-class LibraryStatsResource(Resource):
+
+# Served from circulation_daily, which roll_up_circulation_task brings up to date every few minutes.
+class CirculationStatsResource(Resource):
+    @cached_by_entities('circulation_daily', 'book_circulation_daily')
     def get(self):
-        total_books = Book.query.count()
-        total_sections = Section.query.count()
-        total_books_issued = Request.query.filter_by(status='accepted').count()
-        total_users = User.query.filter(User.role != 'admin').count()
+        interval = request.args.get('interval', 'day')
+        try:
+            start, end = date_range(request.args.get('from'), request.args.get('to'))
+            series, totals = circulation_series(start, end, interval, int_arg('section_id'), int_arg('book_id'))
+        except (CirculationError, PaginationError) as e:
+            return {"message": str(e)}, 400
+        return {
+            "from": start.strftime('%Y-%m-%d'),
+            "to": end.strftime('%Y-%m-%d'),
+            "interval": interval,
+            "series": series,
+            "totals": totals
+        }
 
+class TrendingStatsResource(Resource):
+    @cached_by_entities('circulation_daily', 'book_circulation_daily', 'book', 'section')
+    def get(self):
+        by = request.args.get('by', 'book')
+        metric = request.args.get('metric', 'requested')
+        try:
+            start, end = date_range(request.args.get('from'), request.args.get('to'))
+            limit = int_arg('limit')
+            items = trending(start, end, by, metric, 10 if limit is None else limit, int_arg('section_id'))
+        except (CirculationError, PaginationError) as e:
+            return {"message": str(e)}, 400
         return {
-            "total_books": total_books,
-            "total_sections": total_sections,
-            "total_books_issued": total_books_issued,
-            "total_users": total_users
+            "from": start.strftime('%Y-%m-%d'),
+            "to": end.strftime('%Y-%m-%d'),
+            "by": by,
+            "metric": metric,
+            "items": items
         }
 
 
 
 
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
 class ExportResource(Resource):
     @jwt_required()
     def post(self,user_id):
         user_role = get_jwt_identity()
         if user_role !='admin':
-            return jsonify({'message':'access deneid'})
+            return {'message': 'access denied'}, 403
+
+        data = request.get_json(silent=True) or {}
+        export_format = data.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            return {'message': f"format must be one of {', '.join(EXPORT_FORMATS)}"}, 400
+
+        from tasks import export_sections_details
+
+        job = ExportJob(id=str(uuid.uuid4()), user_id=user_id, format=export_format, gzip=bool(data.get('gzip')))
+        db.session.add(job)
+        db.session.commit()
         try:
-            from tasks import export_sections_details_as_csv
+            export_sections_details.delay(job.id)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)[:255]
+            db.session.commit()
+            return {'message': 'Export could not be queued', 'job_id': job.id}, 503
 
-            csv_data = export_sections_details_as_csv(user_id)
+        return {'job_id': job.id, 'status': job.status}, 202
 
-            response = make_response(csv_data)
 
-            response.headers['Content-Disposition'] = 'attachment;filename=section_report.csv'
+class ExportJobResource(Resource):
+    @jwt_required()
+    def get(self, job_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        job = db.session.get(ExportJob, job_id)
+        if not job:
+            return {'message': 'Export job not found'}, 404
+        return {
+            'job_id': job.id,
+            'status': job.status,
+            'format': job.format,
+            'gzip': job.gzip,
+            'rows': job.rows,
+            'error': job.error,
+            'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None
+        }
 
-            response.headers['Content-type'] = 'text/csv'
 
-            return response
-        except Exception as e:
-            return jsonify(e),500
+class ExportDownloadResource(Resource):
+    @jwt_required()
+    def get(self, job_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        job = db.session.get(ExportJob, job_id)
+        if not job:
+            return {'message': 'Export job not found'}, 404
+        if job.status != 'done':
+            return {'message': f'Export is {job.status}'}, 409
+
+        from tasks import export_file_name
+
+        # send_file streams the file from disk in blocks (or via the server's sendfile support).
+        return send_file(
+            job.path,
+            mimetype='application/gzip' if job.gzip else ('text/csv' if job.format == 'csv' else 'application/x-ndjson'),
+            as_attachment=True,
+            download_name=export_file_name(job),
+            conditional=True
+        )
 
 
-class SingleBookResource(Resource):
-    def get(self, book_id):
-        book = Book.query.get(book_id)
-        if not book:
-            return {"message": "Book not found"}, 404
-        return jsonify({
-            "id": book.id,
-            "name": book.name,
-            "author": book.author,
-            "content": book.content,
-            "section_id": book.section_id,
-            "user_id": book.user_id,
-            "created_at": book.created_at,
-            "issue_date": book.issue_date.strftime('%Y-%m-%d'),
-            "return_date": book.return_date.strftime('%Y-%m-%d')
-        })
+class BookContentUploadResource(Resource):
+    @jwt_required()
+    def post(self, book_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        if db.session.get(Book, book_id) is None:
+            return {'message': 'Book not found'}, 404
 
+        data = request.get_json(silent=True) or {}
+        try:
+            book_file = start_upload(db.session, book_id, data.get('filename'), data.get('size'),
+                                     current_app.config['CONTENT_MAX_BYTES'])
+        except ContentError as e:
+            return {'message': str(e)}, 400
+        db.session.commit()
+        return upload_state(book_file), 201
 
 
+class BookContentChunkResource(Resource):
+    def upload(self, book_id, upload_id):
+        book_file = db.session.get(BookFile, upload_id)
+        return book_file if book_file is not None and book_file.book_id == book_id else None
 
+    @jwt_required()
+    def get(self, book_id, upload_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        book_file = self.upload(book_id, upload_id)
+        if book_file is None:
+            return {'message': 'Upload not found'}, 404
+        return upload_state(book_file), 200
 
+    @jwt_required()
+    def put(self, book_id, upload_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        book_file = self.upload(book_id, upload_id)
+        if book_file is None:
+            return {'message': 'Upload not found'}, 404
+        if book_file.status != 'uploading':
+            return dict(upload_state(book_file), message=f'Upload is {book_file.status}'), 409
 
-api.add_resource(LibraryStatsResource, '/api/stats/library')
-api.add_resource(SingleBookResource, '/api/book/<int:book_id>')
-api.add_resource(ExportResource,'/exportcsv/<int:user_id>')
-api.add_resource(BooksInLibraryStatsResource, '/api/stats/books-in-library')
-api.add_resource(BooksIssuedStatsResource, '/api/stats/books-issued')
-api.add_resource(FeedbackResource, '/api/feedback', '/api/feedback/<int:book_id>')
-api.add_resource(ReturnBookResource, '/api/request/return/<int:book_id>')
-api.add_resource(RequestResource, '/api/request', '/api/request/<int:request_id>', '/api/request/user/<int:user_id>')
-api.add_resource(BookResource, '/api/book')
-api.add_resource(SectionResource, '/api/section', '/api/section/<int:section_id>')
-api.add_resource(UserInfo, '/api/userinfo')
-api.add_resource(SignUpResource, '/api/signup')
-api.add_resource(LoginResource, '/api/login')
+        try:
+            start, end = parse_content_range(request.headers.get('Content-Range'), book_file.size)
+            if request.content_length != end - start + 1:
+                return {'message': 'Content-Length must match the Content-Range'}, 400
+            # The body is read from the WSGI stream block by block, never buffered whole.
+            write_chunk(db.session, book_file, request.stream, start, end, current_app.config['CONTENT_DIR'])
+        except UploadConflict as e:
+            return dict(upload_state(book_file), message=str(e)), 409
+        except ContentError as e:
+            return dict(upload_state(book_file), message=str(e)), 400
+        return upload_state(book_file), 200
+
+
+class BookContentResource(Resource):
+    @jwt_required()
+    def get(self, book_id):
+        # Admins, and readers holding an accepted request for the book.
+        if get_jwt_identity() != 'admin' and not can_read(read_session, book_id, get_jwt().get('user_id')):
+            return {'message': 'access denied'}, 403
+        book_file = current_file(read_session, book_id)
+        if book_file is None:
+            return {'message': 'No content uploaded for this book'}, 404
+
+        # conditional=True answers Range, If-Range, If-None-Match and If-Modified-Since from the file on
+        # disk; with USE_X_SENDFILE the front server sends the file and handles ranges itself.
+        try:
+            response = send_file(
+                content_path(current_app.config['CONTENT_DIR'], book_file),
+                mimetype=book_file.media_type,
+                download_name=book_file.filename,
+                conditional=True,
+                etag=book_file.sha256,
+                last_modified=book_file.finished_at
+            )
+        except FileNotFoundError:
+            return {'message': 'No content uploaded for this book'}, 404
+        # Werkzeug only advertises ranges on 206 replies; PDF viewers look for it on the first full one.
+        response.accept_ranges = 'bytes'
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    @jwt_required()
+    def delete(self, book_id):
+        if get_jwt_identity() != 'admin':
+            return {'message': 'access denied'}, 403
+        removed = remove_files(db.session, current_app.config['CONTENT_DIR'], BookFile.book_id == book_id)
+        if not removed:
+            return {'message': 'No content uploaded for this book'}, 404
+        return {'message': 'Content deleted', 'removed': removed}, 200
+
+
+class SearchResource(Resource):
+    @cached_by_entities('book', 'feedback', 'section')
+    def get(self):
+        query = request.args.get('q', '').strip()
+        if not query:
+            return {"message": "q is required"}, 400
+        try:
+            section_id = int_arg('section_id')
+            limit, offset = offset_page()
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+
+        results = search_books(read_session, query, section_id=section_id, limit=limit + 1, offset=offset)
+        next_cursor = encode_cursor([offset + limit]) if len(results) > limit else None
+        return paginated_response([{
+            "id": book_id,
+            "name": name,
+            "author": author,
+            "section_id": book_section_id,
+            "section_name": section_name,
+            "rank": rank
+        } for book_id, name, author, book_section_id, section_name, rank in results[:limit]], next_cursor)
+
+
+class MetricsResource(Resource):
+    def get(self):
+        if not current_app.config['METRICS_ENABLED']:
+            return {"message": "Metrics are disabled"}, 404
+        return make_response(registry.render(), 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+class SingleBookResource(Resource):
+    @conditional(row_stamp(Book, 'book_id'))
+    @cached_by_entities('book')
+    def get(self, book_id):
+        try:
+            query, make = BOOK_SCHEMA.rows(read_session, BOOK_SCHEMA.fields_arg())
+        except PaginationError as e:
+            return {"message": str(e)}, 400
+        book = query.filter(Book.id == book_id).first()
+        if not book:
+            return {"message": "Book not found"}, 404
+        return json_response(make(book))
+
+
+def create_app(config=None):
+    """The API process: the core app plus CORS, JWT and every resource."""
+    app = create_core_app(config)
+    CORS(app, origins='*', expose_headers=['X-Next-Cursor', 'ETag'])
+    JWTManager(app)
+    api = Api(app)
+    api.add_resource(LibraryStatsResource, '/api/stats/library')
+    api.add_resource(SearchResource, '/api/search')
+    api.add_resource(MetricsResource, '/api/metrics')
+    api.add_resource(SingleBookResource, '/api/book/<int:book_id>')
+    api.add_resource(BookContentResource, '/api/book/<int:book_id>/content')
+    api.add_resource(BookContentUploadResource, '/api/book/<int:book_id>/content/uploads')
+    api.add_resource(BookContentChunkResource, '/api/book/<int:book_id>/content/uploads/<string:upload_id>')
+    api.add_resource(ExportResource,'/exportcsv/<int:user_id>')
+    api.add_resource(ExportJobResource, '/api/export/<string:job_id>')
+    api.add_resource(ExportDownloadResource, '/api/export/<string:job_id>/download')
+    api.add_resource(BooksInLibraryStatsResource, '/api/stats/books-in-library')
+    api.add_resource(BooksIssuedStatsResource, '/api/stats/books-issued')
+    api.add_resource(CirculationStatsResource, '/api/stats/circulation')
+    api.add_resource(TrendingStatsResource, '/api/stats/trending')
+    api.add_resource(FeedbackBatchResource, '/api/feedback/batch')
+    api.add_resource(FeedbackResource, '/api/feedback', '/api/feedback/<int:book_id>')
+    api.add_resource(RequestBatchResource, '/api/request/batch')
+    api.add_resource(ReturnBookResource, '/api/request/return/<int:book_id>')
+    api.add_resource(RequestHistoryResource, '/api/request/history')
+    api.add_resource(RequestResource, '/api/request', '/api/request/<int:request_id>', '/api/request/user/<int:user_id>')
+    api.add_resource(BookBulkResource, '/api/book/bulk')
+    api.add_resource(BookResource, '/api/book')
+    api.add_resource(SectionResource, '/api/section', '/api/section/<int:section_id>')
+    api.add_resource(UserInfo, '/api/userinfo')
+    api.add_resource(SignUpResource, '/api/signup')
+    api.add_resource(LoginResource, '/api/login')
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,83 @@
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, inspect, literal, select, text
+from model import Request, RequestHistory, ReminderLog
+
+# Requests in these states never change again.
+FINISHED_STATUSES = ('returned', 'declined', 'revoked')
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_MAX_BATCHES = 200
+ARCHIVED_COLUMNS = ('user_id', 'book_id', 'issue_date', 'return_date', 'status')
+
+
+def _finished_before(cutoff):
+    return [Request.status.in_(FINISHED_STATUSES), Request.return_date < cutoff]
+
+
+def rebuild_request_history(connection):
+    """Give a request_history built keyed by the request id its own key and a request_id column."""
+    columns = {column['name'] for column in inspect(connection).get_columns('request_history')}
+    if 'request_id' in columns:
+        return
+    for index in RequestHistory.__table__.indexes:
+        connection.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    connection.execute(text('ALTER TABLE request_history RENAME TO request_history_old'))
+    RequestHistory.__table__.create(connection)
+    names = ', '.join([*ARCHIVED_COLUMNS, 'archived_at'])
+    connection.execute(text(
+        f'INSERT INTO request_history (request_id, {names}) SELECT id, {names} FROM request_history_old ORDER BY id'
+    ))
+    connection.execute(text('DROP TABLE request_history_old'))
+
+
+def archive_requests(session, after_days, batch_size=ARCHIVE_BATCH_SIZE, max_batches=ARCHIVE_MAX_BATCHES, now=None,
+                     dry_run=False):
+    """Move finished requests due more than after_days ago into request_history, one short transaction per batch.
+
+    Each batch starts with the INSERT into request_history, so it takes the write
+    lock up front and the API waits at most one batch. Their reminder_log rows go
+    too: reminders are only ever sent for accepted loans.
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=after_days)
+    finished = _finished_before(cutoff)
+    if dry_run:
+        count, oldest = session.query(func.count(Request.id), func.min(Request.return_date)).filter(*finished).one()
+        return {'dry_run': True, 'cutoff': cutoff.strftime('%Y-%m-%d'), 'archivable': count,
+                'oldest_return_date': oldest and oldest.strftime('%Y-%m-%d'), 'archived': 0, 'batches': 0}
+
+    archived = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = select(Request.id).where(*finished).order_by(Request.id).limit(batch_size)
+        columns = [getattr(Request, name) for name in ARCHIVED_COLUMNS]
+        ids = session.execute(
+            insert(RequestHistory).from_select(
+                ['request_id', *ARCHIVED_COLUMNS, 'archived_at'],
+                select(Request.id, *columns, literal(now, RequestHistory.archived_at.type))
+                .where(Request.id.in_(batch)).order_by(Request.id)
+            ).returning(RequestHistory.request_id)
+        ).scalars().all()
+        if not ids:
+            session.rollback()
+            break
+        session.execute(delete(ReminderLog).where(ReminderLog.request_id.in_(ids)))
+        session.execute(delete(Request).where(Request.id.in_(ids)))
+        session.commit()
+        archived += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+    return {'dry_run': False, 'cutoff': cutoff.strftime('%Y-%m-%d'), 'archived': archived, 'batches': batches}
+
+
+if __name__ == '__main__':
+    from factory import create_core_app
+    from model import db
+    app = create_core_app()
+    with app.app_context():
+        result = archive_requests(db.session, app.config['ARCHIVE_AFTER_DAYS'], max_batches=None,
+                                  dry_run='--dry-run' in sys.argv)
+        if result['dry_run']:
+            print(f"{result['archivable']} finished requests due before {result['cutoff']} would be archived")
+        else:
+            print(f"Archived {result['archived']} requests due before {result['cutoff']} in {result['batches']} batches")
@@ -0,0 +1,177 @@
+"""Throughput of book content uploads and concurrent HTTP Range reads.
+
+Run from the backend directory:
+
+    python -m benchmarks.content_range --size-mb 256 --concurrency 1,4,16
+
+Starts the API on a local threaded WSGI server against a throwaway database,
+uploads a generated PDF through the chunked upload endpoint, then has each
+client thread issue random Range requests over a keep-alive connection. Peak
+RSS is reported to show that neither uploads nor reads load the file into
+memory: it should grow by far less than the file size.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import warnings
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+MB = 1024 * 1024
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def generate_pdf(path, size):
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.7\n')
+        written = 9
+        while written < size:
+            chunk = block[:min(MB, size - written)]
+            f.write(chunk)
+            written += len(chunk)
+
+
+def request(connection, method, path, headers, body=None):
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    received = 0
+    for block in iter(lambda: response.read(64 * 1024), b''):
+        received += len(block)
+    return response.status, received
+
+
+class FileSlice:
+    def __init__(self, source, length):
+        self.source = source
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.source.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def upload(port, headers, path, size, chunk_size):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/api/book/1/content/uploads', body=f'{{"filename": "bench.pdf", "size": {size}}}',
+                       headers=dict(headers, **{'Content-Type': 'application/json'}))
+    response = connection.getresponse()
+    upload_id = json.loads(response.read())['upload_id']
+    with open(path, 'rb') as source:
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size) - 1
+            source.seek(start)
+            # http.client streams a file body in blocks rather than reading it whole.
+            status, _ = request(connection, 'PUT', f'/api/book/1/content/uploads/{upload_id}', dict(headers, **{
+                'Content-Range': f'bytes {start}-{end}/{size}', 'Content-Length': str(end - start + 1),
+                'Content-Type': 'application/octet-stream'
+            }), body=FileSlice(source, end - start + 1))
+            assert status == 200, status
+    connection.close()
+
+
+class QuietHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def read_ranges(port, headers, size, range_size, count, seed, latencies, totals):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    received = 0
+    for _ in range(count):
+        start = rng.randrange(0, size - range_size)
+        started = time.perf_counter()
+        status, length = request(connection, 'GET', '/api/book/1/content',
+                                 dict(headers, Range=f'bytes={start}-{start + range_size - 1}'))
+        latencies.append(time.perf_counter() - started)
+        assert status == 206 and length == range_size, (status, length)
+        received += length
+    connection.close()
+    totals.append(received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    parser.add_argument('--range-kb', type=int, default=256)
+    parser.add_argument('--requests', type=int, default=400, help='range requests per concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    from app import create_app
+    from model import db, init_db, User, Request
+    from flask_jwt_extended import create_access_token
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'DATABASE_FILE': os.path.join(directory, 'content.db'),
+            'CONTENT_DIR': os.path.join(directory, 'content'),
+            'CACHE_TYPE': 'SimpleCache',
+            'METRICS_ENABLED': False,
+            'EVENTS_BROKER': 'none',
+        })
+        init_db(app)
+        with app.app_context():
+            reader = User(username='reader', email='reader@librar.com', password='x')
+            db.session.add(reader)
+            db.session.commit()
+            db.session.add(Request(user_id=reader.id, book_id=1, status='accepted'))
+            db.session.commit()
+            admin = {'Authorization': 'Bearer ' + create_access_token(identity='admin')}
+            user = {'Authorization': 'Bearer ' + create_access_token(identity='user', additional_claims={'user_id': reader.id})}
+
+        server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+
+        size = args.size_mb * MB
+        source = os.path.join(directory, 'source.pdf')
+        generate_pdf(source, size)
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        upload(port, admin, source, size, args.chunk_mb * MB)
+        elapsed = time.perf_counter() - started
+        print(f"upload: {args.size_mb} MB in {args.chunk_mb} MB chunks, {elapsed:.2f}s, {args.size_mb / elapsed:.0f} MB/s "
+              f"(includes fsync per chunk and a sha256 pass)")
+
+        range_size = args.range_kb * 1024
+        print(f"{'clients':>7} {'req/s':>8} {'MB/s':>8} {'p50':>9} {'p95':>9}")
+        for clients in (int(value) for value in args.concurrency.split(',')):
+            latencies, totals = [], []
+            per_client = max(args.requests // clients, 1)
+            threads = [threading.Thread(target=read_ranges, args=(
+                port, user, size, range_size, per_client, f'{clients}:{i}', latencies, totals
+            )) for i in range(clients)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            print(f"{clients:>7} {len(latencies) / elapsed:>8.0f} {sum(totals) / MB / elapsed:>8.0f} "
+                  f"{statistics.median(latencies) * 1000:>7.1f}ms {latencies[int(len(latencies) * 0.95)] * 1000:>7.1f}ms")
+
+        server.shutdown()
+        print(f"peak RSS grew {peak_rss_mb() - rss_before:.0f} MB while uploading and serving a {args.size_mb} MB file")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""Synthetic large-library database generator.
+
+Run from the backend directory:
+
+    python -m benchmarks.datagen /tmp/librar-small.db --scale small
+    python -m benchmarks.datagen /tmp/librar-large.db --scale large --seed 7
+    python -m benchmarks.datagen /tmp/custom.db --books 50000 --requests 400000
+
+The same scale, seed and anchor date always produce the same rows; dates
+are relative to the anchor (today by default) so loans are due around it. Rows are bulk loaded
+into the bare schema and the migrations then build the indexes, counters,
+search index and triggers, exactly as they would on a production upgrade.
+Every user, including the "librarian" admin, has the password "librar".
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from werkzeug.security import generate_password_hash
+from migrations import migrate
+from model import db
+
+SCALES = {
+    'tiny': {'sections': 10, 'books': 2000, 'users': 500, 'requests': 20000, 'feedback': 5000},
+    'small': {'sections': 100, 'books': 20000, 'users': 5000, 'requests': 200000, 'feedback': 50000},
+    'large': {'sections': 1000, 'books': 200000, 'users': 50000, 'requests': 2000000, 'feedback': 500000},
+}
+
+GENRES = ['Fiction', 'Non-Fiction', 'Poetry', 'History', 'Science', 'Travel', 'Biography', 'Fantasy',
+          'Mystery', 'Philosophy', 'Art', 'Cookery', 'Drama', 'Law', 'Economics', 'Music']
+WORDS = ('river mountain shadow garden winter silver empire letter island machine harbour forest '
+         'secret journey kingdom stone window archive memory ocean lantern engine orchard signal '
+         'desert mirror thunder library voyage meadow citadel compass ember fable glacier horizon').split()
+FIRST_NAMES = ['Asha', 'Ben', 'Chen', 'Dara', 'Eli', 'Farah', 'Gita', 'Hugo', 'Ines', 'Jon', 'Kavya', 'Liam',
+               'Mei', 'Noor', 'Omar', 'Priya', 'Quinn', 'Ravi', 'Sara', 'Tomas', 'Uma', 'Vik', 'Wen', 'Yara']
+LAST_NAMES = ['Rao', 'Smith', 'Khan', 'Garcia', 'Ito', 'Mehta', 'Novak', 'Okafor', 'Silva', 'Weber', 'Zhou']
+
+HISTORY_DAYS = 730
+ACTIVE_WINDOW_DAYS = 30
+MAX_ACTIVE_PER_USER = 5
+INSERT_BATCH = 10000
+
+
+def skewed(rng, n):
+    # A few popular sections, books and readers take most of the traffic.
+    return min(int(n * rng.random() ** 2.5), n - 1) + 1
+
+
+def timestamp(value):
+    return value.isoformat(' ')
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def insert(connection, table, columns, rows):
+    statement = f'INSERT INTO "{table}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH:
+            connection.executemany(statement, batch)
+            batch = []
+    if batch:
+        connection.executemany(statement, batch)
+
+
+def users(rng, count, now):
+    password = generate_password_hash('librar')
+    yield 1, 'librarian', password, 'librarian@librar.com', 'admin', timestamp(now)
+    for i in range(2, count + 1):
+        name = f'{rng.choice(FIRST_NAMES).lower()}.{rng.choice(LAST_NAMES).lower()}{i}'
+        yield i, name, password, f'{name}@librar.com', 'user', timestamp(now)
+
+
+def sections(count, now):
+    for i in range(1, count + 1):
+        genre = GENRES[(i - 1) % len(GENRES)]
+        yield i, genre if i <= len(GENRES) else f'{genre} {(i - 1) // len(GENRES) + 1}', timestamp(now)
+
+
+def books(rng, count, section_count, now):
+    authors = max(count // 20, 1)
+    for i in range(1, count + 1):
+        created = now - timedelta(days=rng.uniform(0, HISTORY_DAYS * 1.5))
+        author = f'{FIRST_NAMES[i % len(FIRST_NAMES)]} {LAST_NAMES[rng.randrange(len(LAST_NAMES))]} {rng.randrange(authors)}'
+        yield (i, f'The {sentence(rng, 2).title()} {i}', author, sentence(rng, 12), skewed(rng, section_count),
+               timestamp(created), timestamp(created), timestamp(created), timestamp(created + timedelta(weeks=1)))
+
+
+def requests(rng, count, user_count, book_count, now, holders):
+    """Requests ordered by issue date; only the last ACTIVE_WINDOW_DAYS can still be pending or accepted.
+
+    Fills holders with book_id -> user_id for the accepted ones.
+    """
+    issue_dates = sorted(now - timedelta(days=rng.uniform(0, HISTORY_DAYS)) for _ in range(count))
+    active_per_user = {}
+    active_pairs = set()
+    for i, issued in enumerate(issue_dates, start=1):
+        user_id = skewed(rng, user_count - 1) + 1
+        book_id = skewed(rng, book_count)
+        returned = issued + timedelta(weeks=1)
+        status = rng.choices(('returned', 'declined', 'revoked'), (80, 12, 8))[0]
+        if (now - issued).days < ACTIVE_WINDOW_DAYS and active_per_user.get(user_id, 0) < MAX_ACTIVE_PER_USER \
+                and (user_id, book_id) not in active_pairs:
+            status = 'accepted' if book_id not in holders and rng.random() < 0.6 else 'pending'
+            active_per_user[user_id] = active_per_user.get(user_id, 0) + 1
+            active_pairs.add((user_id, book_id))
+            if status == 'accepted':
+                holders[book_id] = user_id
+        yield i, user_id, book_id, timestamp(issued), timestamp(returned), status
+
+
+def feedback(rng, count, user_count, book_count, now):
+    for i in range(1, count + 1):
+        yield i, skewed(rng, user_count - 1) + 1, skewed(rng, book_count), sentence(rng, rng.randint(4, 20)), timestamp(now)
+
+
+def generate(path, scale, seed=1, anchor=None):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    now = anchor or datetime.combine(datetime.now().date(), datetime.min.time())
+    holders = {}
+    started = time.perf_counter()
+
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    with connection:
+        insert(connection, 'user', ('id', 'username', 'password', 'email', 'role', 'updated_at'),
+               users(rng, scale['users'], now))
+        insert(connection, 'section', ('id', 'name', 'updated_at'), sections(scale['sections'], now))
+        insert(connection, 'book', ('id', 'name', 'author', 'content', 'section_id', 'created_at', 'updated_at',
+                                    'issue_date', 'return_date'),
+               books(rng, scale['books'], scale['sections'], now))
+        insert(connection, 'request', ('id', 'user_id', 'book_id', 'issue_date', 'return_date', 'status'),
+               requests(rng, scale['requests'], scale['users'], scale['books'], now, holders))
+        connection.executemany('UPDATE book SET user_id = ? WHERE id = ?',
+                               [(user_id, book_id) for book_id, user_id in holders.items()])
+        insert(connection, 'feedback', ('id', 'user_id', 'book_id', 'content', 'updated_at'),
+               feedback(rng, scale['feedback'], scale['users'], scale['books'], now))
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.close()
+    loaded = time.perf_counter()
+
+    engine = create_engine(f'sqlite:///{path}')
+    migrate(engine)
+    with engine.connect() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    engine.dispose()
+    print(f'Generated {path} in {loaded - started:.1f}s, migrated in {time.perf_counter() - loaded:.1f}s: '
+          + ', '.join(f'{count} {name}' for name, count in scale.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--anchor', type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help='the "today" that generated dates are relative to (default: today)')
+    for name in SCALES['small']:
+        parser.add_argument(f'--{name}', type=int, help=f'override the number of {name}')
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    scale.update({name: getattr(args, name) for name in scale if getattr(args, name) is not None})
+    generate(os.path.abspath(args.path), scale, args.seed, args.anchor)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Idle connection cost and fan-out latency of the request event stream.
+
+Run from the backend directory:
+
+    python -m benchmarks.event_stream --connections 5000 --events 50
+
+Builds the API against a throwaway database, starts event_stream in a thread
+of this process with the local broker, and opens --connections idle SSE
+clients (a few percent admins, the rest readers). Reports the memory and
+threads the open connections cost, then accepts requests through the API and
+times how long each change takes to reach every subscribed client. Last, it
+compares the bytes a reader receives per change with the refetch of
+/api/request/user/<id> the views used to make.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import warnings
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else min(hard, needed), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def client(port, token, received, connected):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET /api/events?token={token} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode())
+    await writer.drain()
+    status = await reader.readline()
+    assert b' 200 ' in status, status
+    connected.append(writer)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if line.startswith(b'data: {"change"'):
+            event = json.loads(line[6:])
+            received.setdefault(event['id'], []).append(time.perf_counter())
+
+
+async def run(args, port, tokens, readers, accept):
+    received, connected, tasks = {}, [], []
+    rss_before, threads_before = rss_mb(), threading.active_count()
+    admins = max(1, args.connections * args.admin_percent // 100)
+    audience = {}
+    for i in range(args.connections):
+        if i < admins:
+            token = tokens['admin']
+        else:
+            reader = readers[i % len(readers)]
+            audience[reader] = audience.get(reader, 0) + 1
+            token = tokens[reader]
+        tasks.append(asyncio.create_task(client(port, token, received, connected)))
+        if i % 500 == 499:
+            await asyncio.sleep(0)
+    started = time.perf_counter()
+    while len(connected) < args.connections:
+        await asyncio.sleep(0.05)
+        failed = [task for task in tasks if task.done() and task.exception()]
+        if failed:
+            raise failed[0].exception()
+    opened = time.perf_counter() - started
+    # Let the server finish registering the subscribers before measuring.
+    await asyncio.sleep(0.5)
+    grown = rss_mb() - rss_before
+    print(f"connections: {args.connections} ({admins} admin) opened in {opened:.2f}s")
+    print(f"memory: +{grown:.1f} MB for both ends, {grown * 1024 / args.connections:.1f} KB per connection")
+    print(f"threads: {threads_before} before, {threading.active_count()} with every connection open")
+
+    loop = asyncio.get_running_loop()
+    latencies, fanout = [], []
+    for n in range(args.events):
+        reader = readers[n % len(readers)]
+        expected = admins + audience.get(reader, 0)
+        sent = time.perf_counter()
+        request_id = await loop.run_in_executor(None, accept, reader)
+        while len(received.get(request_id, ())) < expected:
+            await asyncio.sleep(0.001)
+        times = received[request_id]
+        latencies.extend(t - sent for t in times)
+        fanout.append(max(times) - sent)
+    latencies.sort()
+    print(f"fan-out of {args.events} changes to {admins} admins plus the reader's connections, including the API call:")
+    print(f"    per client p50 {statistics.median(latencies) * 1000:.1f}ms  p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms"
+          f"  last client p95 {sorted(fanout)[int(len(fanout) * 0.95)] * 1000:.1f}ms")
+
+    for writer in connected:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=200)
+    parser.add_argument('--admin-percent', type=int, default=2)
+    parser.add_argument('--events', type=int, default=50)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    # Each connection is two descriptors here: the client's and the server's.
+    limit = raise_file_limit(2 * args.connections + 256)
+    if limit < 2 * args.connections + 256:
+        parser.error(f'the open file limit is {limit}; lower --connections or raise ulimit -n')
+
+    from app import create_app
+    from model import db, init_db, User, Request
+    from flask_jwt_extended import create_access_token
+    import event_stream
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app({
+            'DATABASE_FILE': os.path.join(directory, 'events.db'),
+            'CACHE_TYPE': 'SimpleCache',
+            'METRICS_ENABLED': False,
+            'EVENTS_BROKER': 'local',
+        })
+        init_db(app)
+        with app.app_context():
+            users = [User(username=f'reader{i}', email=f'reader{i}@librar.com', password='x') for i in range(args.readers)]
+            db.session.add_all(users)
+            db.session.commit()
+            readers = [user.id for user in users]
+            tokens = {reader: create_access_token(identity='user', additional_claims={'user_id': reader}) for reader in readers}
+            tokens['admin'] = create_access_token(identity='admin')
+            db.session.add_all(Request(user_id=readers[n % len(readers)], book_id=1 + n // len(readers), status='pending')
+                               for n in range(args.events))
+            db.session.commit()
+            pending = {}
+            for request in Request.query.filter_by(status='pending').order_by(Request.id):
+                pending.setdefault(request.user_id, []).append(request.id)
+
+        port, _ = event_stream.start_in_thread(app.config)
+        client_app = app.test_client()
+        admin = {'Authorization': 'Bearer ' + tokens['admin']}
+
+        def accept(reader):
+            request_id = pending[reader].pop(0)
+            response = client_app.put(f'/api/request/{request_id}', json={'status': 'accepted'}, headers=admin)
+            assert response.status_code == 200, response.status_code
+            return request_id
+
+        asyncio.run(run(args, port, tokens, readers, accept))
+
+        reader = readers[0]
+        refetch = client_app.get(f'/api/request/user/{reader}', headers={'Authorization': 'Bearer ' + tokens[reader]})
+        event = event_stream.frame(event_stream.Hub(), 1, {'change': 'updated', 'id': 1, 'user_id': reader, 'book_id': 1, 'status': 'accepted'})
+        print(f"per change a reader receives {len(event)} bytes; refetching their {len(refetch.json)} requests was "
+              f"{len(refetch.data)} bytes of JSON plus a database query")
+
+
+if __name__ == '__main__':
+    main()
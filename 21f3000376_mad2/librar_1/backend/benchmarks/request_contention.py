@@ -0,0 +1,113 @@
+"""Concurrent request placement: fires parallel requests at place_request and checks the invariants.
+
+Run from the backend directory:
+
+    python -m benchmarks.request_contention --threads 16 --attempts 2000
+
+Exits non-zero if any user ends up with more than MAX_ACTIVE_REQUESTS active
+requests or with two active requests for the same book.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+from database import engine_options, apply_sqlite_pragmas
+from loans import ACTIVE_STATUSES, MAX_ACTIVE_REQUESTS, LoanError, place_request
+from migrations import migrate
+from model import db, User, Section, Book, Request
+
+
+def build_database(engine, users, books):
+    db.metadata.create_all(engine)
+    migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'username': f'user{i}', 'email': f'user{i}@librar.com', 'password': 'x'} for i in range(users)
+        ])
+        connection.execute(Section.__table__.insert(), [{'name': 'Fiction'}])
+        connection.execute(Book.__table__.insert(), [{'name': f'Book {i}', 'section_id': 1} for i in range(books)])
+
+
+def worker(Session, users, books, attempts, latencies, outcomes, lock):
+    session = Session()
+    rng = random.Random()
+    local_latencies = []
+    local_outcomes = {'placed': 0, 'rejected': 0}
+    for _ in range(attempts):
+        started = time.perf_counter()
+        try:
+            place_request(session, rng.randint(1, users), rng.randint(1, books))
+            local_outcomes['placed'] += 1
+        except LoanError:
+            local_outcomes['rejected'] += 1
+        local_latencies.append(time.perf_counter() - started)
+    session.close()
+    with lock:
+        latencies.extend(local_latencies)
+        for key, value in local_outcomes.items():
+            outcomes[key] += value
+
+
+def check_invariants(engine):
+    with engine.connect() as connection:
+        over_limit = connection.execute(
+            select(Request.user_id, func.count()).where(Request.status.in_(ACTIVE_STATUSES))
+            .group_by(Request.user_id).having(func.count() > MAX_ACTIVE_REQUESTS)
+        ).all()
+        duplicates = connection.execute(
+            select(Request.user_id, Request.book_id, func.count()).where(Request.status.in_(ACTIVE_STATUSES))
+            .group_by(Request.user_id, Request.book_id).having(func.count() > 1)
+        ).all()
+    return over_limit, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--attempts', type=int, default=2000, help='total placement attempts')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--books', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'contention.db')
+        engine = create_engine(f'sqlite:///{path}', **engine_options())
+        apply_sqlite_pragmas(engine)
+        build_database(engine, args.users, args.books)
+
+        Session = sessionmaker(bind=engine)
+        latencies, outcomes, lock = [], {'placed': 0, 'rejected': 0}, threading.Lock()
+        per_thread = args.attempts // args.threads
+        threads = [
+            threading.Thread(target=worker, args=(Session, args.users, args.books, per_thread, latencies, outcomes, lock))
+            for _ in range(args.threads)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        print(f"{len(latencies)} attempts in {elapsed:.2f}s ({len(latencies) / elapsed:.0f}/s): "
+              f"{outcomes['placed']} placed, {outcomes['rejected']} rejected")
+        print(f"latency p50 {statistics.median(latencies) * 1000:.2f} ms, "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+
+        over_limit, duplicates = check_invariants(engine)
+        engine.dispose()
+    if over_limit or duplicates:
+        print(f'INVARIANT VIOLATED: over limit {over_limit}, duplicates {duplicates}')
+        sys.exit(1)
+    print('Invariants hold: no user over the limit, no duplicate active requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""FTS5 search versus LIKE scans over a synthetic catalogue.
+
+Run from the backend directory:
+
+    python -m benchmarks.search_fts --books 100000 --queries 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from model import db, Section, Book, User, Feedback
+from search import create_search_index, search_books
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ren', 'sa', 'tor', 'vel', 'quin', 'da', 'gor', 'phi', 'nex', 'ul', 'bra', 'zen', 'cor')
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+LIKE_SQL = """
+    SELECT book.id, book.name, book.author FROM book
+    WHERE book.name LIKE :pattern OR book.author LIKE :pattern
+       OR EXISTS (SELECT 1 FROM feedback WHERE feedback.book_id = book.id AND feedback.content LIKE :pattern)
+    ORDER BY book.name
+    LIMIT 20
+"""
+
+
+def build_database(engine, books, words, sections=200):
+    db.metadata.create_all(engine)
+    rng = random.Random(42)
+    now = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [{'username': 'reader', 'email': 'reader@librar.com', 'password': 'x'}])
+        connection.execute(Section.__table__.insert(), [{'name': f'Section {i}'} for i in range(sections)])
+        connection.execute(Book.__table__.insert(), [
+            {'name': ' '.join(rng.sample(words, 3)).title() + f' {i}', 'author': f'{rng.choice(words).title()} Author {i % 5000}',
+             'section_id': i % sections + 1, 'created_at': now, 'issue_date': now, 'return_date': now}
+            for i in range(books)
+        ])
+        connection.execute(Feedback.__table__.insert(), [
+            {'user_id': 1, 'book_id': rng.randint(1, books), 'content': ' '.join(rng.sample(words, 5))}
+            for _ in range(books // 5)
+        ])
+        create_search_index(connection)
+
+
+def timed(label, queries, run):
+    started = time.perf_counter()
+    for query in queries:
+        run(query)
+    elapsed = time.perf_counter() - started
+    print(f'{label:>6}: {elapsed / len(queries) * 1000:8.2f} ms/query over {len(queries)} queries')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'search.db')}")
+        started = time.perf_counter()
+        words = vocabulary(20000, random.Random(1))
+        build_database(engine, args.books, words)
+        print(f'Built {args.books} books with search index in {time.perf_counter() - started:.1f}s')
+
+        rng = random.Random(7)
+        queries = [rng.choice(words)[:rng.randint(4, 7)] for _ in range(args.queries)]
+        with engine.connect() as connection:
+            fts = timed('fts5', queries, lambda q: search_books(connection, q, limit=20))
+            like = timed('like', queries, lambda q: connection.execute(text(LIKE_SQL), {'pattern': f'%{q}%'}).all())
+        print(f'FTS5 is {like / fts:.1f}x faster than LIKE')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
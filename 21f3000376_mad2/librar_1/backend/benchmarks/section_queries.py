@@ -0,0 +1,93 @@
+"""Statement count of GET /api/section as the number of sections grows.
+
+Run from the backend directory:
+
+    python -m benchmarks.section_queries --sections 20 --books-per-section 3
+
+Seeds N sections, counts the statements each /api/section mode issues, grows
+the library to 10*N sections and counts again. The counts must not change:
+a per-section query slipping back in shows up as a failure and a non-zero
+exit status. The cache is disabled so every call reaches the database.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import warnings
+from sqlalchemy import event
+
+MODES = {
+    'sections with books': '/api/section',
+    'section summary': '/api/section?include_books=false',
+    'one section': '/api/section/1',
+}
+
+
+def seed(db, Section, Book, first, last, books_per_section):
+    db.session.execute(Section.__table__.insert(), [{'name': f'Section {i}'} for i in range(first, last + 1)])
+    db.session.execute(Book.__table__.insert(), [
+        {'name': f'Book {i}-{j}', 'author': 'Bench', 'content': 'content', 'section_id': i}
+        for i in range(first, last + 1) for j in range(books_per_section)
+    ])
+    db.session.commit()
+
+
+def count_statements(client, counter):
+    counts = {}
+    for mode, path in MODES.items():
+        counter[0] = 0
+        response = client.get(path)
+        assert response.status_code == 200, (path, response.status_code)
+        counts[mode] = counter[0]
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--books-per-section', type=int, default=3)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    with tempfile.TemporaryDirectory() as directory:
+        with contextlib.redirect_stdout(io.StringIO()):
+            from app import create_app
+            from model import db, Section, Book
+            app = create_app({
+                'DATABASE_FILE': os.path.join(directory, 'librar.db'),
+                'CACHE_TYPE': 'NullCache',
+                'EVENTS_BROKER': 'none',
+            })
+        counter = [0]
+        with app.app_context():
+            db.create_all()
+            # Reads go through the read-only bind, so count on every engine.
+            for engine in db.engines.values():
+                @event.listens_for(engine, 'before_cursor_execute')
+                def count(*args):
+                    counter[0] += 1
+
+            client = app.test_client()
+            seed(db, Section, Book, 1, args.sections, args.books_per_section)
+            small = count_statements(client, counter)
+            seed(db, Section, Book, args.sections + 1, args.sections * 10, args.books_per_section)
+            large = count_statements(client, counter)
+            for engine in db.engines.values():
+                engine.dispose()
+
+    print(f"{'mode':<22} {args.sections:>8} {args.sections * 10:>8}  sections")
+    failed = []
+    for mode in MODES:
+        print(f"{mode:<22} {small[mode]:>8} {large[mode]:>8}")
+        if small[mode] != large[mode]:
+            failed.append(mode)
+    if failed:
+        print(f"Statement count grows with the number of sections: {', '.join(failed)}")
+        sys.exit(1)
+    print('Statement counts do not depend on the number of sections')
+
+
+if __name__ == '__main__':
+    main()
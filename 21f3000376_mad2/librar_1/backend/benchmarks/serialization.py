@@ -0,0 +1,133 @@
+"""Serialization cost of a large /api/request response: ORM objects versus column-only schemas.
+
+Run from the backend directory:
+
+    python -m benchmarks.serialization --rows 10000 --repeat 5
+
+Compares the old per-row path (hydrated Request objects, lazy-loaded book,
+section and user, strftime per date, stdlib json) with REQUEST_SCHEMA
+(column-only query, dates formatted by SQLite) encoded with stdlib json and
+with orjson when it is installed.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database import engine_options, apply_sqlite_pragmas
+from model import db, User, Section, Book, Request
+import serializers
+
+
+def build_database(engine, rows):
+    db.metadata.create_all(engine)
+    users = max(rows // 20, 1)
+    books = max(rows // 10, 1)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'username': f'user{i}', 'email': f'user{i}@librar.com', 'password': 'x'} for i in range(users)
+        ])
+        connection.execute(Section.__table__.insert(), [{'name': f'Section {i}'} for i in range(10)])
+        connection.execute(Book.__table__.insert(), [{
+            'name': f'Book {i}', 'author': f'Author {i % 300}', 'content': 'Lorem ipsum dolor sit amet. ' * 4,
+            'section_id': i % 10 + 1, 'issue_date': start, 'return_date': start + timedelta(weeks=1)
+        } for i in range(books)])
+        connection.execute(Request.__table__.insert(), [{
+            'user_id': i % users + 1, 'book_id': i % books + 1, 'status': 'returned',
+            'issue_date': start + timedelta(hours=i), 'return_date': start + timedelta(hours=i, weeks=1)
+        } for i in range(rows)])
+
+
+def legacy(session):
+    started = time.perf_counter()
+    requests = session.query(Request).order_by(Request.id).all()
+    data = [{
+        "id": request.id,
+        "user_id": request.user_id,
+        "book_id": request.book_id,
+        "book_name": request.book.name,
+        "book_author": request.book.author,
+        "issue_date": request.issue_date.strftime('%Y-%m-%d'),
+        "return_date": request.return_date.strftime('%Y-%m-%d'),
+        "status": request.status,
+        "book": {
+            "content": request.book.content if request.book else "No content available",
+            "section_id": request.book.section_id,
+            "section_name": request.book.section.name
+        },
+        "user": {
+            "username": request.user.username,
+            "email": request.user.email
+        }
+    } for request in requests]
+    built = time.perf_counter()
+    body = json.dumps(data).encode()
+    return built - started, time.perf_counter() - built, body
+
+
+def schema(session, dumps):
+    started = time.perf_counter()
+    query, make = serializers.REQUEST_SCHEMA.rows(session)
+    query = query.select_from(Request).join(Book, Book.id == Request.book_id) \
+        .join(Section, Section.id == Book.section_id).join(User, User.id == Request.user_id)
+    data = [make(row) for row in query.order_by(Request.id)]
+    built = time.perf_counter()
+    body = dumps(data)
+    return built - started, time.perf_counter() - built, body
+
+
+def stdlib_dumps(data):
+    return json.dumps(data).encode()
+
+
+def measure(Session, run, repeat):
+    query_times, encode_times = [], []
+    for _ in range(repeat):
+        session = Session()
+        query_time, encode_time, body = run(session)
+        session.close()
+        query_times.append(query_time)
+        encode_times.append(encode_time)
+    return statistics.median(query_times), statistics.median(encode_times), body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'serialization.db')}", **engine_options())
+        apply_sqlite_pragmas(engine)
+        build_database(engine, args.rows)
+        Session = sessionmaker(bind=engine)
+
+        runs = [
+            ('orm objects + json', legacy),
+            ('schema + json', lambda session: schema(session, stdlib_dumps)),
+        ]
+        if serializers.orjson is not None:
+            runs.append(('schema + orjson', lambda session: schema(session, serializers.dumps)))
+        else:
+            print('orjson is not installed; skipping the orjson run')
+
+        print(f"{args.rows} rows, median of {args.repeat} runs")
+        print(f"{'path':<20} {'query+build':>12} {'encode':>10} {'total':>10} {'us/row':>8} {'bytes':>10}")
+        baseline = None
+        for name, run in runs:
+            query_time, encode_time, body = measure(Session, run, args.repeat)
+            total = query_time + encode_time
+            baseline = baseline or total
+            print(f"{name:<20} {query_time * 1000:>10.1f}ms {encode_time * 1000:>8.1f}ms "
+                  f"{total * 1000:>8.1f}ms {total / args.rows * 1e6:>8.1f} {len(body):>10}  x{baseline / total:.1f}")
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
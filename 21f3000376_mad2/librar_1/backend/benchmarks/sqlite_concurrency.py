@@ -0,0 +1,108 @@
+"""Mixed read/write throughput against SQLite, default engine settings vs the tuned profile.
+
+Run from the backend directory:
+
+    python -m benchmarks.sqlite_concurrency --threads 8 --seconds 10 --write-ratio 0.2
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.exc import OperationalError
+from database import SQLITE_PROFILE, engine_options, apply_sqlite_pragmas
+from model import db, Section, Book
+
+SECTIONS = 50
+BOOKS = 20000
+
+
+def build_database(path):
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Section.__table__.insert(), [{'name': f'Section {i}'} for i in range(SECTIONS)])
+        now = datetime.now()
+        connection.execute(Book.__table__.insert(), [
+            {'name': f'Book {i}', 'author': f'Author {i % 500}', 'section_id': i % SECTIONS + 1,
+             'created_at': now, 'issue_date': now, 'return_date': now}
+            for i in range(BOOKS)
+        ])
+    engine.dispose()
+
+
+def default_engines(path):
+    engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+    with engine.begin() as connection:
+        connection.execute(text('PRAGMA journal_mode = DELETE'))
+    return engine, engine
+
+
+def tuned_engines(path):
+    writer = create_engine(f'sqlite:///{path}', **engine_options())
+    apply_sqlite_pragmas(writer)
+    reader = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true', **engine_options())
+    apply_sqlite_pragmas(reader, readonly=True)
+    with writer.connect():
+        pass
+    return writer, reader
+
+
+def worker(writer, reader, write_ratio, deadline, results):
+    ops = errors = 0
+    read_query = select(Section.name, func.count(Book.id)).outerjoin(Book).group_by(Section.id)
+    while time.monotonic() < deadline:
+        try:
+            if random.random() < write_ratio:
+                with writer.begin() as connection:
+                    connection.execute(
+                        Book.__table__.update().where(Book.id == random.randint(1, BOOKS))
+                        .values(user_id=random.choice([None, 1]))
+                    )
+            else:
+                with reader.connect() as connection:
+                    connection.execute(read_query).all()
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.append((ops, errors))
+
+
+def run(name, engines, threads, seconds, write_ratio):
+    writer, reader = engines
+    results = []
+    deadline = time.monotonic() + seconds
+    pool = [threading.Thread(target=worker, args=(writer, reader, write_ratio, deadline, results)) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    writer.dispose()
+    reader.dispose()
+    ops = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    print(f'{name:>8}: {ops / seconds:10.1f} ops/s  {errors:6d} lock errors  ({threads} threads, {write_ratio:.0%} writes)')
+    return ops / seconds, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f"Tuned profile: journal_mode={SQLITE_PROFILE['journal_mode']} synchronous={SQLITE_PROFILE['synchronous']} "
+          f"busy_timeout={SQLITE_PROFILE['busy_timeout_ms']}ms pool_size={SQLITE_PROFILE['pool_size']}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, make_engines in (('default', default_engines), ('tuned', tuned_engines)):
+            path = os.path.join(directory, f'{name}.db')
+            build_database(path)
+            run(name, make_engines(path), args.threads, args.seconds, args.write_ratio)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Import time and cold start of the API and Celery worker processes.
+
+Run from the backend directory:
+
+    python -m benchmarks.startup --repeat 7
+
+Every measurement runs in a fresh interpreter against a throwaway database, so
+module caches from earlier runs do not hide import cost. "import" is the time
+to import a module; "cold start" adds building the app and serving the first
+request (API) or running the first task (worker). "process" is the wall time
+of the whole child, interpreter startup included. --top lists the slowest
+top-level imports of each target from python -X importtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRELUDE = '''
+import contextlib, io, json, sys, time, warnings
+warnings.simplefilter('ignore')
+started = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+'''
+
+TARGETS = {
+    'import model': 'import model',
+    'import tasks (worker)': 'import tasks',
+    'import app (API)': 'import app',
+    'API cold start': (
+        'from app import create_app\n'
+        'response = create_app().test_client().get("/api/stats/library")\n'
+        'assert response.status_code == 200, response.status_code'
+    ),
+    'worker cold start': (
+        'import tasks\n'
+        'from celery_config import celery\n'
+        'celery.conf.update(task_always_eager=True, task_eager_propagates=True)\n'
+        'tasks.reconcile_stats_counters.delay().get()'
+    ),
+}
+
+
+def child_source(code):
+    body = '\n'.join('    ' + line for line in code.split('\n'))
+    return PRELUDE + body + '\nprint(json.dumps({"seconds": time.perf_counter() - started, "modules": len(sys.modules)}))\n'
+
+
+def run_child(code, env):
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', child_source(code)], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+
+def slowest_imports(code, env, top):
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', child_source(code)], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, check=True
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Direct children of the measured import are indented by exactly three spaces.
+        if name.startswith('   ') and not name.startswith('    '):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--top', type=int, default=0, help='show the N slowest imports of each target')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_FILE=os.path.join(directory, 'startup.db'), CACHE_TYPE='SimpleCache',
+                   EVENTS_BROKER='none')
+        subprocess.run([sys.executable, '-c', 'import model; model.init_db()'], cwd=BACKEND_DIR, env=env,
+                       capture_output=True, check=True)
+
+        print(f"median of {args.repeat} fresh interpreters")
+        print(f"{'target':<24} {'in-process':>11} {'process':>10} {'modules':>8}")
+        for name, code in TARGETS.items():
+            runs = [run_child(code, env) for _ in range(args.repeat)]
+            print(f"{name:<24} {statistics.median(run['seconds'] for run in runs) * 1000:>9.0f}ms "
+                  f"{statistics.median(run['process'] for run in runs) * 1000:>8.0f}ms {runs[0]['modules']:>8}")
+            for milliseconds, module in slowest_imports(code, env, args.top) if args.top else ():
+                print(f"    {module:<30} {milliseconds:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+"""Benchmark suite: every API route and Celery task against a generated library database.
+
+Run from the backend directory:
+
+    python -m benchmarks.suite --scale small
+    python -m benchmarks.suite --scale small --save-baseline
+    python -m benchmarks.suite --database /tmp/librar-large.db --iterations 50 --fail-on-regression
+
+The database is generated with benchmarks.datagen (and reused between runs),
+then copied so the write scenarios never touch the original. Routes are
+driven through the Flask test client and tasks are called directly, with
+Celery in eager mode, an in-process SMTP sink and the cache selected by
+--cache, so nothing outside the process is needed.
+
+Each scenario reports latency percentiles and the median number of SQL
+statements per call. Results are compared with the stored baseline in
+benchmarks/baselines/<name>.json: a scenario regresses when it issues more
+statements than the baseline, or its p95 grows past --tolerance.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from datetime import datetime, timedelta
+from sqlalchemy import event
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+CACHE_TYPES = {'none': 'NullCache', 'simple': 'SimpleCache', 'fakeredis': 'caching.fakeredis_cache'}
+SEARCH_TERMS = ['river', 'silver empire', 'lan', 'winter garden', 'archive', 'compass ember']
+
+
+class SmtpSink(socketserver.StreamRequestHandler):
+    """Accepts and discards mail, so the outbox tasks exercise a real SMTP session offline."""
+
+    def handle(self):
+        # Replies are tiny; without TCP_NODELAY delayed ACKs would dominate the measured send time.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wfile.write(b'220 benchmark sink\r\n')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    self.wfile.write(b'250 OK\r\n')
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+def start_smtp_sink():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpSink)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Context:
+    """Ids and credentials shared by the scenarios; built once against the working database."""
+
+    def __init__(self, app, db, seed):
+        from flask_jwt_extended import create_access_token
+        self.app = app
+        self.db = db
+        self.seed = seed
+        self.client = app.test_client()
+        self.sequence = 0
+        with app.app_context():
+            self.admin = {'Authorization': 'Bearer ' + create_access_token(identity='admin')}
+            for table in ('user', 'section', 'book', 'request', 'feedback'):
+                setattr(self, f'max_{table}', self.scalar(f'SELECT MAX(id) FROM "{table}"'))
+
+    def scalar(self, sql, **params):
+        with self.app.app_context():
+            return self.db.session.execute(self.db.text(sql), params).scalar()
+
+    def execute(self, sql, **params):
+        with self.app.app_context():
+            self.db.session.execute(self.db.text(sql), params)
+            self.db.session.commit()
+
+    def unique(self, prefix):
+        self.sequence += 1
+        return f'{prefix}-{os.getpid()}-{self.sequence}'
+
+    def add(self, *rows):
+        with self.app.app_context():
+            self.db.session.add_all(rows)
+            self.db.session.commit()
+            return [row.id for row in rows]
+
+    def pick(self, rng, sql, **params):
+        """First matching row at or after a random id, so picks are repeatable for a given seed."""
+        start = rng.randint(1, self.max_request)
+        with self.app.app_context():
+            for first_id in (start, 0):
+                row = self.db.session.execute(
+                    self.db.text(sql + ' AND id >= :start ORDER BY id LIMIT 1'), dict(params, start=first_id)
+                ).first()
+                if row is not None:
+                    return row
+
+    def upload_content(self, book_id):
+        """Upload CONTENT_BODY to a book in one chunk; returns the upload path."""
+        upload_id = self.client.post(f'/api/book/{book_id}/content/uploads', headers=self.admin, json={
+            'filename': 'bench.pdf', 'size': len(CONTENT_BODY)}).get_json()['upload_id']
+        return f'/api/book/{book_id}/content/uploads/{upload_id}'
+
+    def content_reader(self, rng):
+        """A book with uploaded content and the headers of a reader holding an accepted request for it."""
+        if not hasattr(self, 'reader_book'):
+            from flask_jwt_extended import create_access_token
+            book_id, user_id = self.pick(rng, "SELECT book_id, user_id FROM request WHERE status = 'accepted'")
+            path = self.upload_content(book_id)
+            self.client.put(path, data=CONTENT_BODY, headers=dict(self.admin, **content_range(0, len(CONTENT_BODY))))
+            with self.app.app_context():
+                token = create_access_token(identity='user', additional_claims={'user_id': user_id})
+            self.reader_book = book_id, {'Authorization': 'Bearer ' + token}
+        return self.reader_book
+
+    def archived_user(self, rng):
+        """A reader with archived requests; archives a few batches the first time."""
+        if not hasattr(self, 'history_user'):
+            from archive import archive_requests
+            with self.app.app_context():
+                archive_requests(self.db.session, self.app.config['ARCHIVE_AFTER_DAYS'], max_batches=4)
+                self.history_user = self.db.session.execute(self.db.text(
+                    'SELECT user_id FROM request_history GROUP BY user_id ORDER BY count(*) DESC LIMIT 1')).scalar()
+        return self.history_user
+
+    def export_job(self, rng):
+        if not hasattr(self, 'export_job_id'):
+            response = self.client.post('/exportcsv/1', json={'format': 'csv'}, headers=self.admin)
+            self.export_job_id = response.get_json()['job_id']
+        return self.export_job_id
+
+
+CONTENT_BODY = b'%PDF-1.7\n' + bytes(256 * 1024 - 9)
+
+
+def content_range(start, length):
+    return {'Content-Range': f'bytes {start}-{start + length - 1}/{len(CONTENT_BODY)}'}
+
+
+def route_scenarios():
+    """name -> function(ctx, rng) returning (method, path, request kwargs); anything before the return is untimed."""
+    return {
+        'GET /api/userinfo': lambda ctx, rng: ('GET', '/api/userinfo', {}),
+        'GET /api/section': lambda ctx, rng: ('GET', '/api/section', {}),
+        'GET /api/section summary': lambda ctx, rng: ('GET', '/api/section?include_books=false', {}),
+        'GET /api/section/<id>': lambda ctx, rng: ('GET', f'/api/section/{rng.randint(1, ctx.max_section)}', {}),
+        'POST /api/section': lambda ctx, rng: ('POST', '/api/section', {'json': {'name': ctx.unique('Section')}}),
+        'PUT /api/section': lambda ctx, rng: ('PUT', '/api/section', {
+            'json': {'id': rng.randint(1, ctx.max_section), 'name': ctx.unique('Renamed')}}),
+        'DELETE /api/section': delete_section,
+        'GET /api/book': lambda ctx, rng: ('GET', '/api/book', {}),
+        'GET /api/book page': lambda ctx, rng: ('GET', '/api/book?limit=50', {}),
+        'GET /api/book section page': lambda ctx, rng: (
+            'GET', f'/api/book?section_id={rng.randint(1, ctx.max_section)}&limit=50', {}),
+        'GET /api/book/<id>': lambda ctx, rng: ('GET', f'/api/book/{rng.randint(1, ctx.max_book)}', {}),
+        'POST /api/book': lambda ctx, rng: ('POST', '/api/book', {'json': {
+            'name': ctx.unique('Book'), 'author': 'Bench', 'section_id': rng.randint(1, ctx.max_section), 'user_id': 1}}),
+        'PUT /api/book': lambda ctx, rng: ('PUT', '/api/book', {
+            'json': {'id': rng.randint(1, ctx.max_book), 'content': ctx.unique('content')}}),
+        'DELETE /api/book': delete_book,
+        'POST /api/book/bulk': bulk_books,
+        'POST /api/book/<id>/content/uploads': lambda ctx, rng: (
+            'POST', f'/api/book/{rng.randint(1, ctx.max_book)}/content/uploads',
+            {'json': {'filename': 'bench.pdf', 'size': len(CONTENT_BODY)}, 'headers': ctx.admin}),
+        'GET /api/book/<id>/content/uploads/<id>': lambda ctx, rng: (
+            'GET', ctx.upload_content(rng.randint(1, ctx.max_book)), {'headers': ctx.admin}),
+        'PUT /api/book/<id>/content/uploads/<id>': lambda ctx, rng: (
+            'PUT', ctx.upload_content(rng.randint(1, ctx.max_book)),
+            {'data': CONTENT_BODY, 'headers': dict(ctx.admin, **content_range(0, len(CONTENT_BODY)))}),
+        'GET /api/book/<id>/content range': read_content,
+        'DELETE /api/book/<id>/content': delete_content,
+        'GET /api/request admin page': lambda ctx, rng: ('GET', '/api/request/user/1?limit=50', {}),
+        'GET /api/request/user/<id>': lambda ctx, rng: ('GET', f'/api/request/user/{rng.randint(2, ctx.max_user)}', {}),
+        'POST /api/request': lambda ctx, rng: ('POST', '/api/request', {
+            'json': {'user_id': rng.randint(2, ctx.max_user), 'book_id': rng.randint(1, ctx.max_book)}}),
+        'PUT /api/request/<id>': lambda ctx, rng: (
+            'PUT', f"/api/request/{ctx.pick(rng, 'SELECT id FROM request WHERE status = :s', s='pending')[0]}",
+            {'json': {'status': 'accepted'}}),
+        'DELETE /api/request/<id>': lambda ctx, rng: (
+            'DELETE', f"/api/request/{ctx.pick(rng, 'SELECT id FROM request WHERE status = :s', s='returned')[0]}", {}),
+        'POST /api/request/batch': batch_transition,
+        'PUT /api/request/return/<book_id>': return_book,
+        'GET /api/request/history': lambda ctx, rng: (
+            'GET', f'/api/request/history?user_id={ctx.archived_user(rng)}&limit=50', {'headers': ctx.admin}),
+        'GET /api/feedback page': lambda ctx, rng: ('GET', '/api/feedback?limit=50', {}),
+        'GET /api/feedback/<book_id>': lambda ctx, rng: ('GET', f'/api/feedback/{rng.randint(1, 50)}', {}),
+        'POST /api/feedback': lambda ctx, rng: ('POST', '/api/feedback', {'json': {
+            'user_id': rng.randint(2, ctx.max_user), 'book_id': rng.randint(1, ctx.max_book), 'content': 'benchmark'}}),
+        'GET /api/feedback/batch': lambda ctx, rng: (
+            'GET', f'/api/feedback/batch?section_id={rng.randint(1, ctx.max_section)}', {}),
+        'GET /api/search': lambda ctx, rng: ('GET', f'/api/search?q={rng.choice(SEARCH_TERMS)}', {}),
+        'GET /api/stats/library': lambda ctx, rng: ('GET', '/api/stats/library', {}),
+        'GET /api/stats/books-in-library': lambda ctx, rng: ('GET', '/api/stats/books-in-library', {}),
+        'GET /api/stats/books-issued': lambda ctx, rng: ('GET', '/api/stats/books-issued', {}),
+        'GET /api/stats/circulation': lambda ctx, rng: (
+            'GET', f'/api/stats/circulation?section_id={rng.randint(1, ctx.max_section)}', {}),
+        'GET /api/stats/circulation year by week': lambda ctx, rng: (
+            'GET', f'/api/stats/circulation?from={year_ago()}&interval=week&book_id={rng.randint(1, ctx.max_book)}', {}),
+        'GET /api/stats/trending': lambda ctx, rng: ('GET', '/api/stats/trending?limit=20', {}),
+        'GET /api/stats/trending sections year': lambda ctx, rng: (
+            'GET', f'/api/stats/trending?by=section&from={year_ago()}&metric={rng.choice(("accepted", "returned"))}', {}),
+        'GET /api/metrics': lambda ctx, rng: ('GET', '/api/metrics', {}),
+        'POST /exportcsv/<user_id>': lambda ctx, rng: ('POST', '/exportcsv/1', {'json': {'format': 'csv'}, 'headers': ctx.admin}),
+        'GET /api/export/<job_id>': lambda ctx, rng: ('GET', f'/api/export/{ctx.export_job(rng)}', {'headers': ctx.admin}),
+        'GET /api/export/<job_id>/download': lambda ctx, rng: (
+            'GET', f'/api/export/{ctx.export_job(rng)}/download', {'headers': ctx.admin}),
+        'POST /api/signup': lambda ctx, rng: ('POST', '/api/signup', {'json': {
+            'username': ctx.unique('reader'), 'email': ctx.unique('reader') + '@librar.com', 'password': 'librar'}}),
+        'POST /api/login': lambda ctx, rng: ('POST', '/api/login', {'json': {'username': 'librarian', 'password': 'librar'}}),
+    }
+
+
+def year_ago():
+    return (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
+
+
+def delete_section(ctx, rng):
+    from model import Section
+    section_id, = ctx.add(Section(name=ctx.unique('Doomed')))
+    return 'DELETE', '/api/section', {'json': {'id': section_id}}
+
+
+def delete_book(ctx, rng):
+    from model import Book
+    book_id, = ctx.add(Book(name='Doomed', section_id=1))
+    return 'DELETE', '/api/book', {'json': {'id': book_id}}
+
+
+def read_content(ctx, rng):
+    book_id, headers = ctx.content_reader(rng)
+    start = rng.randrange(0, len(CONTENT_BODY) - 65536)
+    return 'GET', f'/api/book/{book_id}/content', {'headers': dict(headers, Range=f'bytes={start}-{start + 65535}')}
+
+
+def delete_content(ctx, rng):
+    book_id = rng.randint(1, ctx.max_book)
+    ctx.client.put(ctx.upload_content(book_id), data=CONTENT_BODY,
+                   headers=dict(ctx.admin, **content_range(0, len(CONTENT_BODY))))
+    return 'DELETE', f'/api/book/{book_id}/content', {'headers': ctx.admin}
+
+
+def bulk_books(ctx, rng):
+    rows = '\n'.join(f'{ctx.unique("Bulk")},Bench,Fiction,bulk content' for _ in range(1000))
+    return 'POST', '/api/book/bulk', {'data': 'name,author,section,content\n' + rows, 'headers': ctx.admin}
+
+
+def batch_transition(ctx, rng):
+    with ctx.app.app_context():
+        ids = [row[0] for row in ctx.db.session.execute(ctx.db.text(
+            "SELECT id FROM request WHERE status = 'pending' AND id >= :start ORDER BY id LIMIT 50"
+        ), {'start': rng.randint(1, ctx.max_request)})]
+    return 'POST', '/api/request/batch', {'json': {'action': 'decline', 'ids': ids}, 'headers': ctx.admin}
+
+
+def return_book(ctx, rng):
+    book_id, user_id = ctx.pick(rng, "SELECT book_id, user_id FROM request WHERE status = 'accepted'") or (1, 1)
+    return 'PUT', f'/api/request/return/{book_id}', {'json': {'user_id': user_id}}
+
+
+def task_scenarios(tasks):
+    """name -> function(ctx, rng) returning the callable to time."""
+    def monthly_report(ctx, rng):
+        ctx.execute("DELETE FROM report_run WHERE name = 'monthly_report'")
+        return tasks.generate_monthly_report
+
+    def report_chunk(ctx, rng):
+        return lambda: tasks.send_monthly_report_chunk(datetime.now().strftime('%Y-%m'), 2, min(ctx.max_user, 501))
+
+    def finish_report(ctx, rng):
+        from model import ReportRun
+        run_id, = ctx.add(ReportRun(name='benchmark', period=ctx.unique('period')))
+        return lambda: tasks.finish_monthly_report([100, 100], run_id)
+
+    def reminders(ctx, rng):
+        ctx.execute('DELETE FROM reminder_log')
+        return tasks.daily_reminders
+
+    def outbox(ctx, rng):
+        from model import EmailOutbox
+        # Report and reminder scenarios queue mail too; time a fixed batch of 200, not their backlog.
+        ctx.execute("UPDATE email_outbox SET status = 'sent' WHERE status = 'pending'")
+        ctx.add(*(EmailOutbox(to_email=f'reader{i}@librar.com', subject='Benchmark', html_content='<p>benchmark</p>')
+                  for i in range(200)))
+        return tasks.dispatch_email_outbox
+
+    def circulation_rollup(ctx, rng):
+        # Fold a fixed batch of 1000 events spread over 30 days, not whatever the route scenarios logged.
+        ctx.execute('DELETE FROM request_event')
+        ctx.execute("""INSERT INTO request_event (request_id, book_id, section_id, event, created_at)
+            SELECT r.id, r.book_id, b.section_id, 'requested', datetime('now', 'localtime', '-' || (r.id % 30) || ' days')
+            FROM request r JOIN book b ON b.id = r.book_id ORDER BY r.id LIMIT 1000""")
+        return tasks.roll_up_circulation_task
+
+    def export(ctx, rng):
+        from model import ExportJob
+        job_id, = ctx.add(ExportJob(id=str(uuid.uuid4()), user_id=1))
+        return lambda: tasks.export_sections_details(job_id)
+
+    return {
+        'tasks.generate_monthly_report': monthly_report,
+        'tasks.send_monthly_report_chunk': report_chunk,
+        'tasks.finish_monthly_report': finish_report,
+        'tasks.daily_reminders': reminders,
+        'tasks.reconcile_stats_counters': lambda ctx, rng: tasks.reconcile_stats_counters,
+        'tasks.revoke_overdue_loans_task': lambda ctx, rng: lambda: tasks.revoke_overdue_loans_task(dry_run=True),
+        'tasks.dispatch_email_outbox': outbox,
+        'tasks.export_sections_details': export,
+        'tasks.roll_up_circulation_task': circulation_rollup,
+        # One 500-row batch per run; each run moves the next oldest finished requests.
+        'tasks.archive_finished_requests': lambda ctx, rng: lambda: tasks.archive_finished_requests(max_batches=1),
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(latencies, statements, statuses):
+    return {
+        'n': len(latencies),
+        'p50': round(percentile(latencies, 0.50), 3),
+        'p95': round(percentile(latencies, 0.95), 3),
+        'p99': round(percentile(latencies, 0.99), 3),
+        'mean': round(sum(latencies) / len(latencies), 3),
+        'queries': sorted(statements)[len(statements) // 2],
+        'statuses': sorted(set(statuses)),
+    }
+
+
+def run_scenario(ctx, name, prepare, counter, iterations, warmup, is_task):
+    rng = random.Random(f'{ctx.seed}:{name}')
+    latencies, statements, statuses, endpoints = [], [], [], set()
+    for i in range(warmup + iterations):
+        with contextlib.redirect_stdout(io.StringIO()):
+            prepared = prepare(ctx, rng)
+            counter[0] = 0
+            started = time.perf_counter()
+            if is_task:
+                # As when a request queues it eagerly: the task runs in its own context of the same app.
+                with ctx.app.app_context():
+                    prepared()
+                status = 'ok'
+            else:
+                method, path, kwargs = prepared
+                response = ctx.client.open(path, method=method, **kwargs)
+                response.get_data()
+                response.close()
+                status = response.status_code
+            elapsed = (time.perf_counter() - started) * 1000
+            count = counter[0]
+        if not is_task:
+            endpoints.add(endpoint_of(ctx.app, method, path))
+        if i >= warmup:
+            latencies.append(elapsed)
+            statements.append(count)
+            statuses.append(status)
+    return summarize(latencies, statements, statuses), endpoints
+
+
+def endpoint_of(app, method, path):
+    adapter = app.url_map.bind('localhost')
+    endpoint, _ = adapter.match(path.split('?')[0], method=method)
+    return endpoint, method
+
+
+def routes(app):
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            yield rule.endpoint, method
+
+
+def compare(results, baseline, tolerance, min_ms):
+    regressions = []
+    print(f"\n{'scenario':<38} {'p95':>9} {'base':>9} {'delta':>8} {'queries':>8} {'base':>6}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print(f'{name:<38} {result["p95"]:>8.1f}ms {"new":>9}')
+            continue
+        delta = (result['p95'] - base['p95']) / base['p95'] if base['p95'] else 0.0
+        slower = delta > tolerance and result['p95'] - base['p95'] > min_ms
+        more_queries = result['queries'] > base['queries']
+        flag = ' REGRESSION' if slower or more_queries else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<38} {result['p95']:>8.1f}ms {base['p95']:>7.1f}ms {delta:>+7.0%} "
+              f"{result['queries']:>8} {base['queries']:>6}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', default='small', help='datagen scale to generate when --database is not given')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', help='an existing generated database (it is copied, never modified)')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--task-iterations', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--only', help='run only scenarios whose name contains this text')
+    parser.add_argument('--cache', choices=CACHE_TYPES, default='none',
+                        help='"none" measures the uncached path; "fakeredis" or "simple" include cache hits')
+    parser.add_argument('--baseline', help='baseline name under benchmarks/baselines (default: the scale)')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 growth before flagging')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore p95 growth smaller than this')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    # The short development JWT secret warns on every token; it is noise here.
+    warnings.simplefilter('ignore')
+    workdir = tempfile.mkdtemp(prefix='librar-bench-')
+    database = os.path.join(workdir, 'librar.db')
+    smtp = start_smtp_sink()
+    # tasks reads the SMTP server at import time, so set it before importing any backend module.
+    os.environ.update({'SMTP_HOST': '127.0.0.1', 'SMTP_PORT': str(smtp.server_address[1])})
+
+    from benchmarks.datagen import SCALES, generate
+    source = args.database
+    if source is None:
+        source = os.path.join(tempfile.gettempdir(), f'librar-{args.scale}-{args.seed}-{datetime.now():%Y%m%d}.db')
+        if not os.path.exists(source):
+            generate(source, SCALES[args.scale], args.seed)
+    with sqlite3.connect(source) as original, sqlite3.connect(database) as copy:
+        original.backup(copy)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import create_app
+        from model import db
+        from celery_config import celery
+        import tasks
+        app = create_app({
+            'DATABASE_FILE': database,
+            'CONTENT_DIR': os.path.join(workdir, 'content'),
+            'CACHE_TYPE': CACHE_TYPES[args.cache],
+            'METRICS_ENABLED': True,
+            # Publishing is measured; nothing subscribes, so no Redis server is needed.
+            'EVENTS_BROKER': 'local',
+        })
+        # A cached database may predate newer tables; bring it up to date as a deploy would.
+        from migrations import migrate
+        with app.app_context():
+            db.create_all()
+            migrate(db.engine)
+    celery.conf.update(task_always_eager=True, task_eager_propagates=True)
+
+    counter = [0]
+    with app.app_context():
+        for engine in db.engines.values():
+            @event.listens_for(engine, 'before_cursor_execute')
+            def count(*args):
+                counter[0] += 1
+    ctx = Context(app, db, args.seed)
+
+    results, covered = {}, set()
+    scenarios = [(name, prepare, False) for name, prepare in route_scenarios().items()]
+    scenarios += [(name, prepare, True) for name, prepare in task_scenarios(tasks).items()]
+    print(f"{'scenario':<38} {'n':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'queries':>8}  statuses")
+    for name, prepare, is_task in scenarios:
+        if args.only and args.only not in name:
+            continue
+        iterations = args.task_iterations if is_task else args.iterations
+        result, endpoints = run_scenario(ctx, name, prepare, counter, iterations, 0 if is_task else args.warmup, is_task)
+        results[name] = result
+        covered |= endpoints
+        print(f"{name:<38} {result['n']:>4} {result['p50']:>7.1f}ms {result['p95']:>7.1f}ms {result['p99']:>7.1f}ms "
+              f"{result['queries']:>8}  {','.join(map(str, result['statuses']))}")
+
+    if not args.only:
+        missing_routes = sorted(set(routes(app)) - covered)
+        missing_tasks = sorted(name for name in celery.tasks if name.startswith('tasks.') and name not in results)
+        for endpoint, method in missing_routes:
+            print(f'Not covered by any scenario: {method} {endpoint}')
+        for name in missing_tasks:
+            print(f'Not covered by any scenario: task {name}')
+
+    baseline_path = os.path.join(BASELINE_DIR, f'{args.baseline or args.scale}.json')
+    regressions = []
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump({
+                'meta': {
+                    'scale': args.scale if args.database is None else args.database,
+                    'seed': args.seed, 'iterations': args.iterations, 'cache': args.cache,
+                    'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                    'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'\nBaseline saved to {baseline_path}')
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_ms)
+        print(f"\n{len(regressions)} regressions against {baseline_path}")
+    else:
+        print(f'\nNo baseline at {baseline_path}; run with --save-baseline to create one')
+
+    smtp.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import uuid
+from functools import wraps
+from flask import request, make_response
+from flask_caching import Cache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+cache = Cache()
+
+# Versioned reads never go stale, so the timeout only bounds how long abandoned keys linger.
+VIEW_TIMEOUT = 24 * 60 * 60
+VERSION_KEY = 'version:%s'
+
+
+def fakeredis_cache(app, config, args, kwargs):
+    # CACHE_TYPE='caching.fakeredis_cache' runs the Redis backend against an in-process fake server.
+    import fakeredis
+    from flask_caching.backends.rediscache import RedisCache
+    kwargs.update(host=fakeredis.FakeStrictRedis(), key_prefix=config.get('CACHE_KEY_PREFIX'))
+    return RedisCache(*args, **kwargs)
+
+
+def entity_versions(entities):
+    # Tables with a trigger-maintained table_version use it, as the ETag does, so writes that
+    # skip the session hooks (raw SQL, other processes) still change the key.
+    from etags import VERSIONED_TABLES, table_versions
+    versioned = [entity for entity in entities if entity in VERSIONED_TABLES]
+    versions = {entity: str(version) for entity, version in zip(versioned, table_versions(versioned))
+                if version is not None}
+
+    keys = [VERSION_KEY % entity for entity in entities if entity not in versions]
+    if keys:
+        tokens = dict(zip(keys, cache.get_many(*keys)))
+        missing = {key: uuid.uuid4().hex for key, token in tokens.items() if token is None}
+        if missing:
+            cache.set_many(missing, timeout=0)
+            tokens.update(missing)
+        versions.update((entity, tokens[VERSION_KEY % entity]) for entity in entities if entity not in versions)
+    return [versions[entity] for entity in entities]
+
+
+def invalidate(*entities):
+    if entities:
+        cache.set_many({VERSION_KEY % entity: uuid.uuid4().hex for entity in entities}, timeout=0)
+
+
+def cached_by_entities(*entities):
+    """Cache a GET handler until one of the given entity types is written.
+
+    The cache key combines the request path and query string with the current
+    version token of each entity; commits touching those entities replace the
+    token, so the next read misses and repopulates.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            query = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+            try:
+                key = 'view:%s?%s:%s' % (request.path, query, '.'.join(entity_versions(entities)))
+                cached = cache.get(key)
+            except Exception as e:
+                print(f"Cache unavailable, serving {request.path} uncached: {e}")
+                return f(*args, **kwargs)
+            if cached is not None:
+                return _restore(cached)
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                try:
+                    cache.set(key, (response.get_data(), response.status_code, _headers(response)), timeout=VIEW_TIMEOUT)
+                except Exception as e:
+                    print(f"Cache unavailable, not storing {request.path}: {e}")
+            return response
+        return decorated
+    return decorator
+
+
+def _headers(response):
+    return [(name, value) for name, value in response.headers.items() if name.lower() != 'content-length']
+
+
+def _restore(cached):
+    data, status, headers = cached
+    return make_response(data, status, headers)
+
+
+def _entities(session):
+    return session.info.setdefault('written_entities', set())
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_flush(session, flush_context, instances):
+    entities = _entities(session)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        entities.add(obj.__tablename__)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_bulk_write(orm_execute_state):
+    # ORM-enabled update()/delete() statements bypass the flush.
+    if (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert) \
+            and orm_execute_state.bind_mapper is not None:
+        _entities(orm_execute_state.session).add(orm_execute_state.bind_mapper.local_table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_versions(session):
+    entities = session.info.pop('written_entities', None)
+    if entities:
+        try:
+            invalidate(*entities)
+        except Exception as e:
+            # The write already committed; a cache outage must not turn it into an error.
+            print(f"Cache invalidation failed for {sorted(entities)}: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_versions(session):
+    session.info.pop('written_entities', None)
@@ -1,16 +1,66 @@
-from celery import Celery
+import os
+import threading
+from celery import Celery, Task
 from celery.schedules import crontab
+from flask import current_app, has_app_context
 
-celery = Celery(__name__, broker='redis://localhost:6379/0', backend='redis://localhost:6379/0')
+BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', BROKER_URL)
+
+_worker_app = None
+_worker_app_lock = threading.Lock()
+
+
+def worker_app():
+    # Built by the first task, so importing tasks (beat, the API process, scripts) sets up no database or cache.
+    global _worker_app
+    with _worker_app_lock:
+        if _worker_app is None:
+            from factory import create_core_app
+            _worker_app = create_core_app()
+    return _worker_app
+
+
+class AppContextTask(Task):
+    """Run each task in its own app context: the caller's app when run eagerly from one, else the worker's."""
+
+    def __call__(self, *args, **kwargs):
+        app = current_app._get_current_object() if has_app_context() else worker_app()
+        with app.app_context():
+            return super().__call__(*args, **kwargs)
+
+
+# Neither client connects until the first task is sent or received.
+celery = Celery(__name__, broker=BROKER_URL, backend=RESULT_BACKEND, task_cls=AppContextTask)
 
 CELERY_BEAT_SCHEDULE = {
     'generate_monthly_report': {
         'task': 'tasks.generate_monthly_report',
-        'schedule': crontab(minute='*')
+        'schedule': crontab(minute=0, hour=6, day_of_month=1)
     },
     'daily_reminders': {
         'task': 'tasks.daily_reminders',
-        'schedule': 20.0  
+        'schedule': crontab(minute=0)
+    },
+    'dispatch_email_outbox': {
+        'task': 'tasks.dispatch_email_outbox',
+        'schedule': 10.0
+    },
+    'reconcile_stats_counters': {
+        'task': 'tasks.reconcile_stats_counters',
+        'schedule': crontab(minute=0, hour=3)
+    },
+    'revoke_overdue_loans': {
+        'task': 'tasks.revoke_overdue_loans_task',
+        'schedule': crontab(minute=30)
+    },
+    'roll_up_circulation': {
+        'task': 'tasks.roll_up_circulation_task',
+        'schedule': crontab(minute='*/5')
+    },
+    'archive_finished_requests': {
+        'task': 'tasks.archive_finished_requests',
+        'schedule': crontab(minute=15, hour=4)
     }
 }
 
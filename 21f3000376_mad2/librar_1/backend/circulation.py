@@ -0,0 +1,275 @@
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import DateTime, case, delete, func, literal, select, text, union_all, update
+from sqlalchemy.dialects.sqlite import insert
+from database import read_session
+from model import Book, Section, Request, RequestHistory, RequestEvent, CirculationDaily, BookCirculationDaily, RollupWatermark
+
+CIRCULATION_EVENTS = ('requested', 'accepted', 'returned', 'revoked')
+INTERVALS = ('day', 'week', 'month')
+ROLLUP_BATCH_SIZE = 5000
+DEFAULT_RANGE_DAYS = 30
+MAX_RANGE_DAYS = 5 * 366
+MAX_TRENDING = 100
+WATERMARK = 'circulation'
+
+_LOGGED = "('accepted', 'returned', 'revoked')"
+_SECTION = '(SELECT section_id FROM book WHERE id = NEW.book_id)'
+_NOW = "datetime('now', 'localtime')"
+
+# Every request placed and every status change a rollup counts is appended to
+# request_event, including Core and raw SQL writes. roll_up_circulation folds
+# the log into circulation_daily and deletes what it consumed.
+CIRCULATION_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_event_insert AFTER INSERT ON request BEGIN
+        INSERT INTO request_event (request_id, book_id, section_id, event, created_at)
+            VALUES (NEW.id, NEW.book_id, {_SECTION}, 'requested', {_NOW});
+        INSERT INTO request_event (request_id, book_id, section_id, event, created_at)
+            SELECT NEW.id, NEW.book_id, {_SECTION}, NEW.status, {_NOW} WHERE NEW.status IN {_LOGGED};
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_event_update AFTER UPDATE OF status ON request
+        WHEN NEW.status != OLD.status AND NEW.status IN {_LOGGED} BEGIN
+        INSERT INTO request_event (request_id, book_id, section_id, event, created_at)
+            VALUES (NEW.id, NEW.book_id, {_SECTION}, NEW.status, {_NOW});
+    END""",
+]
+
+
+def create_circulation_rollups(connection):
+    for model in (RequestEvent, CirculationDaily, BookCirculationDaily, RollupWatermark):
+        model.__table__.create(connection, checkfirst=True)
+    for statement in CIRCULATION_TRIGGERS:
+        connection.execute(text(statement))
+    backfill_circulation(connection)
+
+
+def _counts(event_column):
+    return [func.sum(case((event_column == event, 1), else_=0)).label(event) for event in CIRCULATION_EVENTS]
+
+
+def _section_rollup(book_rows):
+    """Fold (day, book) rows into circulation_daily's (day, section) rows."""
+    return select(
+        book_rows.c.day, book_rows.c.section_id, *[func.sum(getattr(book_rows.c, event)) for event in CIRCULATION_EVENTS]
+    ).where(book_rows.c.section_id.is_not(None)).group_by(book_rows.c.day, book_rows.c.section_id)
+
+
+def backfill_circulation(connection, today=None):
+    """Rebuild both rollup tables from the request and request_history tables and restart the log from here.
+
+    The request table keeps no transition times, so history is approximated:
+    requests and acceptances are dated by issue_date, returns and revocations by
+    return_date (the due date, which is when the overdue task revokes), never
+    later than today. Events logged before the rebuild are already reflected in
+    the request rows and are dropped. Returns the number of (day, book) rows.
+    """
+    today = today or datetime.now()
+    selects = []
+    # Archived requests (see archive.py) keep their dates, so they count like live ones.
+    for table in (Request, RequestHistory):
+        issued = func.date(table.issue_date)
+        closed = func.date(func.min(table.return_date, literal(today, DateTime)))
+        selects += [
+            select(issued.label('day'), table.book_id, Book.section_id, literal('requested').label('event'))
+            .join(Book, Book.id == table.book_id).where(table.issue_date.is_not(None)),
+            select(issued, table.book_id, Book.section_id, literal('accepted'))
+            .join(Book, Book.id == table.book_id)
+            .where(table.issue_date.is_not(None), table.status.in_(('accepted', 'returned', 'revoked'))),
+            select(closed, table.book_id, Book.section_id, table.status)
+            .join(Book, Book.id == table.book_id)
+            .where(table.return_date.is_not(None), table.status.in_(('returned', 'revoked'))),
+        ]
+    changes = union_all(*selects).subquery()
+
+    books = BookCirculationDaily.__table__
+    connection.execute(books.delete())
+    connection.execute(books.insert().from_select(
+        ['day', 'book_id', 'section_id', *CIRCULATION_EVENTS],
+        select(changes.c.day, changes.c.book_id, func.min(changes.c.section_id), *_counts(changes.c.event))
+        .group_by(changes.c.day, changes.c.book_id)
+    ))
+    connection.execute(CirculationDaily.__table__.delete())
+    connection.execute(CirculationDaily.__table__.insert().from_select(
+        ['day', 'section_id', *CIRCULATION_EVENTS], _section_rollup(books)
+    ))
+    last_id = connection.execute(select(func.max(RequestEvent.id))).scalar() or 0
+    connection.execute(RequestEvent.__table__.delete())
+    _set_watermark(connection, last_id)
+    return connection.execute(select(func.count()).select_from(books)).scalar()
+
+
+def _set_watermark(connection, last_id):
+    connection.execute(
+        insert(RollupWatermark).values(name=WATERMARK, last_id=last_id, updated_at=datetime.now())
+        .on_conflict_do_update(index_elements=['name'], set_={'last_id': last_id, 'updated_at': datetime.now()})
+    )
+
+
+def _add_counts(model, rows):
+    key = [column.name for column in model.__table__.primary_key]
+    columns = [name for name in model.__table__.columns.keys() if name not in CIRCULATION_EVENTS]
+    statement = insert(model).from_select([*columns, *CIRCULATION_EVENTS], rows)
+    return statement.on_conflict_do_update(
+        index_elements=key,
+        set_={event: getattr(model, event) + getattr(statement.excluded, event) for event in CIRCULATION_EVENTS}
+    )
+
+
+def roll_up_circulation(session, batch_size=ROLLUP_BATCH_SIZE):
+    """Fold request_event rows past the watermark into the rollup tables, one transaction per batch.
+
+    Returns how many events were consumed. Each batch starts by writing the
+    watermark row, so concurrent runs queue on the write lock instead of
+    folding the same events twice.
+    """
+    consumed = 0
+    while True:
+        watermark = session.execute(
+            update(RollupWatermark).where(RollupWatermark.name == WATERMARK)
+            .values(updated_at=datetime.now()).returning(RollupWatermark.last_id)
+        ).scalar()
+        if watermark is None:
+            _set_watermark(session, 0)
+            watermark = 0
+        pending = select(RequestEvent.id).where(RequestEvent.id > watermark).order_by(RequestEvent.id).limit(batch_size).subquery()
+        high = session.execute(select(func.max(pending.c.id))).scalar()
+        if high is None:
+            session.rollback()
+            break
+
+        day = func.date(RequestEvent.created_at).label('day')
+        batch = [RequestEvent.id > watermark, RequestEvent.id <= high]
+        book_rows = select(
+            day, RequestEvent.book_id, func.min(RequestEvent.section_id).label('section_id'), *_counts(RequestEvent.event)
+        ).where(*batch).group_by(day, RequestEvent.book_id)
+        session.execute(_add_counts(BookCirculationDaily, book_rows))
+        section_rows = _section_rollup(book_rows.subquery())
+        session.execute(_add_counts(CirculationDaily, section_rows))
+        count = session.execute(delete(RequestEvent).where(*batch)).rowcount
+        session.execute(update(RollupWatermark).where(RollupWatermark.name == WATERMARK).values(last_id=high))
+        session.commit()
+        consumed += count
+        if count < batch_size:
+            break
+    return consumed
+
+
+class CirculationError(Exception):
+    pass
+
+
+def date_range(start, end, today=None):
+    """Parse ?from= and ?to= (inclusive YYYY-MM-DD); defaults to the last DEFAULT_RANGE_DAYS days."""
+    today = (today or datetime.now()).date()
+    try:
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else today
+        start = datetime.strptime(start, '%Y-%m-%d').date() if start else end - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+    except ValueError:
+        raise CirculationError('from and to must be dates in YYYY-MM-DD format')
+    if start > end:
+        raise CirculationError('from must not be after to')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise CirculationError(f'ranges are limited to {MAX_RANGE_DAYS} days')
+    return start, end
+
+
+def period_of(day, interval):
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _period_column(day, interval):
+    if interval == 'week':
+        # SQLite's 'weekday 0' moves forward to Sunday; six days back is that week's Monday.
+        return func.date(day, 'weekday 0', '-6 days')
+    if interval == 'month':
+        return func.date(day, 'start of month')
+    return func.date(day)
+
+
+def _sums(model):
+    return [func.sum(getattr(model, event)) for event in CIRCULATION_EVENTS]
+
+
+def circulation_series(start, end, interval='day', section_id=None, book_id=None):
+    """Counts per period between start and end inclusive, with empty periods filled with zeros.
+
+    Library and section series read circulation_daily; a book's series reads
+    book_circulation_daily through its (book_id, day) index.
+    """
+    if interval not in INTERVALS:
+        raise CirculationError(f"interval must be one of: {', '.join(INTERVALS)}")
+    model = CirculationDaily if book_id is None else BookCirculationDaily
+    period = _period_column(model.day, interval)
+    query = read_session.query(period, *_sums(model)).filter(model.day.between(start, end))
+    if section_id is not None:
+        query = query.filter(model.section_id == section_id)
+    if book_id is not None:
+        query = query.filter(model.book_id == book_id)
+    found = {row[0]: row[1:] for row in query.group_by(period)}
+
+    series, day = [], start
+    while day <= end:
+        label = period_of(day, interval).strftime('%Y-%m-%d')
+        if not series or series[-1]['period'] != label:
+            counts = found.get(label) or (0,) * len(CIRCULATION_EVENTS)
+            series.append({'period': label, **dict(zip(CIRCULATION_EVENTS, counts))})
+        day += timedelta(days=1)
+    totals = {event: sum(entry[event] for entry in series) for event in CIRCULATION_EVENTS}
+    return series, totals
+
+
+def trending(start, end, by='book', metric='requested', limit=10, section_id=None):
+    """The books or sections with the highest metric between start and end inclusive.
+
+    Ranking books reads one row per book per active day, so its cost grows with
+    the length of the range; sections read the much smaller circulation_daily.
+    """
+    if by not in ('book', 'section'):
+        raise CirculationError('by must be book or section')
+    if metric not in CIRCULATION_EVENTS:
+        raise CirculationError(f"metric must be one of: {', '.join(CIRCULATION_EVENTS)}")
+    if not 1 <= limit <= MAX_TRENDING:
+        raise CirculationError(f'limit must be between 1 and {MAX_TRENDING}')
+    model = BookCirculationDaily if by == 'book' else CirculationDaily
+    key = model.book_id if by == 'book' else model.section_id
+    sums = _sums(model)
+    ranked = select(key.label('id'), *[total.label(event) for total, event in zip(sums, CIRCULATION_EVENTS)]) \
+        .where(model.day.between(start, end))
+    if section_id is not None:
+        ranked = ranked.where(model.section_id == section_id)
+    ranked = ranked.group_by(key).order_by(sums[CIRCULATION_EVENTS.index(metric)].desc(), key).limit(limit).subquery()
+
+    counts = [getattr(ranked.c, event) for event in CIRCULATION_EVENTS]
+    if by == 'book':
+        rows = read_session.execute(
+            select(ranked.c.id, Book.name, Book.author, Section.id, Section.name, *counts)
+            .outerjoin(Book, Book.id == ranked.c.id).outerjoin(Section, Section.id == Book.section_id)
+            .order_by(getattr(ranked.c, metric).desc(), ranked.c.id)
+        ).all()
+        return [{'id': book, 'name': name, 'author': author, 'section_id': section, 'section_name': section_name,
+                 **dict(zip(CIRCULATION_EVENTS, values))}
+                for book, name, author, section, section_name, *values in rows]
+    rows = read_session.execute(
+        select(ranked.c.id, Section.name, *counts).outerjoin(Section, Section.id == ranked.c.id)
+        .order_by(getattr(ranked.c, metric).desc(), ranked.c.id)
+    ).all()
+    return [{'id': section, 'name': name, **dict(zip(CIRCULATION_EVENTS, values))} for section, name, *values in rows]
+
+
+if __name__ == '__main__':
+    from factory import create_core_app
+    from model import db
+    from caching import invalidate
+    app = create_core_app()
+    with app.app_context():
+        if '--backfill' in sys.argv:
+            with db.engine.begin() as connection:
+                rows = backfill_circulation(connection)
+            invalidate('circulation_daily', 'book_circulation_daily')
+            print(f'Rebuilt the circulation rollups from the request table: {rows} day and book rows')
+        else:
+            print(f'Rolled up {roll_up_circulation(db.session)} request events')
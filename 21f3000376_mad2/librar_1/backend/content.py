@@ -0,0 +1,183 @@
+import hashlib
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from model import BookFile, Request
+
+MEDIA_TYPES = {'.pdf': 'application/pdf', '.epub': 'application/epub+zip'}
+# Request bodies are copied to disk in blocks of this size; no chunk or file is ever held in memory.
+COPY_BLOCK_SIZE = 64 * 1024
+MAX_CHUNK_BYTES = 16 * 1024 * 1024
+# A chunk writer that died without releasing its claim is assumed gone after this long.
+CLAIM_TIMEOUT = timedelta(minutes=10)
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class ContentError(Exception):
+    pass
+
+
+class UploadConflict(ContentError):
+    pass
+
+
+def media_type_for(filename):
+    return MEDIA_TYPES.get(os.path.splitext(filename.lower())[1])
+
+
+def content_path(directory, book_file):
+    return os.path.join(directory, book_file.id + os.path.splitext(book_file.filename)[1].lower())
+
+
+def upload_state(book_file):
+    return {
+        'upload_id': book_file.id,
+        'book_id': book_file.book_id,
+        'filename': book_file.filename,
+        'media_type': book_file.media_type,
+        'size': book_file.size,
+        'offset': book_file.received,
+        'status': book_file.status,
+        'sha256': book_file.sha256,
+    }
+
+
+def start_upload(session, book_id, filename, size, max_bytes):
+    """Register an upload; the caller commits. Chunks then go through write_chunk."""
+    filename = os.path.basename(filename or '').strip()
+    media_type = media_type_for(filename)
+    if media_type is None:
+        raise ContentError(f"filename must end in {' or '.join(MEDIA_TYPES)}")
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise ContentError('size must be a positive integer')
+    if size > max_bytes:
+        raise ContentError(f'files are limited to {max_bytes} bytes')
+    book_file = BookFile(id=str(uuid.uuid4()), book_id=book_id, filename=filename[:255], media_type=media_type, size=size)
+    session.add(book_file)
+    return book_file
+
+
+def parse_content_range(header, size):
+    match = CONTENT_RANGE.match(header or '')
+    if not match:
+        raise ContentError('Content-Range must be "bytes <start>-<end>/<size>"')
+    start, end, total = map(int, match.groups())
+    if total != size or start > end or end >= size:
+        raise ContentError(f'Content-Range must lie within the {size} byte upload')
+    if end - start + 1 > MAX_CHUNK_BYTES:
+        raise ContentError(f'chunks are limited to {MAX_CHUNK_BYTES} bytes')
+    return start, end
+
+
+def looks_valid(path, media_type):
+    with open(path, 'rb') as f:
+        head = f.read(58)
+    if media_type == 'application/pdf':
+        return head.startswith(b'%PDF-')
+    # An EPUB is a zip whose first entry is the uncompressed "mimetype" file.
+    return head.startswith(b'PK\x03\x04') and head[30:58] == b'mimetypeapplication/epub+zip'
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_chunk(session, book_file, stream, start, end, directory):
+    """Write bytes start..end of an upload from stream, finishing the upload on its last chunk.
+
+    Chunks must arrive in order: start has to equal the bytes already received.
+    Commits on its own: the claim is committed before the body is read so the
+    database is not locked while the client sends it.
+    """
+    now = datetime.now()
+    claimed = session.execute(
+        update(BookFile).where(
+            BookFile.id == book_file.id,
+            BookFile.status == 'uploading',
+            BookFile.received == start,
+            BookFile.claimed_at.is_(None) | (BookFile.claimed_at < now - CLAIM_TIMEOUT)
+        ).values(claimed_at=now).execution_options(synchronize_session=False)
+    ).rowcount
+    session.commit()
+    if not claimed:
+        session.refresh(book_file)
+        raise UploadConflict(f'upload is at offset {book_file.received}; resend from there')
+
+    os.makedirs(directory, exist_ok=True)
+    path = content_path(directory, book_file)
+    partial_path = path + '.part'
+    try:
+        with open(partial_path, 'r+b' if os.path.exists(partial_path) else 'w+b') as partial:
+            # Anything past the acknowledged offset is left over from a chunk that never finished.
+            partial.truncate(start)
+            partial.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                partial.write(block)
+                remaining -= len(block)
+            if remaining:
+                raise ContentError(f'chunk body ended {remaining} bytes before its Content-Range')
+            partial.flush()
+            os.fsync(partial.fileno())
+    except BaseException:
+        session.execute(update(BookFile).where(BookFile.id == book_file.id).values(claimed_at=None))
+        session.commit()
+        raise
+
+    book_file.received = end + 1
+    book_file.claimed_at = None
+    if book_file.received == book_file.size:
+        if not looks_valid(partial_path, book_file.media_type):
+            os.remove(partial_path)
+            book_file.status = 'failed'
+            session.commit()
+            raise ContentError(f'file is not a valid {os.path.splitext(path)[1][1:].upper()}')
+        book_file.sha256 = file_sha256(partial_path)
+        os.replace(partial_path, path)
+        book_file.status = 'ready'
+        book_file.finished_at = datetime.now()
+    session.commit()
+    if book_file.status == 'ready':
+        remove_files(session, directory, BookFile.book_id == book_file.book_id, BookFile.status == 'ready',
+                     BookFile.id != book_file.id)
+    return book_file
+
+
+def remove_files(session, directory, *criteria):
+    """Delete the matching BookFile rows and their files, finished or not; returns how many."""
+    book_files = session.execute(select(BookFile).where(*criteria)).scalars().all()
+    for book_file in book_files:
+        session.delete(book_file)
+    session.commit()
+    for book_file in book_files:
+        path = content_path(directory, book_file)
+        for leftover in (path, path + '.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return len(book_files)
+
+
+def current_file(session, book_id):
+    return session.execute(
+        select(BookFile).where(BookFile.book_id == book_id, BookFile.status == 'ready')
+        .order_by(BookFile.finished_at.desc()).limit(1)
+    ).scalar()
+
+
+def can_read(session, book_id, user_id):
+    if user_id is None:
+        return False
+    return session.execute(
+        select(Request.id).where(
+            Request.book_id == book_id, Request.user_id == user_id, Request.status == 'accepted'
+        ).limit(1)
+    ).first() is not None
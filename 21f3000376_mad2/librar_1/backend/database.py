@@ -0,0 +1,77 @@
+import os
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# Engine profile for concurrent Flask and Celery workers sharing one SQLite file.
+SQLITE_PROFILE = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'busy_timeout_ms': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'readonly_pool': os.environ.get('DB_READONLY_POOL', '1') == '1',
+}
+
+# Sessions for read-only endpoints; bound to the read-only pool when it is enabled.
+read_session = scoped_session(sessionmaker())
+
+
+def engine_options(profile=SQLITE_PROFILE):
+    return {
+        'pool_size': profile['pool_size'],
+        'max_overflow': profile['max_overflow'],
+        'pool_timeout': profile['pool_timeout'],
+        'connect_args': {'timeout': profile['busy_timeout_ms'] / 1000, 'check_same_thread': False},
+    }
+
+
+def configure_database(app, database, profile=SQLITE_PROFILE):
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(profile)
+    if profile['readonly_pool']:
+        app.config['SQLALCHEMY_BINDS'] = {
+            'readonly': dict(engine_options(profile), url=f'sqlite:///file:{database}?mode=ro&uri=true')
+        }
+
+
+def sqlite_pragmas(profile=SQLITE_PROFILE, readonly=False):
+    statements = [
+        f"PRAGMA busy_timeout = {profile['busy_timeout_ms']}",
+        f"PRAGMA synchronous = {profile['synchronous']}",
+        f"PRAGMA mmap_size = {profile['mmap_size']}",
+        f"PRAGMA cache_size = {profile['cache_size']}",
+    ]
+    if readonly:
+        statements.append('PRAGMA query_only = ON')
+    else:
+        # journal_mode is persistent in the database file, so only writers need to set it.
+        statements.insert(0, f"PRAGMA journal_mode = {profile['journal_mode']}")
+    return statements
+
+
+def apply_sqlite_pragmas(engine, profile=SQLITE_PROFILE, readonly=False):
+    statements = sqlite_pragmas(profile, readonly)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+def init_database(app, db, profile=SQLITE_PROFILE):
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            if engine.dialect.name == 'sqlite':
+                apply_sqlite_pragmas(engine, profile, readonly=bind_key == 'readonly')
+        read_session.configure(bind=db.engines.get('readonly', db.engine))
+
+    # Close after every request, not just the app context, so a long-lived context never reads a stale snapshot.
+    @app.teardown_request
+    @app.teardown_appcontext
+    def remove_read_session(exception=None):
+        read_session.remove()
@@ -0,0 +1,99 @@
+import hashlib
+import random
+from datetime import datetime
+from functools import wraps
+from flask import g, request, make_response
+from sqlalchemy import select, text
+from database import read_session
+
+VERSIONED_TABLES = ('user', 'section', 'book', 'feedback')
+
+# table_version.version is bumped by every insert, update or delete on a versioned
+# table, including Core and raw SQL writes that never pass through the session.
+TABLE_VERSION_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON "{table}" BEGIN
+        UPDATE table_version SET version = version + 1 WHERE name = '{table}';
+    END"""
+    for table in VERSIONED_TABLES for event in ('INSERT', 'UPDATE', 'DELETE')
+]
+
+
+def create_table_versions(connection):
+    from model import TableVersion
+    for table in VERSIONED_TABLES:
+        columns = {row[1] for row in connection.execute(text(f'PRAGMA table_info("{table}")'))}
+        if 'updated_at' not in columns:
+            connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN updated_at DATETIME'))
+        connection.execute(text(f'UPDATE "{table}" SET updated_at = :now WHERE updated_at IS NULL'), {'now': datetime.now()})
+
+    TableVersion.__table__.create(connection, checkfirst=True)
+    # Random starting points, so a rebuilt database never re-issues ETags a client already holds.
+    for table in VERSIONED_TABLES:
+        connection.execute(
+            text('INSERT OR IGNORE INTO table_version (name, version) VALUES (:name, :version)'),
+            {'name': table, 'version': random.getrandbits(48)}
+        )
+    for statement in TABLE_VERSION_TRIGGERS:
+        connection.execute(text(statement))
+
+
+def table_versions(tables):
+    """Current table_version of each table, read once per request.
+
+    The ETag and the view cache key both come from here, so a cached body can
+    never be served under an ETag newer than the data it was built from.
+    """
+    from model import TableVersion
+    known = g.setdefault('table_versions', {})
+    missing = [table for table in tables if table not in known]
+    if missing:
+        known.update(dict.fromkeys(missing))
+        known.update(read_session.execute(
+            select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(missing))
+        ).all())
+    return [known[table] for table in tables]
+
+
+def table_stamp(*tables):
+    """Marker for responses built from whole tables: their current version numbers."""
+    def stamp(**kwargs):
+        return '.'.join(str(version) for version in table_versions(tables))
+    return stamp
+
+
+def row_stamp(model, arg):
+    """Marker for a single-row response: the row's updated_at, or None when it does not exist."""
+    def stamp(**kwargs):
+        updated_at = read_session.execute(
+            select(model.updated_at).where(model.id == kwargs[arg])
+        ).first()
+        return updated_at and f'{kwargs[arg]}:{updated_at[0]}'
+    return stamp
+
+
+def conditional(stamp):
+    """Strong ETag and If-None-Match support for a GET handler.
+
+    The ETag hashes the request path and query with the stamp, which is read
+    before the handler runs; a matching If-None-Match returns 304 without
+    running the handler at all.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            marker = stamp(**kwargs)
+            if marker is None:
+                return f(*args, **kwargs)
+            etag = hashlib.sha1(f'{request.full_path}|{marker}'.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Browsers keep the body but revalidate on every use.
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return decorated
+    return decorator
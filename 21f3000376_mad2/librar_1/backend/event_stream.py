@@ -0,0 +1,256 @@
+"""Server-Sent Events stream of request status changes.
+
+Run next to the API and the Celery worker:
+
+    python event_stream.py --port 5001
+
+Browsers connect with EventSource to /api/events?token=<access token> (EventSource
+cannot send an Authorization header, though one is accepted too). Admins receive
+every change, readers only changes to their own requests. Each connection is a
+coroutine and a bounded queue rather than a thread, so thousands of idle clients
+cost a few kilobytes each.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qs, urlsplit
+import jwt
+import events
+
+STREAM_PATH = '/api/events'
+HEARTBEAT_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+# Events buffered per connection before it is told to resync and dropped.
+QUEUE_SIZE = 256
+# Recent events kept so a reconnecting client can catch up from Last-Event-ID.
+REPLAY_SIZE = 10000
+MAX_HEADER_LINES = 64
+HEADER_TIMEOUT = 10
+
+CORS_HEADERS = (
+    'Access-Control-Allow-Origin: *\r\n'
+    'Access-Control-Allow-Headers: Authorization, Last-Event-ID\r\n'
+)
+
+
+class Subscriber:
+    def __init__(self, user_id, admin):
+        self.user_id = user_id
+        self.admin = admin
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.lagging = False
+
+
+class Hub:
+    """Fans events out to subscribers; only touched from the event loop's thread."""
+
+    def __init__(self):
+        # Event ids are "<epoch>-<sequence>"; a new epoch after a restart makes old ids unknown.
+        self.epoch = format(int(time.time()), 'x')
+        self.sequence = 0
+        self.recent = deque(maxlen=REPLAY_SIZE)
+        self.admins = set()
+        self.readers = defaultdict(set)
+
+    def subscribe(self, subscriber):
+        if subscriber.admin:
+            self.admins.add(subscriber)
+        else:
+            self.readers[subscriber.user_id].add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        if subscriber.admin:
+            self.admins.discard(subscriber)
+        else:
+            readers = self.readers.get(subscriber.user_id)
+            if readers is not None:
+                readers.discard(subscriber)
+                if not readers:
+                    del self.readers[subscriber.user_id]
+
+    def dispatch(self, batch):
+        for event in batch:
+            self.sequence += 1
+            item = (self.sequence, event)
+            self.recent.append(item)
+            for subscriber in (*self.admins, *self.readers.get(event['user_id'], ())):
+                try:
+                    subscriber.queue.put_nowait(item)
+                except asyncio.QueueFull:
+                    subscriber.lagging = True
+
+    def replay(self, subscriber, last_event_id):
+        """Events after last_event_id for this subscriber, or None if they are no longer known."""
+        epoch, _, sequence = last_event_id.partition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        oldest = self.recent[0][0] if self.recent else self.sequence + 1
+        if sequence > self.sequence or sequence < oldest - 1:
+            return None
+        return [item for item in self.recent if item[0] > sequence
+                and (subscriber.admin or item[1]['user_id'] == subscriber.user_id)]
+
+    def event_id(self, sequence):
+        return f'{self.epoch}-{sequence}'
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    method, target, _ = (request_line.split(' ', 2) + ['', ''])[:3]
+    return method, target, headers
+
+
+def respond(writer, status, body=''):
+    writer.write((
+        f'HTTP/1.1 {status}\r\n{CORS_HEADERS}Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n{body}'
+    ).encode())
+
+
+def authenticate(token, secret):
+    """Return (user_id, admin) for a valid access token, or raise jwt.InvalidTokenError."""
+    claims = jwt.decode(token, secret, algorithms=['HS256'])
+    if claims.get('type', 'access') != 'access':
+        raise jwt.InvalidTokenError('not an access token')
+    return claims.get('user_id'), claims.get('sub') == 'admin'
+
+
+def frame(hub, sequence, event):
+    return f'id: {hub.event_id(sequence)}\nevent: request\ndata: {json.dumps(event, separators=(",", ":"))}\n\n'.encode()
+
+
+async def stream(hub, secret, reader, writer):
+    subscriber = None
+    try:
+        method, target, headers = await asyncio.wait_for(read_request(reader), HEADER_TIMEOUT)
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if method == 'OPTIONS':
+            respond(writer, '204 No Content')
+            return
+        if method != 'GET' or url.path != STREAM_PATH:
+            respond(writer, '404 Not Found', '{"message": "Not found"}')
+            return
+
+        authorization = headers.get('authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else query.get('token', [''])[0]
+        try:
+            user_id, admin = authenticate(token, secret)
+        except jwt.InvalidTokenError:
+            respond(writer, '401 Unauthorized', '{"message": "Invalid or expired token"}')
+            return
+        if not admin and user_id is None:
+            respond(writer, '403 Forbidden', '{"message": "Token has no user id; log in again"}')
+            return
+
+        subscriber = Subscriber(user_id, admin)
+        hub.subscribe(subscriber)
+        writer.write((
+            f'HTTP/1.1 200 OK\r\n{CORS_HEADERS}Content-Type: text/event-stream\r\n'
+            'Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\nConnection: keep-alive\r\n\r\n'
+            f'retry: {RETRY_MILLISECONDS}\n\n'
+        ).encode())
+
+        last_event_id = headers.get('last-event-id') or query.get('lastEventId', [''])[0]
+        if last_event_id:
+            missed = hub.replay(subscriber, last_event_id)
+            if missed is None:
+                writer.write(f'id: {hub.event_id(hub.sequence)}\nevent: resync\ndata: {{}}\n\n'.encode())
+            else:
+                for sequence, event in missed:
+                    writer.write(frame(hub, sequence, event))
+        await writer.drain()
+
+        while True:
+            try:
+                sequence, event = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Comments keep proxies from closing the connection and find clients that went away.
+                writer.write(b': ping\n\n')
+            else:
+                if subscriber.lagging:
+                    # The client fell too far behind; it reloads once instead of replaying a backlog.
+                    writer.write(b'event: resync\ndata: {}\n\n')
+                    await writer.drain()
+                    return
+                writer.write(frame(hub, sequence, event))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        pass
+    finally:
+        if subscriber is not None:
+            hub.unsubscribe(subscriber)
+        writer.close()
+
+
+async def listen_redis(hub, url):
+    """Feed the hub from the Redis channel, reconnecting with a backoff if Redis goes away."""
+    import redis.asyncio as redis
+    delay = 1
+    while True:
+        try:
+            client = redis.Redis.from_url(url)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(events.EVENTS_CHANNEL)
+            delay = 1
+            async for message in pubsub.listen():
+                hub.dispatch(json.loads(message['data']))
+        except (OSError, redis.RedisError) as e:
+            print(f"Event stream lost Redis ({e}); retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+async def serve(config, host, port, ready=None):
+    hub = Hub()
+    loop = asyncio.get_running_loop()
+    if config['EVENTS_BROKER'] == 'local':
+        broker = events.broker if isinstance(events.broker, events.LocalBroker) else events.LocalBroker()
+        events.broker = broker
+        broker.listeners.append(lambda payload: loop.call_soon_threadsafe(hub.dispatch, json.loads(payload)))
+    else:
+        loop.create_task(listen_redis(hub, config['EVENTS_REDIS_URL']))
+    server = await asyncio.start_server(
+        lambda reader, writer: stream(hub, config['JWT_SECRET_KEY'], reader, writer), host, port, backlog=1024
+    )
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1], hub)
+    async with server:
+        await server.serve_forever()
+
+
+def start_in_thread(config, host='127.0.0.1', port=0):
+    """Serve from a daemon thread of this process; with the local broker this is how one process runs both."""
+    started = threading.Event()
+    bound = {}
+
+    def ready(actual_port, hub):
+        bound.update(port=actual_port, hub=hub)
+        started.set()
+
+    threading.Thread(target=lambda: asyncio.run(serve(config, host, port, ready)), daemon=True).start()
+    started.wait()
+    return bound['port'], bound['hub']
+
+
+if __name__ == '__main__':
+    from factory import default_config
+    parser = argparse.ArgumentParser(description='Serve request status changes as Server-Sent Events')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+    config = default_config()
+    port = args.port or config['EVENTS_PORT']
+    print(f"Streaming request events on http://{args.host}:{port}{STREAM_PATH}")
+    asyncio.run(serve(config, args.host, port))
@@ -0,0 +1,101 @@
+import json
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from model import Request
+
+EVENTS_CHANNEL = 'librar:request-events'
+EVENT_FIELDS = ('status', 'issue_date', 'return_date')
+
+
+class LocalBroker:
+    """Delivers to listeners in this process; for a single process running both the API and event_stream."""
+
+    def __init__(self):
+        self.listeners = []
+
+    def publish(self, payload):
+        for listener in list(self.listeners):
+            listener(payload)
+
+
+class RedisBroker:
+    """Publishes on a Redis channel; the client is created on the first publish."""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+
+    def publish(self, payload):
+        if self.client is None:
+            import redis
+            self.client = redis.Redis.from_url(self.url, socket_connect_timeout=1, socket_timeout=1)
+        self.client.publish(EVENTS_CHANNEL, payload)
+
+
+broker = None
+
+
+def init_events(app):
+    """Pick the broker from EVENTS_BROKER: 'redis', 'local', or 'none' to publish nothing."""
+    global broker
+    kind = app.config['EVENTS_BROKER']
+    if kind == 'redis':
+        broker = RedisBroker(app.config['EVENTS_REDIS_URL'])
+    elif kind == 'local':
+        broker = broker if isinstance(broker, LocalBroker) else LocalBroker()
+    else:
+        broker = None
+
+
+def _date(value):
+    return value.strftime('%Y-%m-%d') if value else None
+
+
+def request_event(change, request_id, user_id, book_id, status=None, issue_date=None, return_date=None):
+    """A compact change: fields that are None were not changed, or are not known to the writer."""
+    values = {'change': change, 'id': request_id, 'user_id': user_id, 'book_id': book_id}
+    for name, value in (('status', status), ('issue_date', _date(issue_date)), ('return_date', _date(return_date))):
+        if value is not None:
+            values[name] = value
+    return values
+
+
+def record_request_events(session, events):
+    """Queue events for requests changed by bulk UPDATEs, which the flush hook cannot see."""
+    session.info.setdefault('request_events', []).extend(events)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_requests(session, flush_context):
+    events = []
+    for obj in session.new:
+        if isinstance(obj, Request):
+            events.append(request_event('created', obj.id, obj.user_id, obj.book_id, obj.status, obj.issue_date, obj.return_date))
+    for obj in session.dirty:
+        if isinstance(obj, Request):
+            state = inspect(obj)
+            changed = [name for name in EVENT_FIELDS if state.attrs[name].history.has_changes()]
+            if changed:
+                events.append(request_event('updated', obj.id, obj.user_id, obj.book_id,
+                                            **{name: getattr(obj, name) for name in changed}))
+    for obj in session.deleted:
+        if isinstance(obj, Request):
+            events.append(request_event('deleted', obj.id, obj.user_id, obj.book_id))
+    if events:
+        record_request_events(session, events)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish(session):
+    events = session.info.pop('request_events', None)
+    if events and broker is not None:
+        try:
+            broker.publish(json.dumps(events))
+        except Exception as e:
+            # The change is committed; clients that miss it resync on their next reconnect.
+            print(f"Publishing {len(events)} request events failed: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('request_events', None)
@@ -0,0 +1,56 @@
+import os
+from flask import Flask
+from model import db
+from database import configure_database, init_database
+from caching import cache
+from metrics import METRICS_CONFIG, init_metrics
+from events import init_events
+
+
+def default_config():
+    # Read when an app is built rather than at import, so scripts can set the environment first.
+    return {
+        # Relative names live in the Flask instance folder; benchmarks point this at a generated database.
+        'DATABASE_FILE': os.environ.get('DATABASE_FILE', 'librar.db'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'JWT_SECRET_KEY': 'librar',
+        # Serve the admin stats from the trigger-maintained counter tables instead of aggregating Book
+        'STATS_USE_COUNTERS': os.environ.get('STATS_USE_COUNTERS', '1') == '1',
+        # CACHE_TYPE='SimpleCache' or 'caching.fakeredis_cache' runs without a Redis server
+        'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'RedisCache'),
+        'CACHE_REDIS_URL': os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+        'CACHE_KEY_PREFIX': 'librar:',
+        'METRICS_ENABLED': METRICS_CONFIG['enabled'],
+        # Uploaded book files; served by send_file, or by the front server when USE_X_SENDFILE is on.
+        'CONTENT_DIR': os.environ.get('CONTENT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'content')),
+        'CONTENT_MAX_BYTES': int(os.environ.get('CONTENT_MAX_BYTES', 512 * 1024 * 1024)),
+        'USE_X_SENDFILE': os.environ.get('USE_X_SENDFILE', '0') == '1',
+        # Request status changes go to event_stream over Redis pub/sub; 'local' keeps them in this process.
+        'EVENTS_BROKER': os.environ.get('EVENTS_BROKER', 'redis'),
+        'EVENTS_REDIS_URL': os.environ.get('EVENTS_REDIS_URL', 'redis://localhost:6379/0'),
+        'EVENTS_PORT': int(os.environ.get('EVENTS_PORT', 5001)),
+        # Accepted loans are revoked this many days after their due date; daily_reminders sends
+        # the 'overdue' reminder in between.
+        'OVERDUE_GRACE_DAYS': int(os.environ.get('OVERDUE_GRACE_DAYS', 3)),
+        # Finished requests due longer ago than this move to request_history.
+        'ARCHIVE_AFTER_DAYS': int(os.environ.get('ARCHIVE_AFTER_DAYS', 180)),
+    }
+
+
+def create_core_app(config=None):
+    """Database, cache and metrics without any routes; Celery workers and scripts run in this app.
+
+    config overrides default_config(). The Redis client is created here but only
+    connects on the first cache call.
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    configure_database(app, app.config['DATABASE_FILE'])
+    db.init_app(app)
+    init_database(app, db)
+    cache.init_app(app)
+    init_events(app)
+    app.config['METRICS_ENABLED'] = init_metrics(app, db, dict(METRICS_CONFIG, enabled=app.config['METRICS_ENABLED']))
+    return app
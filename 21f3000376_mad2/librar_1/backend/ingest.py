@@ -0,0 +1,214 @@
+import argparse
+import csv
+import json
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, func, insert, select, tuple_, update
+from model import Section, Book
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ('csv', 'jsonl')
+
+
+def _decoded_lines(stream, undecodable):
+    # A newline byte never occurs inside a UTF-8 sequence, so each line decodes on its own.
+    for line in stream:
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError as e:
+            undecodable.append(e)
+            yield line.decode('utf-8', 'replace')
+
+
+def iter_records(stream, fmt):
+    """Yield (row number, dict) from a binary CSV or JSONL stream without reading it all.
+
+    A row with bytes that are not UTF-8 is yielded as its UnicodeDecodeError.
+    """
+    undecodable = []
+    lines = _decoded_lines(stream, undecodable)
+    if fmt == 'csv':
+        for number, record in enumerate(csv.DictReader(lines), start=2):
+            yield number, undecodable.pop() if undecodable else record
+            undecodable.clear()
+    else:
+        for number, line in enumerate(lines, start=1):
+            if undecodable:
+                yield number, undecodable.pop()
+            elif line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError as e:
+                    yield number, e
+
+
+def _date(value, field):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a date in YYYY-MM-DD format')
+
+
+def _text(record, field):
+    value = record.get(field)
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise ValueError(f'{field} must be a string')
+    return value
+
+
+def parse_record(record):
+    if isinstance(record, UnicodeDecodeError):
+        raise ValueError('row is not valid UTF-8')
+    if isinstance(record, Exception):
+        raise ValueError(f'invalid JSON: {record}')
+    if not isinstance(record, dict):
+        raise ValueError('record must be an object')
+    name = _text(record, 'name').strip()
+    if not name:
+        raise ValueError('name is required')
+    section = _text(record, 'section').strip()
+    section_id = record.get('section_id')
+    if not section and not section_id:
+        raise ValueError('section or section_id is required')
+    if section_id:
+        try:
+            section_id = int(section_id)
+        except (TypeError, ValueError):
+            raise ValueError('section_id must be an integer')
+
+    issue_date = _date(record.get('issue_date'), 'issue_date') or datetime.now()
+    return_date = _date(record.get('return_date'), 'return_date') or issue_date + timedelta(weeks=1)
+    return {
+        'name': name[:150],
+        'author': _text(record, 'author') or None,
+        'content': _text(record, 'content') or None,
+        'section': section,
+        'section_id': section_id,
+        'issue_date': issue_date,
+        'return_date': return_date,
+    }
+
+
+class Ingestion:
+    def __init__(self, engine, batch_size=DEFAULT_BATCH_SIZE, upsert=False):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.sections = {}
+        self.report = {'rows': 0, 'inserted': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+    def error(self, number, message):
+        self.report['failed'] += 1
+        if len(self.report['errors']) < MAX_REPORTED_ERRORS:
+            self.report['errors'].append({'row': number, 'error': message})
+
+    def run(self, records):
+        started = time.perf_counter()
+        batch = []
+        for number, record in records:
+            self.report['rows'] += 1
+            try:
+                batch.append((number, parse_record(record)))
+            except ValueError as e:
+                self.error(number, str(e))
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = []
+        if batch:
+            self.flush(batch)
+
+        elapsed = time.perf_counter() - started
+        self.report['seconds'] = round(elapsed, 3)
+        self.report['rows_per_second'] = round(self.report['rows'] / elapsed, 1) if elapsed else None
+        return self.report
+
+    def resolve_sections(self, connection, names):
+        missing = {name for name in names if name not in self.sections}
+        if not missing:
+            return
+        query = select(Section.name, Section.id).where(Section.name.in_(missing))
+        self.sections.update(connection.execute(query).all())
+        new = [{'name': name} for name in missing if name not in self.sections]
+        if new:
+            connection.execute(insert(Section), new)
+            self.sections.update(connection.execute(query).all())
+
+    def flush(self, batch):
+        try:
+            with self.engine.begin() as connection:
+                self.resolve_sections(connection, {row['section'] for _, row in batch if row['section']})
+                for _, row in batch:
+                    section = row.pop('section')
+                    if section:
+                        row['section_id'] = self.sections[section]
+
+                inserts, updates, collapsed = [row for _, row in batch], [], 0
+                if self.upsert:
+                    inserts, updates, collapsed = self.split_existing(connection, inserts)
+                if inserts:
+                    connection.execute(insert(Book), inserts)
+                if updates:
+                    connection.execute(
+                        update(Book).where(Book.id == bindparam('book_id')).values(
+                            content=bindparam('new_content'),
+                            issue_date=bindparam('new_issue_date'),
+                            return_date=bindparam('new_return_date')
+                        ),
+                        updates
+                    )
+            self.report['inserted'] += len(inserts)
+            self.report['updated'] += len(updates) + collapsed
+        except Exception as e:
+            # The whole batch rolled back; report every row in it rather than aborting the upload.
+            self.sections = {}
+            for number, _ in batch:
+                self.error(number, f'batch failed: {e}'[:255])
+
+    def split_existing(self, connection, rows):
+        key = lambda row: (row['name'], row['author'] or '', row['section_id'])
+        by_key = {key(row): row for row in rows}
+        existing = dict(
+            ((name, author, section_id), book_id) for book_id, name, author, section_id in connection.execute(
+                select(Book.id, Book.name, func.coalesce(Book.author, ''), Book.section_id).where(
+                    tuple_(Book.name, func.coalesce(Book.author, ''), Book.section_id).in_(list(by_key))
+                )
+            )
+        )
+        inserts = [row for row_key, row in by_key.items() if row_key not in existing]
+        updates = [{
+            'book_id': existing[row_key],
+            'new_content': row['content'],
+            'new_issue_date': row['issue_date'],
+            'new_return_date': row['return_date'],
+        } for row_key, row in by_key.items() if row_key in existing]
+        # Rows repeated within the batch collapse onto their last occurrence and count as updates.
+        return inserts, updates, len(rows) - len(by_key)
+
+
+def ingest_books(engine, stream, fmt, batch_size=DEFAULT_BATCH_SIZE, upsert=False):
+    return Ingestion(engine, batch_size, upsert).run(iter_records(stream, fmt))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load books from a CSV or JSONL file.')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=FORMATS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--upsert', action='store_true', help='update books matching (name, author, section)')
+    args = parser.parse_args()
+
+    from factory import create_core_app
+    from model import db
+    app = create_core_app()
+    fmt = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with app.app_context(), open(args.path, 'rb') as source:
+        report = ingest_books(db.engine, source, fmt, args.batch_size, args.upsert)
+    errors = report.pop('errors')
+    for error in errors:
+        print(f"row {error['row']}: {error['error']}")
+    print(json.dumps(report))
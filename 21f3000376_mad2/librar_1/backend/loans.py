@@ -0,0 +1,255 @@
+from datetime import datetime, timedelta
+from sqlalchemy import exists, false, func, or_, select, text, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from model import Book, Request
+from events import record_request_events, request_event
+
+ACTIVE_STATUSES = ('pending', 'accepted')
+MAX_ACTIVE_REQUESTS = 5
+LOAN_LIMIT_ERROR = 'loan limit reached'
+# SQLite names the columns of a violated unique index, not the index itself.
+DUPLICATE_REQUEST_ERRORS = ('uq_request_active_user_book', 'UNIQUE constraint failed: request.user_id, request.book_id')
+MAX_BATCH_TRANSITIONS = 1000
+OVERDUE_BATCH_SIZE = 200
+
+# action -> (status the request must be in, status it moves to)
+TRANSITIONS = {
+    'accept': ('pending', 'accepted'),
+    'decline': ('pending', 'declined'),
+    'reject': ('pending', 'declined'),
+    'revoke': ('accepted', 'revoked'),
+}
+
+_ACTIVE = "IN ('pending', 'accepted')"
+
+# user_loan_counter.active is the number of pending or accepted requests per user. The
+# BEFORE triggers refuse any write that would take it past MAX_ACTIVE_REQUESTS; because
+# SQLite serialises writers, the check and the write are atomic.
+LOAN_GUARD_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_loan_limit_insert BEFORE INSERT ON request
+        WHEN NEW.status {_ACTIVE}
+         AND COALESCE((SELECT active FROM user_loan_counter WHERE user_id = NEW.user_id), 0) >= {MAX_ACTIVE_REQUESTS}
+        BEGIN SELECT RAISE(ABORT, '{LOAN_LIMIT_ERROR}'); END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_loan_limit_update BEFORE UPDATE OF status, user_id ON request
+        WHEN NEW.status {_ACTIVE} AND NOT (OLD.status {_ACTIVE} AND OLD.user_id = NEW.user_id)
+         AND COALESCE((SELECT active FROM user_loan_counter WHERE user_id = NEW.user_id), 0) >= {MAX_ACTIVE_REQUESTS}
+        BEGIN SELECT RAISE(ABORT, '{LOAN_LIMIT_ERROR}'); END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_loan_counter_insert AFTER INSERT ON request
+        WHEN NEW.status {_ACTIVE} BEGIN
+        INSERT OR IGNORE INTO user_loan_counter (user_id, active) VALUES (NEW.user_id, 0);
+        UPDATE user_loan_counter SET active = active + 1 WHERE user_id = NEW.user_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_loan_counter_delete AFTER DELETE ON request
+        WHEN OLD.status {_ACTIVE} BEGIN
+        UPDATE user_loan_counter SET active = active - 1 WHERE user_id = OLD.user_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_request_loan_counter_update AFTER UPDATE OF status, user_id ON request
+        WHEN (OLD.status {_ACTIVE}) OR (NEW.status {_ACTIVE}) BEGIN
+        UPDATE user_loan_counter SET active = active - (OLD.status {_ACTIVE}) WHERE user_id = OLD.user_id;
+        INSERT OR IGNORE INTO user_loan_counter (user_id, active) VALUES (NEW.user_id, 0);
+        UPDATE user_loan_counter SET active = active + (NEW.status {_ACTIVE}) WHERE user_id = NEW.user_id;
+    END""",
+]
+
+
+def create_loan_guards(connection):
+    from model import UserLoanCounter
+    UserLoanCounter.__table__.create(connection, checkfirst=True)
+
+    # The unique index below cannot be built over existing duplicates: keep the oldest
+    # active request per (user, book) and decline the rest.
+    connection.execute(text(f"""
+        UPDATE request SET status = 'declined'
+        WHERE status {_ACTIVE} AND id NOT IN (
+            SELECT MIN(id) FROM request WHERE status {_ACTIVE} GROUP BY user_id, book_id
+        )"""))
+    connection.execute(text('DROP INDEX IF EXISTS ix_request_active_user_book'))
+    connection.execute(text(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS uq_request_active_user_book ON request (user_id, book_id) WHERE status {_ACTIVE}'
+    ))
+
+    connection.execute(text('DELETE FROM user_loan_counter'))
+    connection.execute(text(
+        f'INSERT INTO user_loan_counter (user_id, active) SELECT user_id, count(*) FROM request WHERE status {_ACTIVE} GROUP BY user_id'
+    ))
+    for statement in LOAN_GUARD_TRIGGERS:
+        connection.execute(text(statement))
+
+
+class LoanError(Exception):
+    pass
+
+
+class LoanLimitReached(LoanError):
+    pass
+
+
+class DuplicateRequest(LoanError):
+    pass
+
+
+def _commit_loan(session):
+    try:
+        session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        message = str(e.orig)
+        if LOAN_LIMIT_ERROR in message:
+            raise LoanLimitReached()
+        if any(error in message for error in DUPLICATE_REQUEST_ERRORS):
+            raise DuplicateRequest()
+        raise
+
+
+def place_request(session, user_id, book_id):
+    """Insert a pending request in a single statement; the database enforces the limits."""
+    issue_date = datetime.now()
+    new_request = Request(
+        user_id=user_id,
+        book_id=book_id,
+        status='pending',
+        issue_date=issue_date,
+        return_date=issue_date + timedelta(weeks=1)
+    )
+    session.add(new_request)
+    _commit_loan(session)
+    return new_request
+
+
+def set_request_status(session, request_id, status):
+    """Set one request's status and the book's holder; returns None when there is no such request.
+
+    Moving a request back to pending or accepted goes through the same database guards as a new request.
+    """
+    request = session.get(Request, request_id)
+    if request is None:
+        return None
+    request.status = status
+    if status == 'accepted':
+        session.get(Book, request.book_id).user_id = request.user_id
+    elif status == 'revoked':
+        book = session.get(Book, request.book_id)
+        if book.user_id == request.user_id:
+            book.user_id = None
+    _commit_loan(session)
+    return request
+
+
+def _selection(entity, ids=None, section_id=None, user_id=None, book_id=None):
+    conditions = []
+    if ids is not None:
+        conditions.append(entity.id.in_(ids))
+    if user_id is not None:
+        conditions.append(entity.user_id == user_id)
+    if book_id is not None:
+        conditions.append(entity.book_id == book_id)
+    if section_id is not None:
+        conditions.append(entity.book_id.in_(select(Book.id).where(Book.section_id == section_id)))
+    return conditions
+
+
+def transition_requests(session, action, ids=None, section_id=None, user_id=None, book_id=None):
+    """Apply one status transition to many requests with set-based UPDATEs in one transaction.
+
+    Requests are chosen by id list or by filter; the caller commits. Returns a result per
+    selected id: the new status, or the reason it was left alone.
+    """
+    from_status, to_status = TRANSITIONS[action]
+    conditions = _selection(Request, ids, section_id, user_id, book_id)
+    if not conditions:
+        raise LoanError('select requests by ids or by a filter')
+
+    eligible = [Request.status == from_status, *conditions]
+    issued = None
+    if action == 'accept':
+        # A book can go to one reader: never to a book already on loan, and when several
+        # selected requests want the same book, only the oldest is accepted.
+        holder = aliased(Request)
+        issued = or_(
+            exists().where(holder.book_id == Request.book_id, holder.status == 'accepted'),
+            Request.book_id.in_(select(Book.id).where(Book.user_id.is_not(None)))
+        )
+        eligible.append(~issued)
+        rival = aliased(Request)
+        eligible.append(Request.id == select(func.min(rival.id)).where(
+            rival.book_id == Request.book_id, rival.status == from_status,
+            *_selection(rival, ids, section_id, user_id, book_id)
+        ).scalar_subquery())
+
+    changed = session.execute(
+        update(Request).where(*eligible).values(status=to_status)
+        .returning(Request.id, Request.book_id, Request.user_id),
+        execution_options={'synchronize_session': False}
+    ).all()
+
+    if changed and action == 'accept':
+        holders = {book: user for _, book, user in changed}
+        session.execute(
+            update(Book).where(Book.id.in_(holders)).values(user_id=select(Request.user_id).where(
+                Request.book_id == Book.id, Request.id.in_([request_id for request_id, _, _ in changed])
+            ).scalar_subquery()),
+            execution_options={'synchronize_session': False}
+        )
+    elif changed and action == 'revoke':
+        # Only clear the holder if the book is still issued to the revoked request's reader.
+        session.execute(
+            update(Book).where(tuple_(Book.id, Book.user_id).in_([(book, user) for _, book, user in changed])).values(user_id=None),
+            execution_options={'synchronize_session': False}
+        )
+
+    record_request_events(session, [
+        request_event('updated', request_id, request_user, request_book, to_status)
+        for request_id, request_book, request_user in changed
+    ])
+    results = {request_id: {'id': request_id, 'ok': True, 'status': to_status} for request_id, _, _ in changed}
+    if ids is not None:
+        skipped = session.execute(
+            select(Request.id, Request.status, issued if issued is not None else false())
+            .where(*conditions, Request.id.notin_(results))
+        ).all()
+        for request_id, status, book_issued in skipped:
+            reason = f'request is {status}, expected {from_status}'
+            if status == from_status:
+                reason = 'book already issued' if book_issued else 'another selected request for this book was accepted'
+            results[request_id] = {'id': request_id, 'ok': False, 'error': reason}
+        for request_id in ids:
+            results.setdefault(request_id, {'id': request_id, 'ok': False, 'error': 'request not found'})
+    return sorted(results.values(), key=lambda result: result['id'])
+
+
+
+def revoke_overdue_loans(session, now=None, grace_days=0, batch_size=OVERDUE_BATCH_SIZE, dry_run=False):
+    """Revoke accepted requests more than grace_days past their return date and free the books, one short transaction per batch."""
+    now = now or datetime.now()
+    overdue = [Request.status == 'accepted', Request.return_date < now - timedelta(days=grace_days)]
+    if dry_run:
+        count, oldest = session.query(func.count(Request.id), func.min(Request.return_date)).filter(*overdue).one()
+        return {'dry_run': True, 'overdue': count, 'oldest_return_date': oldest and oldest.strftime('%Y-%m-%d'), 'revoked': 0, 'batches': 0}
+
+    revoked = batches = 0
+    while True:
+        batch = select(Request.id).where(*overdue).order_by(Request.id).limit(batch_size)
+        changed = session.execute(
+            update(Request).where(Request.id.in_(batch), *overdue).values(status='revoked')
+            .returning(Request.id, Request.book_id, Request.user_id),
+            execution_options={'synchronize_session': False}
+        ).all()
+        if not changed:
+            session.rollback()
+            break
+        # Only clear the holder if the book is still issued to the revoked request's reader.
+        session.execute(
+            update(Book).where(tuple_(Book.id, Book.user_id).in_([(book, user) for _, book, user in changed])).values(user_id=None),
+            execution_options={'synchronize_session': False}
+        )
+        record_request_events(session, [
+            request_event('updated', request_id, request_user, request_book, 'revoked')
+            for request_id, request_book, request_user in changed
+        ])
+        session.commit()
+        revoked += len(changed)
+        batches += 1
+        if len(changed) < batch_size:
+            break
+    return {'dry_run': False, 'revoked': revoked, 'batches': batches}
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+
+METRICS_CONFIG = {
+    'enabled': os.environ.get('METRICS_ENABLED', '1') == '1',
+    'slow_query_ms': float(os.environ.get('METRICS_SLOW_QUERY_MS', 200)),
+    'slow_request_ms': float(os.environ.get('METRICS_SLOW_REQUEST_MS', 1000)),
+    # The same statement run this many times within one request or task is reported as N+1.
+    'n_plus_one_threshold': int(os.environ.get('METRICS_N_PLUS_ONE_THRESHOLD', 20)),
+}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_current = ContextVar('metrics_tracker', default=None)
+
+
+class Tracker:
+    """SQL activity of one Flask request or Celery task."""
+
+    __slots__ = ('name', 'started', 'statements', 'sql_seconds', 'by_statement')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.by_statement = Counter()
+
+    def n_plus_one(self, threshold):
+        return [(statement, count) for statement, count in self.by_statement.items() if count >= threshold]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Registry:
+    """In-process metrics; each Flask or Celery worker process exposes its own."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self.histograms[name, labels].observe(value)
+
+    def render(self):
+        lines, typed = [], set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                for bound, count in zip(DURATION_BUCKETS, histogram.buckets):
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {count}')
+                lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(histogram.total)}')
+                lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else round(value, 6)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tracker = _current.get()
+    if tracker is None or not conn.info.get('metrics_started'):
+        return
+    elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+    tracker.statements += 1
+    tracker.sql_seconds += elapsed
+    tracker.by_statement[statement] += 1
+    if elapsed * 1000 >= METRICS_CONFIG['slow_query_ms']:
+        registry.inc('librar_slow_queries_total', (('source', tracker.name),))
+        print(f"Slow query in {tracker.name} ({elapsed * 1000:.0f}ms): {' '.join(statement.split())[:500]}")
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def finish(tracker, kind, labels):
+    """Record a finished request or task; returns the wall time in seconds."""
+    elapsed = time.perf_counter() - tracker.started
+    registry.observe(f'librar_{kind}_duration_seconds', labels, elapsed)
+    registry.inc(f'librar_{kind}_sql_statements_total', labels, tracker.statements)
+    registry.inc(f'librar_{kind}_sql_duration_seconds_total', labels, tracker.sql_seconds)
+
+    repeated = tracker.n_plus_one(METRICS_CONFIG['n_plus_one_threshold'])
+    for statement, count in repeated:
+        registry.inc('librar_n_plus_one_total', (('source', tracker.name),))
+        print(f"Possible N+1 in {tracker.name}: statement ran {count} times: {' '.join(statement.split())[:300]}")
+    if elapsed * 1000 >= METRICS_CONFIG['slow_request_ms']:
+        print(f"Slow {kind} {tracker.name}: {elapsed * 1000:.0f}ms, {tracker.statements} statements, "
+              f"{tracker.sql_seconds * 1000:.0f}ms in SQL")
+    return elapsed
+
+
+def _request_labels():
+    rule = request.url_rule
+    return (('method', request.method), ('route', rule.rule if rule else 'unmatched'))
+
+
+def _start_request():
+    labels = dict(_request_labels())
+    request.environ['metrics.token'] = _current.set(Tracker(f"{labels['method']} {labels['route']}"))
+
+
+def _finish_request(response):
+    token = request.environ.pop('metrics.token', None)
+    if token is None:
+        return response
+    tracker = token.var.get()
+    _current.reset(token)
+
+    labels = _request_labels()
+    elapsed = finish(tracker, 'http_request', labels)
+    registry.inc('librar_http_requests_total', labels + (('status', str(response.status_code)),))
+    # Streamed responses (send_file, event streams) have no length up front.
+    if not response.direct_passthrough and not response.is_streamed:
+        registry.inc('librar_http_response_bytes_total', labels, response.calculate_content_length() or 0)
+    response.headers['Server-Timing'] = (
+        f'app;dur={elapsed * 1000:.1f}, db;dur={tracker.sql_seconds * 1000:.1f};desc="{tracker.statements} queries"'
+    )
+    return response
+
+
+def _discard_request(exception=None):
+    # after_request does not run when a handler raises; do not leak the tracker into the next request.
+    token = request.environ.pop('metrics.token', None)
+    if token is not None:
+        _current.reset(token)
+
+
+_task_tokens = {}
+
+
+def _start_task(task_id=None, task=None, **kwargs):
+    _task_tokens[task_id] = _current.set(Tracker(task.name))
+
+
+def _finish_task(task_id=None, task=None, state=None, **kwargs):
+    token = _task_tokens.pop(task_id, None)
+    if token is None:
+        return
+    tracker = token.var.get()
+    _current.reset(token)
+    labels = (('task', task.name),)
+    finish(tracker, 'celery_task', labels)
+    registry.inc('librar_celery_tasks_total', labels + (('state', state or 'UNKNOWN'),))
+
+
+def init_metrics(app, db, config=METRICS_CONFIG):
+    """Instrument Flask requests, Celery tasks and every engine of db. A no-op when disabled."""
+    if not config['enabled']:
+        return False
+    from celery.signals import task_prerun, task_postrun
+
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_engine(engine)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_discard_request)
+    task_prerun.connect(_start_task, weak=False)
+    task_postrun.connect(_finish_task, weak=False)
+    return True
@@ -0,0 +1,180 @@
+import sys
+from datetime import datetime
+from sqlalchemy import text
+from search import create_search_index
+from loans import create_loan_guards
+from etags import create_table_versions
+from circulation import create_circulation_rollups
+from archive import rebuild_request_history
+
+
+MIGRATION_1_INDEXES = (
+    'ix_book_section_id', 'ix_book_user_id', 'ix_book_section_issued', 'ix_feedback_book_id',
+    'ix_request_user_status', 'ix_request_book_user_status', 'ix_request_status_return_date',
+    'ix_request_status_issue_date',
+)
+
+
+def _create_model_indexes(connection):
+    from model import Book, Feedback, Request
+    for model in (Book, Feedback, Request):
+        for index in model.__table__.indexes:
+            if index.name in MIGRATION_1_INDEXES:
+                index.create(connection, checkfirst=True)
+
+
+STATS_COUNTER_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS trg_section_counter_insert AFTER INSERT ON section BEGIN
+        INSERT OR IGNORE INTO section_counter (section_id, books_total, books_issued) VALUES (NEW.id, 0, 0);
+        UPDATE library_counter SET value = value + 1 WHERE name = 'sections';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_section_counter_delete AFTER DELETE ON section BEGIN
+        DELETE FROM section_counter WHERE section_id = OLD.id;
+        UPDATE library_counter SET value = value - 1 WHERE name = 'sections';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_book_counter_insert AFTER INSERT ON book BEGIN
+        UPDATE section_counter SET books_total = books_total + 1,
+            books_issued = books_issued + (NEW.user_id IS NOT NULL) WHERE section_id = NEW.section_id;
+        UPDATE library_counter SET value = value + 1 WHERE name = 'books';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_book_counter_delete AFTER DELETE ON book BEGIN
+        UPDATE section_counter SET books_total = books_total - 1,
+            books_issued = books_issued - (OLD.user_id IS NOT NULL) WHERE section_id = OLD.section_id;
+        UPDATE library_counter SET value = value - 1 WHERE name = 'books';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_book_counter_update AFTER UPDATE OF section_id, user_id ON book BEGIN
+        UPDATE section_counter SET books_total = books_total - 1,
+            books_issued = books_issued - (OLD.user_id IS NOT NULL) WHERE section_id = OLD.section_id;
+        UPDATE section_counter SET books_total = books_total + 1,
+            books_issued = books_issued + (NEW.user_id IS NOT NULL) WHERE section_id = NEW.section_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_request_counter_insert AFTER INSERT ON request
+        WHEN NEW.status = 'accepted' BEGIN
+        UPDATE library_counter SET value = value + 1 WHERE name = 'requests_accepted';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_request_counter_delete AFTER DELETE ON request
+        WHEN OLD.status = 'accepted' BEGIN
+        UPDATE library_counter SET value = value - 1 WHERE name = 'requests_accepted';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_request_counter_update AFTER UPDATE OF status ON request
+        WHEN (OLD.status = 'accepted') != (NEW.status = 'accepted') BEGIN
+        UPDATE library_counter SET value = value + (NEW.status = 'accepted') - (OLD.status = 'accepted')
+            WHERE name = 'requests_accepted';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_user_counter_insert AFTER INSERT ON "user"
+        WHEN NEW.role IS NULL OR NEW.role != 'admin' BEGIN
+        UPDATE library_counter SET value = value + 1 WHERE name = 'users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_user_counter_delete AFTER DELETE ON "user"
+        WHEN OLD.role IS NULL OR OLD.role != 'admin' BEGIN
+        UPDATE library_counter SET value = value - 1 WHERE name = 'users';
+    END""",
+]
+
+
+def _create_stats_counters(connection):
+    from model import SectionCounter, LibraryCounter
+    from stats import reconcile_counters
+    SectionCounter.__table__.create(connection, checkfirst=True)
+    LibraryCounter.__table__.create(connection, checkfirst=True)
+    for statement in STATS_COUNTER_TRIGGERS:
+        connection.execute(text(statement))
+    reconcile_counters(connection)
+
+
+# Ordered list of (version, description, step). Steps receive a connection inside
+# the migration's transaction and must be safe to run against a database that
+# db.create_all() has just built from the current models.
+MIGRATIONS = [
+    (1, 'Indexes for request, book and feedback hot query predicates', _create_model_indexes),
+    (2, 'Section and library stats counters maintained by triggers', _create_stats_counters),
+    (3, 'FTS5 search index over book name, author and feedback', create_search_index),
+    (4, 'Unique active request per user and book, per-user active loan counter', create_loan_guards),
+    (5, 'updated_at columns and trigger-maintained table versions for ETags', create_table_versions),
+    (6, 'Request event log and daily circulation rollups, backfilled from existing requests', create_circulation_rollups),
+    (7, 'request_history keyed by its own id, with the archived request id in request_id', rebuild_request_history),
+]
+
+
+def current_version(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, description VARCHAR(255) NOT NULL, applied_at DATETIME NOT NULL)'
+    ))
+    return connection.execute(text('SELECT COALESCE(MAX(version), 0) FROM schema_version')).scalar()
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        version = current_version(connection)
+
+    applied = []
+    for migration_version, description, step in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(
+                text('INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': migration_version, 'd': description, 't': datetime.now()}
+            )
+        applied.append(migration_version)
+        print(f'Applied migration {migration_version}: {description}')
+    return applied
+
+
+# Each hot query must be answered with an index SEARCH on its table, never a full SCAN.
+HOT_QUERIES = [
+    ('request active count', 'request',
+     "SELECT count(*) FROM request WHERE user_id = :u AND status IN ('pending', 'accepted')"),
+    ('request duplicate check', 'request',
+     "SELECT id FROM request WHERE user_id = :u AND book_id = :b AND status IN ('pending', 'accepted')"),
+    ('return lookup', 'request',
+     "SELECT id FROM request WHERE book_id = :b AND user_id = :u AND status = 'accepted'"),
+    ('due reminders', 'request',
+     "SELECT id FROM request WHERE status = 'accepted' AND return_date <= :d"),
+    ('monthly issued', 'request',
+     "SELECT id FROM request WHERE status = 'accepted' AND issue_date >= :d"),
+    ('books per section', 'book',
+     'SELECT count(*) FROM book WHERE section_id = :s'),
+    ('issued books per section', 'book',
+     'SELECT count(*) FROM book WHERE section_id = :s AND user_id IS NOT NULL'),
+    ('books per user', 'book',
+     'SELECT id FROM book WHERE user_id = :u'),
+    ('feedback per book', 'feedback',
+     'SELECT id FROM feedback WHERE book_id = :b'),
+    ('archivable requests', 'request',
+     "SELECT id FROM request WHERE status IN ('returned', 'declined', 'revoked') AND return_date < :d"),
+    ('request history per user', 'request_history',
+     'SELECT id FROM request_history WHERE user_id = :u ORDER BY id'),
+]
+
+
+def explain_hot_queries(connection):
+    params = {'u': 1, 'b': 1, 's': 1, 'd': datetime.now()}
+    failures = []
+    for name, table, sql in HOT_QUERIES:
+        plan = [row[3] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql), params)]
+        print(f'{name}:')
+        for detail in plan:
+            print(f'    {detail}')
+        table_steps = [detail for detail in plan if detail.split(' ')[1:2] == [table]]
+        if not table_steps or any(not detail.startswith('SEARCH') for detail in table_steps):
+            failures.append(name)
+    return failures
+
+
+if __name__ == '__main__':
+    from factory import create_core_app
+    from model import db
+    app = create_core_app()
+    with app.app_context():
+        db.create_all()
+        migrate(db.engine)
+        if '--explain' in sys.argv:
+            with db.engine.connect() as connection:
+                failures = explain_hot_queries(connection)
+            if failures:
+                print('Queries not served by an index: ' + ', '.join(failures))
+                sys.exit(1)
+            print('All hot queries use an index')
@@ -1,13 +1,9 @@
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask
 from werkzeug.security import generate_password_hash
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///librar.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
+# Bound to an app by factory.create_core_app; importing the models sets up no engine.
+db = SQLAlchemy()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,6 +11,7 @@ class User(db.Model):
     password = db.Column(db.String(150), nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
     role = db.Column(db.String(150), default='user')
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     books = db.relationship('Book', backref='user', lazy=True)
     requests = db.relationship('Request', backref='user', lazy=True)
     feedbacks = db.relationship('Feedback', backref='user', lazy=True)
@@ -25,6 +22,7 @@ class User(db.Model):
 class Section(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), unique=True, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     books = db.relationship('Book', backref='section', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
@@ -38,10 +36,16 @@ class Book(db.Model):
     section_id = db.Column(db.Integer, db.ForeignKey('section.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     issue_date = db.Column(db.DateTime, default=datetime.now)
     return_date = db.Column(db.DateTime, default=lambda: datetime.now() + timedelta(weeks=1))
     feedbacks = db.relationship('Feedback', backref='book', lazy=True, cascade='all, delete-orphan')
-    
+
+    __table_args__ = (
+        db.Index('ix_book_section_id', 'section_id'),
+        db.Index('ix_book_user_id', 'user_id'),
+        db.Index('ix_book_section_issued', 'section_id', sqlite_where=db.text('user_id IS NOT NULL')),
+    )
     
     def __repr__(self):
         return f'<Book {self.name}>'
@@ -51,6 +55,11 @@ class Feedback(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
     content = db.Column(db.String(255), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_feedback_book_id', 'book_id'),
+    )
     
     def __repr__(self):
         return f'<Feedback {self.id} by User {self.user_id} on Book {self.book_id}>'
@@ -63,13 +72,217 @@ class Request(db.Model):
     return_date = db.Column(db.DateTime, default=lambda: datetime.now() + timedelta(weeks=1))
     status = db.Column(db.String(80),  default='pending', nullable=False)
     book = db.relationship('Book', backref='request', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_request_user_status', 'user_id', 'status'),
+        db.Index('ix_request_book_user_status', 'book_id', 'user_id', 'status'),
+        db.Index('ix_request_status_return_date', 'status', 'return_date'),
+        db.Index('ix_request_status_issue_date', 'status', 'issue_date'),
+        db.Index('uq_request_active_user_book', 'user_id', 'book_id', unique=True,
+                 sqlite_where=db.text("status IN ('pending', 'accepted')")),
+    )
     
     def __repr__(self):
         return f'<Request {self.id} by User {self.user_id} for Book {self.book_id}>'
 
-def init_db():
+class RequestHistory(db.Model):
+    # Finished requests moved out of request by archive.archive_requests. request.id has no
+    # AUTOINCREMENT, so SQLite can hand an archived id out again: request_id is not unique.
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    issue_date = db.Column(db.DateTime)
+    return_date = db.Column(db.DateTime)
+    status = db.Column(db.String(80), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_request_history_user_id', 'user_id', 'id'),
+        db.Index('ix_request_history_book_id', 'book_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<RequestHistory {self.id} of Request {self.request_id} by User {self.user_id} for Book {self.book_id}>'
+
+class SectionCounter(db.Model):
+    section_id = db.Column(db.Integer, primary_key=True)
+    books_total = db.Column(db.Integer, nullable=False, default=0)
+    books_issued = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<SectionCounter {self.section_id}>'
+
+class LibraryCounter(db.Model):
+    name = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<LibraryCounter {self.name}={self.value}>'
+
+class UserLoanCounter(db.Model):
+    user_id = db.Column(db.Integer, primary_key=True)
+    active = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<UserLoanCounter {self.user_id}={self.active}>'
+
+class TableVersion(db.Model):
+    name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<TableVersion {self.name}={self.version}>'
+
+class RequestEvent(db.Model):
+    # Written by triggers on request; AUTOINCREMENT so ids are never reused after the log is drained.
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, nullable=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    section_id = db.Column(db.Integer, nullable=True)
+    event = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f'<RequestEvent {self.event} for Request {self.request_id}>'
+
+class CirculationDaily(db.Model):
+    # Clustered on the key: range reads walk consecutive pages instead of looking up each row.
+    day = db.Column(db.Date, primary_key=True)
+    section_id = db.Column(db.Integer, primary_key=True)
+    requested = db.Column(db.Integer, nullable=False, default=0)
+    accepted = db.Column(db.Integer, nullable=False, default=0)
+    returned = db.Column(db.Integer, nullable=False, default=0)
+    revoked = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_circulation_daily_section_day', 'section_id', 'day'),
+        {'sqlite_with_rowid': False},
+    )
+
+    def __repr__(self):
+        return f'<CirculationDaily {self.day} Section {self.section_id}>'
+
+class BookCirculationDaily(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    book_id = db.Column(db.Integer, primary_key=True)
+    section_id = db.Column(db.Integer, nullable=True)
+    requested = db.Column(db.Integer, nullable=False, default=0)
+    accepted = db.Column(db.Integer, nullable=False, default=0)
+    returned = db.Column(db.Integer, nullable=False, default=0)
+    revoked = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_book_circulation_daily_book_day', 'book_id', 'day'),
+        {'sqlite_with_rowid': False},
+    )
+
+    def __repr__(self):
+        return f'<BookCirculationDaily {self.day} Book {self.book_id}>'
+
+class RollupWatermark(db.Model):
+    name = db.Column(db.String(80), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<RollupWatermark {self.name}={self.last_id}>'
+
+class ReportRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    period = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(80), default='running', nullable=False)
+    recipients = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('name', 'period', name='uq_report_run_name_period'),
+    )
+
+    def __repr__(self):
+        return f'<ReportRun {self.name} {self.period} {self.status}>'
+
+class EmailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(150), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(80), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.String(255), nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f'<EmailOutbox {self.id} to {self.to_email} {self.status}>'
+
+class ReminderLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), nullable=False)
+    threshold = db.Column(db.String(20), nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    sent_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('request_id', 'threshold', 'due_date', name='uq_reminder_log_request_threshold_due'),
+    )
+
+    def __repr__(self):
+        return f'<ReminderLog {self.threshold} for Request {self.request_id}>'
+
+class ExportJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    format = db.Column(db.String(20), default='csv', nullable=False)
+    gzip = db.Column(db.Boolean, default=False, nullable=False)
+    status = db.Column(db.String(80), default='queued', nullable=False)
+    rows = db.Column(db.Integer, default=0, nullable=False)
+    path = db.Column(db.String(255), nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<ExportJob {self.id} {self.status}>'
+
+class BookFile(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    media_type = db.Column(db.String(80), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)
+    status = db.Column(db.String(80), default='uploading', nullable=False)
+    # Set while one request is writing a chunk, so concurrent chunks for the same upload cannot interleave.
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_book_file_book_status', 'book_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f'<BookFile {self.id} for Book {self.book_id} {self.status}>'
+
+def init_db(app=None):
+    if app is None:
+        from factory import create_core_app
+        app = create_core_app()
     with app.app_context():
         db.create_all()
+        from migrations import migrate
+        migrate(db.engine)
         if User.query.filter_by(username='librarian').first() is None and User.query.filter_by(email='librarian@librar.com').first() is None:
             admin_password = generate_password_hash('librar')
             admin = User(username='librarian', email='librarian@librar.com', password=admin_password, role='admin')
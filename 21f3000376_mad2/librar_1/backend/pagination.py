@@ -0,0 +1,111 @@
+import base64
+import json
+from datetime import datetime, timedelta
+from flask import request
+from sqlalchemy import DateTime, tuple_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, key_columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(key_columns):
+        raise PaginationError('Invalid cursor')
+    try:
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                for column, value in zip(key_columns, values)]
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+
+def parse_date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise PaginationError(f'{name} must be a date in YYYY-MM-DD format')
+
+
+def int_arg(name):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be an integer')
+
+
+def id_list_arg(name):
+    value = request.args.get(name, '')
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise PaginationError(f'{name} must be a comma separated list of integers')
+
+
+def filter_date_range(query, column, prefix):
+    # ?<prefix>_from=YYYY-MM-DD is inclusive, ?<prefix>_to=YYYY-MM-DD includes the whole day
+    start = request.args.get(f'{prefix}_from')
+    end = request.args.get(f'{prefix}_to')
+    if start:
+        query = query.filter(column >= parse_date(start, f'{prefix}_from'))
+    if end:
+        query = query.filter(column < parse_date(end, f'{prefix}_to') + timedelta(days=1))
+    return query
+
+
+def paginate(query, key_columns):
+    """Keyset pagination driven by ?limit= and ?cursor=.
+
+    Returns (rows, next_cursor). Responses are always bounded: without ?limit=
+    a page holds DEFAULT_LIMIT rows, and next_cursor is None on the last page.
+    """
+    limit = int_arg('limit')
+    cursor = request.args.get('cursor')
+    query = query.order_by(*key_columns)
+    limit = min(max(limit or DEFAULT_LIMIT, 1), MAX_LIMIT)
+    if cursor:
+        query = query.filter(tuple_(*key_columns) > tuple_(*decode_cursor(cursor, key_columns)))
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([_key_value(rows[-1], column) for column in key_columns])
+
+
+def offset_page():
+    """(limit, offset) for result sets without a stable key, such as ranked search hits.
+
+    Uses the same ?limit= and opaque ?cursor= contract as paginate().
+    """
+    limit = min(max(int_arg('limit') or DEFAULT_LIMIT, 1), MAX_LIMIT)
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return limit, 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))[0]
+    except (ValueError, TypeError, IndexError, KeyError):
+        raise PaginationError('Invalid cursor')
+    if not isinstance(offset, int) or offset < 0:
+        raise PaginationError('Invalid cursor')
+    return limit, offset
+
+
+def _key_value(row, column):
+    if hasattr(row, '_mapping'):
+        return row._mapping[column]
+    return getattr(row, column.key)
@@ -0,0 +1,97 @@
+import re
+import sys
+from sqlalchemy import text
+
+# book_search holds one row per book (rowid = book.id) with the book's name, author
+# and the concatenated content of its feedback. Triggers keep it in sync.
+SEARCH_TABLE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5("
+    "name, author, feedback, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+FEEDBACK_TEXT = "(SELECT COALESCE(group_concat(content, ' '), '') FROM feedback WHERE book_id = {book})"
+
+SEARCH_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS trg_book_search_insert AFTER INSERT ON book BEGIN
+        INSERT INTO book_search (rowid, name, author, feedback)
+            VALUES (NEW.id, NEW.name, COALESCE(NEW.author, ''), '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_book_search_update AFTER UPDATE OF name, author ON book BEGIN
+        UPDATE book_search SET name = NEW.name, author = COALESCE(NEW.author, '') WHERE rowid = NEW.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_book_search_delete AFTER DELETE ON book BEGIN
+        DELETE FROM book_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_feedback_search_insert AFTER INSERT ON feedback BEGIN
+        UPDATE book_search SET feedback = %s WHERE rowid = NEW.book_id;
+    END""" % FEEDBACK_TEXT.format(book='NEW.book_id'),
+    """CREATE TRIGGER IF NOT EXISTS trg_feedback_search_update AFTER UPDATE OF content, book_id ON feedback BEGIN
+        UPDATE book_search SET feedback = %s WHERE rowid = OLD.book_id;
+        UPDATE book_search SET feedback = %s WHERE rowid = NEW.book_id;
+    END""" % (FEEDBACK_TEXT.format(book='OLD.book_id'), FEEDBACK_TEXT.format(book='NEW.book_id')),
+    """CREATE TRIGGER IF NOT EXISTS trg_feedback_search_delete AFTER DELETE ON feedback BEGIN
+        UPDATE book_search SET feedback = %s WHERE rowid = OLD.book_id;
+    END""" % FEEDBACK_TEXT.format(book='OLD.book_id'),
+]
+
+# bm25 column weights: a match in the title counts most, then author, then feedback.
+SEARCH_SQL = """
+    SELECT book.id, book.name, book.author, book.section_id, section.name,
+           bm25(book_search, 10.0, 5.0, 1.0) AS rank
+    FROM book_search
+    JOIN book ON book.id = book_search.rowid
+    JOIN section ON section.id = book.section_id
+    WHERE book_search MATCH :match {section_filter}
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def create_search_index(connection):
+    connection.execute(text(SEARCH_TABLE_DDL))
+    for statement in SEARCH_TRIGGERS:
+        connection.execute(text(statement))
+    rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    connection.execute(text('DELETE FROM book_search'))
+    connection.execute(text(
+        'INSERT INTO book_search (rowid, name, author, feedback) '
+        'SELECT book.id, book.name, COALESCE(book.author, \'\'), COALESCE(fb.content, \'\') FROM book '
+        'LEFT JOIN (SELECT book_id, group_concat(content, \' \') AS content FROM feedback GROUP BY book_id) fb '
+        'ON fb.book_id = book.id'
+    ))
+    connection.execute(text("INSERT INTO book_search (book_search) VALUES ('optimize')"))
+
+
+def match_expression(query):
+    # Every word must match, each as a prefix; quoting keeps FTS5 operators in user input literal.
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_books(session, query, section_id=None, limit=20, offset=0):
+    match = match_expression(query)
+    if not match:
+        return []
+    params = {'match': match, 'limit': limit, 'offset': offset}
+    section_filter = ''
+    if section_id is not None:
+        section_filter = 'AND book.section_id = :section_id'
+        params['section_id'] = section_id
+    return session.execute(text(SEARCH_SQL.format(section_filter=section_filter)), params).all()
+
+
+if __name__ == '__main__':
+    from factory import create_core_app
+    from model import db
+    app = create_core_app()
+    if '--rebuild' in sys.argv:
+        with app.app_context():
+            with db.engine.begin() as connection:
+                rebuild_search_index(connection)
+                count = connection.execute(text('SELECT count(*) FROM book_search')).scalar()
+        print(f'Search index rebuilt with {count} books')
+    else:
+        print('usage: python search.py --rebuild')
@@ -0,0 +1,161 @@
+import json
+from flask import current_app, request
+from sqlalchemy import func
+from model import User, Section, Book, Feedback, Request, RequestHistory
+from pagination import PaginationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), default=lambda value: value.isoformat()).encode()
+
+
+def json_response(data, status=200, headers=None):
+    return current_app.response_class(dumps(data), status=status, headers=headers, mimetype='application/json')
+
+
+def paginated_response(data, next_cursor):
+    response = json_response(data)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def as_date(column):
+    # SQLite formats the stored timestamp, so rows arrive as ready-to-send strings.
+    return func.strftime('%Y-%m-%d', column)
+
+
+def as_datetime(column):
+    return func.strftime('%Y-%m-%d %H:%M:%S', column)
+
+
+class Schema:
+    """Declarative mapping from output keys to column expressions.
+
+    A field is a column expression or a nested Schema. plan() returns the columns to
+    select and a function turning each result row into the output dict, so resources
+    query plain tuples instead of hydrating ORM objects.
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def plan(self, only=None, extra=()):
+        names = [name for name in self.fields if only is None or name in only]
+        columns, parts = [], []
+        for name in names:
+            field = self.fields[name]
+            if isinstance(field, Schema):
+                nested_columns, nested_make = field.plan()
+                parts.append((name, len(columns), len(columns) + len(nested_columns), nested_make))
+                columns.extend(nested_columns)
+            else:
+                parts.append((name, len(columns), None, None))
+                columns.append(field)
+        # Extra columns (such as pagination keys) are selected after the fields and left out of the output.
+        columns.extend(extra)
+
+        if all(end is None for _, _, end, _ in parts):
+            return columns, lambda row: dict(zip(names, row))
+
+        def make(row):
+            return {
+                name: row[start] if end is None else nested_make(row[start:end])
+                for name, start, end, nested_make in parts
+            }
+        return columns, make
+
+    def fields_arg(self, name='fields'):
+        """Top-level fields requested with ?fields=a,b (sparse fieldsets), or None for all."""
+        value = request.args.get(name)
+        if not value:
+            return None
+        only = {item.strip() for item in value.split(',') if item.strip()}
+        unknown = only - set(self.fields)
+        if unknown:
+            raise PaginationError(f"unknown fields: {', '.join(sorted(unknown))}")
+        return only
+
+    def rows(self, session, only=None, extra=()):
+        """(query, make) for a column-only query of this schema."""
+        columns, make = self.plan(only, extra)
+        return session.query(*columns), make
+
+
+USER_SCHEMA = Schema(
+    id=User.id,
+    username=User.username,
+    role=User.role
+)
+
+BOOK_SCHEMA = Schema(
+    id=Book.id,
+    name=Book.name,
+    author=Book.author,
+    content=Book.content,
+    section_id=Book.section_id,
+    user_id=Book.user_id,
+    created_at=as_datetime(Book.created_at),
+    issue_date=as_date(Book.issue_date),
+    return_date=as_date(Book.return_date)
+)
+
+SECTION_BOOK_SCHEMA = Schema(
+    id=Book.id,
+    name=Book.name,
+    author=Book.author,
+    content=Book.content,
+    issue_date=as_date(Book.issue_date),
+    return_date=as_date(Book.return_date)
+)
+
+# Request rows select from request joined to book, section and user.
+REQUEST_SCHEMA = Schema(
+    id=Request.id,
+    user_id=Request.user_id,
+    book_id=Request.book_id,
+    book_name=Book.name,
+    book_author=Book.author,
+    issue_date=as_date(Request.issue_date),
+    return_date=as_date(Request.return_date),
+    status=Request.status,
+    book=Schema(
+        content=Book.content,
+        section_id=Book.section_id,
+        section_name=Section.name
+    ),
+    user=Schema(
+        username=User.username,
+        email=User.email
+    )
+)
+
+# Archived rows select from request_history outer-joined to book, which may since have been deleted.
+REQUEST_HISTORY_SCHEMA = Schema(
+    id=RequestHistory.id,
+    request_id=RequestHistory.request_id,
+    user_id=RequestHistory.user_id,
+    book_id=RequestHistory.book_id,
+    book_name=Book.name,
+    book_author=Book.author,
+    issue_date=as_date(RequestHistory.issue_date),
+    return_date=as_date(RequestHistory.return_date),
+    status=RequestHistory.status,
+    archived_at=as_datetime(RequestHistory.archived_at)
+)
+
+# Feedback rows select from feedback joined to user.
+FEEDBACK_SCHEMA = Schema(
+    id=Feedback.id,
+    user_id=Feedback.user_id,
+    book_id=Feedback.book_id,
+    content=Feedback.content,
+    user=Schema(username=User.username)
+)
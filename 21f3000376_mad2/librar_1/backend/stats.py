@@ -0,0 +1,82 @@
+from sqlalchemy import func, select
+from database import read_session
+from model import User, Section, Book, Request, SectionCounter, LibraryCounter
+
+LIBRARY_COUNTERS = ('books', 'sections', 'requests_accepted', 'users')
+
+
+def section_book_counts():
+    """Per-section (name, books_total, books_issued) from one grouped aggregate."""
+    return read_session.query(
+        Section.name, func.count(Book.id), func.count(Book.user_id)
+    ).outerjoin(Book, Book.section_id == Section.id).group_by(Section.id).order_by(Section.id).all()
+
+
+def section_book_counts_from_counters():
+    return read_session.query(
+        Section.name,
+        func.coalesce(SectionCounter.books_total, 0),
+        func.coalesce(SectionCounter.books_issued, 0)
+    ).outerjoin(SectionCounter, SectionCounter.section_id == Section.id).order_by(Section.id).all()
+
+
+def _library_totals_query():
+    return select(
+        select(func.count(Book.id)).scalar_subquery(),
+        select(func.count(Section.id)).scalar_subquery(),
+        select(func.count(Request.id)).where(Request.status == 'accepted').scalar_subquery(),
+        select(func.count(User.id)).where(User.role != 'admin').scalar_subquery(),
+    )
+
+
+def library_totals():
+    return dict(zip(LIBRARY_COUNTERS, read_session.execute(_library_totals_query()).one()))
+
+
+def library_totals_from_counters():
+    totals = dict.fromkeys(LIBRARY_COUNTERS, 0)
+    totals.update(read_session.query(LibraryCounter.name, LibraryCounter.value).all())
+    return totals
+
+
+def reconcile_counters(connection):
+    """Rebuild the counter tables from the source tables and report any drift.
+
+    Runs on a plain connection so it can be used both from a migration and from
+    the scheduled reconciliation task.
+    """
+    drift = []
+
+    expected = {
+        row[0]: (row[1], row[2]) for row in connection.execute(
+            select(Section.id, func.count(Book.id), func.count(Book.user_id))
+            .outerjoin(Book, Book.section_id == Section.id).group_by(Section.id)
+        )
+    }
+    stored = {
+        row[0]: (row[1], row[2]) for row in connection.execute(
+            select(SectionCounter.section_id, SectionCounter.books_total, SectionCounter.books_issued)
+        )
+    }
+    for section_id in expected.keys() | stored.keys():
+        if expected.get(section_id) != stored.get(section_id):
+            drift.append({'counter': f'section:{section_id}', 'expected': expected.get(section_id), 'stored': stored.get(section_id)})
+
+    library_expected = dict(zip(LIBRARY_COUNTERS, connection.execute(_library_totals_query()).one()))
+    library_stored = dict(connection.execute(select(LibraryCounter.name, LibraryCounter.value)).all())
+    for name in LIBRARY_COUNTERS:
+        if library_expected[name] != library_stored.get(name):
+            drift.append({'counter': name, 'expected': library_expected[name], 'stored': library_stored.get(name)})
+
+    if drift:
+        connection.execute(SectionCounter.__table__.delete())
+        if expected:
+            connection.execute(SectionCounter.__table__.insert(), [
+                {'section_id': section_id, 'books_total': total, 'books_issued': issued}
+                for section_id, (total, issued) in expected.items()
+            ])
+        connection.execute(LibraryCounter.__table__.delete())
+        connection.execute(LibraryCounter.__table__.insert(), [
+            {'name': name, 'value': value} for name, value in library_expected.items()
+        ])
+    return drift
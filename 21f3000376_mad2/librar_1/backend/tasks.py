@@ -2,115 +2,434 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
-from io import StringIO
+import time
+import gzip
+import json
 from datetime import datetime, timedelta
+from flask import current_app
 from celery_config import celery
-from app import app
-from model import db, User, Section, Book, Request
+from itertools import groupby
+from celery import chord
+from sqlalchemy import and_, case, func, select, update
+from sqlalchemy.exc import IntegrityError
+from model import db, User, Section, Book, Request, ReportRun, EmailOutbox, ReminderLog, ExportJob
+from stats import reconcile_counters
+from loans import revoke_overdue_loans, OVERDUE_BATCH_SIZE
+from circulation import roll_up_circulation, ROLLUP_BATCH_SIZE
+from archive import archive_requests, ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_BATCHES
 import csv
 
+REPORT_CHUNK_SIZE = 500
+
+
+def month_bounds(start):
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def previous_month():
+    start_of_this_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return month_bounds((start_of_this_month - timedelta(days=1)).replace(day=1))
+
+
 @celery.task
 def generate_monthly_report():
-    with app.app_context():
-        current_month = datetime.now().strftime('%B')
-        current_year = datetime.now().year
-        start_of_month = datetime.now().replace(day=1)
-
-        users = User.query.filter(User.role != 'librarian').all()
-        for user in users:
-            requests_accepted = Request.query.filter(Request.user_id == user.id, Request.issue_date >= start_of_month, Request.status == 'accepted').all()
-            books_list = ""
-            if requests_accepted:
-                for request in requests_accepted:
-                    book = Book.query.filter_by(id=request.book_id).first()
-                    if book:
-                        books_list += f"<li>{book.name} by {book.author}, Issued on: {request.issue_date.strftime('%Y-%m-%d')}, Return Date: {request.return_date.strftime('%Y-%m-%d')}</li>"
-            else:
-                books_list = "<li>No books issued this month.</li>"
-            
-            html_content = f"""
+    start, end = previous_month()
+    period = start.strftime('%Y-%m')
+
+    run_id = claim_report_run('monthly_report', period)
+    if run_id is None:
+        print(f"Monthly Activity Report for {period} already generated")
+        return
+
+    try:
+        user_ids = db.session.execute(
+            select(User.id).where(User.role != 'admin').order_by(User.id)
+        ).yield_per(REPORT_CHUNK_SIZE)
+        chunks = [
+            send_monthly_report_chunk.s(period, partition[0].id, partition[-1].id)
+            for partition in user_ids.partitions(REPORT_CHUNK_SIZE)
+        ]
+
+        if not chunks:
+            finish_monthly_report([], run_id)
+            return
+        chord(chunks)(finish_monthly_report.s(run_id))
+    except Exception:
+        # Without this the month would keep a 'running' claim that no retry could take over.
+        db.session.rollback()
+        db.session.execute(update(ReportRun).where(ReportRun.id == run_id).values(status='failed', finished_at=datetime.now()))
+        db.session.commit()
+        print(f"Monthly Activity Report for {period} failed to fan out; the next run will retry it")
+        raise
+    print(f"Monthly Activity Report for {period} fanned out in {len(chunks)} chunks")
+
+
+def claim_report_run(name, period):
+    """Claim a report period and return the run id, or None when it is already running or done.
+
+    The ledger row is the claim: a second run for the same period fails on the unique
+    constraint, unless the earlier run failed, in which case it is taken over.
+    """
+    run = ReportRun(name=name, period=period)
+    db.session.add(run)
+    try:
+        db.session.commit()
+        return run.id
+    except IntegrityError:
+        db.session.rollback()
+    run_id = db.session.execute(
+        update(ReportRun).where(ReportRun.name == name, ReportRun.period == period, ReportRun.status == 'failed')
+        .values(status='running', recipients=0, created_at=datetime.now(), finished_at=None)
+        .returning(ReportRun.id)
+    ).scalar()
+    db.session.commit()
+    return run_id
+
+
+@celery.task
+def send_monthly_report_chunk(period, first_user_id, last_user_id):
+    start, end = month_bounds(datetime.strptime(period, '%Y-%m'))
+
+    rows = db.session.query(
+        User.id, User.username, User.email, Book.name, Book.author, Request.issue_date, Request.return_date
+    ).outerjoin(Request, and_(
+        Request.user_id == User.id,
+        Request.status == 'accepted',
+        Request.issue_date >= start,
+        Request.issue_date < end
+    )).outerjoin(Book, Book.id == Request.book_id).filter(
+        User.role != 'admin', User.id.between(first_user_id, last_user_id)
+    ).order_by(User.id, Request.issue_date).yield_per(REPORT_CHUNK_SIZE)
+
+    sent = 0
+    for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+        user_rows = list(user_rows)
+        username, email = user_rows[0][1], user_rows[0][2]
+        books_list = "".join(
+            f"<li>{name} by {author}, Issued on: {issue_date.strftime('%Y-%m-%d')}, Return Date: {return_date.strftime('%Y-%m-%d')}</li>"
+            for _, _, _, name, author, issue_date, return_date in user_rows if name is not None
+        ) or "<li>No books issued this month.</li>"
+
+        html_content = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Monthly Activity Report</title>
+        </head>
+        <body>
+            <p>Dear {username},</p>
+            <p>Here is your monthly activity report for {start.strftime('%B')}, {start.year}:</p>
+            <ul>
+                {books_list}
+            </ul>
+        </body>
+        </html>"""
+        print(f"Sending Monthly Activity Report to {email}")
+        send_email(email, html_content, "Monthly Activity Report")
+        sent += 1
+    db.session.commit()
+    return sent
+
+
+@celery.task
+def finish_monthly_report(sent_counts, run_id):
+    run = db.session.get(ReportRun, run_id)
+    run.status = 'sent'
+    run.recipients = sum(sent_counts)
+    run.finished_at = datetime.now()
+    db.session.commit()
+    print(f"Monthly Activity Report for {run.period} sent to {run.recipients} users")
+
+REMINDER_BATCH_SIZE = 500
+
+
+def reminder_threshold(today):
+    # Overdue (within OVERDUE_GRACE_DAYS, after which the loan is revoked), due today or tomorrow,
+    # or due within the week; each is sent once per due date.
+    return case(
+        (Request.return_date < today, 'overdue'),
+        (Request.return_date < today + timedelta(days=2), '1d'),
+        else_='7d'
+    )
+
+
+@celery.task
+def daily_reminders():
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    grace = timedelta(days=current_app.config['OVERDUE_GRACE_DAYS'])
+    threshold = reminder_threshold(today)
+    due_date = func.date(Request.return_date)
+    already_sent = select(ReminderLog.id).where(
+        ReminderLog.request_id == Request.id,
+        ReminderLog.threshold == threshold,
+        ReminderLog.due_date == due_date
+    ).exists()
+
+    sent = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(
+            Request.id, Request.return_date, threshold, User.username, User.email, Book.name
+        ).join(User, User.id == Request.user_id).join(Book, Book.id == Request.book_id).filter(
+            Request.status == 'accepted',
+            Request.return_date < today + timedelta(days=8),
+            Request.id > last_id,
+            ~already_sent
+        ).order_by(Request.id).limit(REMINDER_BATCH_SIZE).all()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        for request_id, return_date, request_threshold, username, email, book_name in batch:
+            overdue_note = ''
+            if request_threshold == 'overdue':
+                overdue_note = f"<p>It is overdue and will be revoked after {(return_date + grace).strftime('%Y-%m-%d %H:%M')}.</p>"
+            reminder_content = f"""
             <!DOCTYPE html>
             <html>
             <head>
-                <title>Monthly Activity Report</title>
+                <title>Book Return Reminder</title>
             </head>
             <body>
-                <p>Dear {user.username},</p>
-                <p>Here is your monthly activity report for {current_month}, {current_year}:</p>
-                <ul>
-                    {books_list}
-                </ul>
+                <h3>Dear {username},</h3>
+                <p>This is a reminder to return the book titled '{book_name}' which is due for return on {return_date.strftime('%Y-%m-%d')}.</p>
+                {overdue_note}
+                <p>Please visit the library app to return the book.</p>
             </body>
-            </html>"""
-            print(f"Sending Monthly Activity Report to {user.email}")
-            send_email(user.email, html_content, "Monthly Activity Report")
+            </html>
+            """
+            db.session.add(ReminderLog(request_id=request_id, threshold=request_threshold, due_date=return_date.date()))
+            send_email(email, reminder_content, "Book Return Reminder")
+
+        # The log rows and the queued mail commit together, so a reminder is queued exactly once.
+        try:
+            db.session.commit()
+            sent += len(batch)
+        except IntegrityError:
+            db.session.rollback()
+            print("Reminder batch already sent by a concurrent run, skipping")
+    print(f"Daily Reminders Task queued {sent} reminders")
+    return sent
 
 @celery.task
-def daily_reminders():
-    with app.app_context():
-        today = datetime.now().date()
-        print(Request.query.filter(Request.return_date <= today + timedelta(days=8)).all())
-        print("Daily Reminders Task")
-        
-        for request in Request.query.filter(Request.return_date <= today + timedelta(days=8)).all():
-            user = request.user
-            print(request.status)
-            
-            if request.status == 'accepted':
-                reminder_content = f"""
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>Book Return Reminder</title>
-                </head>
-                <body>
-                    <h3>Dear {user.username},</h3>
-                    <p>This is a reminder to return the book titled '{request.book.name}' which is due for return on {request.return_date.strftime('%Y-%m-%d')}.</p>
-                    <p>Please visit the library app to return the book.</p>
-                </body>
-                </html>
-                """
-                send_email(user.email, reminder_content, "Book Return Reminder")
+def reconcile_stats_counters():
+    with db.engine.begin() as connection:
+        drift = reconcile_counters(connection)
+    for entry in drift:
+        print(f"Stats counter drift on {entry['counter']}: stored {entry['stored']}, expected {entry['expected']}")
+    print(f"Stats counters reconciled, {len(drift)} drifted")
+    return drift
+
+
+@celery.task
+def revoke_overdue_loans_task(dry_run=False, batch_size=OVERDUE_BATCH_SIZE):
+    result = revoke_overdue_loans(db.session, grace_days=current_app.config['OVERDUE_GRACE_DAYS'],
+                                  batch_size=batch_size, dry_run=dry_run)
+    if dry_run:
+        print(f"Overdue loans (dry run): {result['overdue']} would be revoked, oldest due {result['oldest_return_date']}")
+    else:
+        print(f"Overdue loans: revoked {result['revoked']} in {result['batches']} batches")
+    return result
+
+
+@celery.task
+def roll_up_circulation_task(batch_size=ROLLUP_BATCH_SIZE):
+    consumed = roll_up_circulation(db.session, batch_size=batch_size)
+    print(f"Circulation rollup consumed {consumed} request events")
+    return consumed
+
+
+@celery.task
+def archive_finished_requests(dry_run=False, batch_size=ARCHIVE_BATCH_SIZE, max_batches=ARCHIVE_MAX_BATCHES):
+    result = archive_requests(db.session, current_app.config['ARCHIVE_AFTER_DAYS'], batch_size=batch_size,
+                              max_batches=max_batches, dry_run=dry_run)
+    if dry_run:
+        print(f"Archive (dry run): {result['archivable']} finished requests due before {result['cutoff']}")
+    else:
+        print(f"Archived {result['archived']} finished requests in {result['batches']} batches")
+    return result
+
+FROM_EMAIL = 'librar@gmail.com'
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 1025))
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_SECONDS = 30
+# A claimed batch is leased for this long; a worker that dies mid-batch leaves it to be claimed again.
+OUTBOX_CLAIM_SECONDS = 600
+
 
 def send_email(to_email, html_content, subject):
-    from_email = 'librar@gmail.com'
+    # Queued in the caller's transaction; dispatch_email_outbox delivers it.
+    db.session.add(EmailOutbox(to_email=to_email, subject=subject, html_content=html_content))
+
+
+class SmtpConnection:
+    """One SMTP session per worker process, reused across batches and reopened when dropped."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def get(self):
+        # No NOOP probe per message: a dead connection shows up as a failed send instead.
+        if self.server is None:
+            self.server = smtplib.SMTP(self.host, self.port, timeout=30)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def send(self, from_email, to_email, message):
+        if self.server is not None:
+            try:
+                self.server.sendmail(from_email, to_email, message)
+                return
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # The server dropped the reused connection; reconnect once and resend.
+                self.close()
+        self.get().sendmail(from_email, to_email, message)
+
+
+smtp_connection = SmtpConnection(SMTP_HOST, SMTP_PORT)
+
+
+def build_message(to_email, html_content, subject):
     msg = MIMEMultipart('alternative')
-    msg['From'] = from_email
+    msg['From'] = FROM_EMAIL
     msg['To'] = to_email
     msg['Subject'] = subject
+    msg.attach(MIMEText(html_content, 'html'))
+    return msg.as_string()
 
-    part1 = MIMEText(html_content, 'html')
-    msg.attach(part1)
 
-    smtp_server = 'localhost'
-    smtp_port = 1025
+def claim_outbox_batch(batch_size, now):
+    """Mark up to batch_size due emails 'sending' and return them, in one statement.
+
+    next_attempt_at doubles as the claim's expiry, so overlapping runs never pick
+    the same row and a 'sending' row left behind by a dead worker is released
+    once its lease runs out.
+    """
+    due = select(EmailOutbox.id).where(
+        EmailOutbox.status.in_(('pending', 'sending')), EmailOutbox.next_attempt_at <= now
+    ).order_by(EmailOutbox.id).limit(batch_size)
+    emails = db.session.execute(
+        update(EmailOutbox).where(EmailOutbox.id.in_(due))
+        .values(status='sending', next_attempt_at=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS))
+        .returning(EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.subject, EmailOutbox.html_content,
+                   EmailOutbox.attempts, EmailOutbox.last_error)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    return sorted(emails)
 
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        print(f"Email sent to {to_email} with subject: {subject}")
-        server.sendmail(from_email, to_email, msg.as_string())
 
 @celery.task
-def export_sections_details_as_csv(created_user_id):
-    sections = Section.query.all()
-
-    csv_buffer = StringIO()
-    csv_writer = csv.writer(csv_buffer)
-    
-    csv_writer.writerow(['Section Name', 'Book Name', 'Author', 'Create Date'])
-
-    for section in sections:
-        books = Book.query.filter_by(section_id=section.id).all()
-        for book in books:
-            csv_writer.writerow([
-                section.name,
-                book.name,
-                book.author,
-                book.issue_date.strftime('%Y-%m-%d') if book.issue_date else '',
-            ])
-
-    base_dir = os.path.abspath(os.path.dirname(__name__))
-    csv_file_path = os.path.join(base_dir, 'csv/section_report.csv')
-    with open(csv_file_path, 'w') as csv_file:
-        csv_file.write(csv_buffer.getvalue())
-
-    return csv_buffer.getvalue()
+def dispatch_email_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    started = time.monotonic()
+    sent = failed = 0
+    unreachable = False
+    while not unreachable:
+        now = datetime.now()
+        emails = claim_outbox_batch(batch_size, now)
+        if not emails:
+            break
+
+        changes = []
+        for email in emails:
+            change = {'id': email.id, 'status': 'pending', 'attempts': email.attempts, 'last_error': email.last_error,
+                      'next_attempt_at': now, 'sent_at': None}
+            changes.append(change)
+            if unreachable:
+                # Hand the rest of the batch back untouched rather than retrying the connect for each.
+                continue
+            try:
+                smtp_connection.send(FROM_EMAIL, email.to_email, build_message(email.to_email, email.html_content, email.subject))
+            except (smtplib.SMTPException, OSError) as e:
+                unreachable = isinstance(e, (OSError, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected))
+                change.update(attempts=email.attempts + 1, last_error=str(e)[:255])
+                if change['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                    change['status'] = 'failed'
+                else:
+                    change['next_attempt_at'] = now + timedelta(seconds=OUTBOX_BACKOFF_SECONDS * 2 ** email.attempts)
+                failed += 1
+            else:
+                change.update(status='sent', sent_at=datetime.now())
+                sent += 1
+        db.session.execute(update(EmailOutbox), changes)
+        db.session.commit()
+
+    elapsed = time.monotonic() - started
+    if unreachable:
+        print("Email outbox: SMTP server unreachable, leaving the rest for the next run")
+    if sent or failed:
+        print(f"Email outbox: {sent} sent, {failed} failed in {elapsed:.2f}s ({sent / elapsed if elapsed else 0:.1f} msg/s)")
+    return {'sent': sent, 'failed': failed, 'seconds': elapsed}
+
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csv', 'exports')
+EXPORT_FIELDS = ['Section Name', 'Book Name', 'Author', 'Create Date']
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_file_name(job):
+    return f"section_report_{job.id}.{job.format}" + ('.gz' if job.gzip else '')
+
+
+@celery.task
+def export_sections_details(job_id):
+    job = db.session.get(ExportJob, job_id)
+    job.status = 'running'
+    db.session.commit()
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, export_file_name(job))
+    partial_path = path + '.part'
+    rows = db.session.execute(
+        select(Section.name, Book.name, Book.author, Book.issue_date)
+        .join(Book, Book.section_id == Section.id).order_by(Section.id, Book.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    written = 0
+    try:
+        opener = gzip.open if job.gzip else open
+        with opener(partial_path, 'wt', newline='') as export_file:
+            if job.format == 'jsonl':
+                for row in rows:
+                    values = row[:3] + (row[3].strftime('%Y-%m-%d') if row[3] else '',)
+                    export_file.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + '\n')
+                    written += 1
+            else:
+                csv_writer = csv.writer(export_file)
+                csv_writer.writerow(EXPORT_FIELDS)
+                for section_name, book_name, author, issue_date in rows:
+                    csv_writer.writerow([
+                        section_name,
+                        book_name,
+                        author,
+                        issue_date.strftime('%Y-%m-%d') if issue_date else '',
+                    ])
+                    written += 1
+        os.replace(partial_path, path)
+    except Exception as e:
+        rows.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        job.status = 'failed'
+        job.error = str(e)[:255]
+        job.finished_at = datetime.now()
+        db.session.commit()
+        raise
+
+    job.status = 'done'
+    job.rows = written
+    job.path = path
+    job.finished_at = datetime.now()
+    db.session.commit()
+    return written
@@ -0,0 +1,7 @@
+import axios from 'axios';
+
+// One page of a keyset-paginated list; next is the cursor for the following page, or null after the last one.
+export async function fetchPage(url, params) {
+  const response = await axios.get(url, { params });
+  return { items: response.data, next: response.headers['x-next-cursor'] || null };
+}
@@ -0,0 +1,51 @@
+import axios from 'axios';
+import { fetchPage } from './pagination';
+
+const EVENTS_URL = 'http://127.0.0.1:5001/api/events';
+
+// Streams request status changes from the event server. onChange gets each change;
+// onResync means changes were missed (the server restarted or the view fell behind)
+// and the view should load its list again.
+export function openRequestEvents(onChange, onResync) {
+  const token = encodeURIComponent(localStorage.getItem('token') || '');
+  const source = new EventSource(`${EVENTS_URL}?token=${token}`);
+  source.addEventListener('request', event => onChange(JSON.parse(event.data)));
+  source.addEventListener('resync', onResync);
+  return source;
+}
+
+// While the stream is down, views reload after their own changes as they used to.
+export function isLive(source) {
+  return !!source && source.readyState === EventSource.OPEN;
+}
+
+// Copies a change onto the loaded request with the same id. Returns false when the
+// request is not loaded, so the view can fetch it with fetchRequest.
+export function applyRequestChange(requests, change) {
+  const index = requests.findIndex(request => request.id === change.id);
+  if (change.change === 'deleted') {
+    if (index !== -1) {
+      requests.splice(index, 1);
+    }
+    return true;
+  }
+  if (index === -1) {
+    return false;
+  }
+  for (const field of ['status', 'issue_date', 'return_date']) {
+    if (field in change) {
+      requests[index][field] = change[field];
+    }
+  }
+  return true;
+}
+
+export async function fetchRequest(listUserId, change) {
+  const response = await axios.get(`http://127.0.0.1:5000/api/request/user/${listUserId}?ids=${change.id}`);
+  return response.data.find(request => request.id === change.id);
+}
+
+export async function fetchRequestPage(listUserId, params) {
+  const page = await fetchPage(`http://127.0.0.1:5000/api/request/user/${listUserId}`, params);
+  return { requests: page.items, next: page.next };
+}